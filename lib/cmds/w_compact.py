@@ -0,0 +1,92 @@
+# Copyright (C) 2013 Joseph W. Kaus and Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+
+import argparse, os
+
+import logging
+log = logging.getLogger('w_compact')
+
+import h5py
+import westpa
+from west.data_manager import create_aggregate_views
+
+parser = argparse.ArgumentParser('w_compact', description='''\
+Merge iteration shards (written when west.data.iterations_per_shard is set) back
+into the main WESTPA HDF5 file, replacing the external links to each sharded
+iteration group with a copy of the group itself, and optionally (re)build
+virtual data sets presenting the segment index and final progress coordinates
+of all iterations as single arrays.
+''')
+
+westpa.rc.add_args(parser)
+parser.add_argument('--no-merge', dest='merge', action='store_false',
+                    help='''Do not merge iteration shards into the main file (e.g. to only build
+                    aggregate views over shards in place).''')
+parser.add_argument('--remove-shards', action='store_true',
+                    help='''Delete shard files once all iterations they contain have been merged.''')
+parser.add_argument('--aggregate', action='store_true',
+                    help='''Build virtual data sets of all completed iterations in /aggregates
+                    (requires HDF5 1.10 and h5py 2.9 or later).''')
+args = parser.parse_args()
+westpa.rc.process_args(args, config_required=False)
+dm = westpa.rc.get_data_manager()
+dm.open_backing()
+h5file = dm.we_h5file
+h5dir = os.path.dirname(os.path.abspath(dm.we_h5filename))
+
+merged_shards = set()
+if args.merge:
+    for n_iter in xrange(1, dm.current_iteration+1):
+        iter_group_name = dm.iter_group_name(n_iter)
+        link = h5file.get(iter_group_name, getlink=True)
+        if not isinstance(link, h5py.ExternalLink):
+            continue
+
+        shard_path = os.path.join(h5dir, link.filename)
+        temp_name = iter_group_name + '_compacting'
+        with h5py.File(shard_path, 'r') as shard_file:
+            shard_file.copy(link.path, h5file, name=temp_name)
+
+        # Swap the copy in for the link only once the copy is complete
+        iter_group = h5file[temp_name]
+        if iter_group.get('ibstates', getlink=True) is not None:
+            del iter_group['ibstates']
+            iter_group['ibstates'] = dm.find_ibstate_group(n_iter)
+        del h5file[iter_group_name]
+        h5file.move(temp_name, iter_group_name)
+        merged_shards.add(shard_path)
+        log.debug('merged iteration {:d} from {!r}'.format(n_iter, shard_path))
+        print('merged iteration {:d}'.format(n_iter))
+
+if args.aggregate:
+    try:
+        group = create_aggregate_views(h5file, 1, dm.current_iteration, iter_prec=dm.iter_prec)
+    except RuntimeError as e:
+        log.warning('skipping aggregate views: {}'.format(e))
+    else:
+        print('aggregate views of iterations 1-{:d} created in {}'.format(dm.current_iteration-1, group.name))
+
+dm.flush_backing()
+dm.close_backing()
+
+if args.remove_shards:
+    for shard_path in sorted(merged_shards):
+        log.debug('removing {!r}'.format(shard_path))
+        os.unlink(shard_path)
+        print('removed {}'.format(shard_path))
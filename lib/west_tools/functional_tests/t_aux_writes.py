@@ -0,0 +1,69 @@
+from __future__ import print_function, division
+# Compare per-segment and coalesced writes of trajectories/* auxiliary data sets,
+# as performed by WESTDataManager.update_segments()
+import os, time, tempfile
+import numpy
+import h5py
+from h5py import h5s
+from west import Segment
+from west.data_manager import write_aux_data, vvoid_dtype
+
+n_segs = 4096
+n_atoms = 100
+pcoord_len = 11
+n_reps = 5
+
+def per_segment_write(dset, dsname, segments):
+    # The write path used by update_segments() prior to write_aux_data()
+    for segment in segments:
+        auxdataset = segment.data[dsname]
+        source_rank = len(auxdataset.shape)
+        source_sel = h5s.create_simple(auxdataset.shape, (h5s.UNLIMITED,)*source_rank)
+        source_sel.select_all()
+        dest_sel = dset.id.get_space()
+        dest_sel.select_hyperslab((segment.seg_id,)+(0,)*source_rank, (1,)+auxdataset.shape)
+        dset.id.write(source_sel, dest_sel, auxdataset)
+
+def make_segments():
+    segments = []
+    for seg_id in xrange(n_segs):
+        restart = os.urandom(512).encode('base64')
+        segment = Segment(n_iter=1, seg_id=seg_id, weight=1.0/n_segs)
+        segment.data['trajectories/trajectory'] = numpy.random.random((pcoord_len, n_atoms, 3)).astype(numpy.float32)
+        segment.data['trajectories/restart'] = numpy.asarray(restart, order='C')
+        segments.append(segment)
+    # update_segments() receives the segments in completion order, not seg_id order
+    numpy.random.shuffle(segments)
+    return segments
+
+def time_writes(writefn, segments):
+    (fd, filename) = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    timings = {}
+    try:
+        with h5py.File(filename, 'w') as h5file:
+            for (dsname, row_shape, dtype) in [('trajectories/trajectory', (pcoord_len, n_atoms, 3), numpy.float32),
+                                               ('trajectories/restart', (), vvoid_dtype)]:
+                dset = h5file.create_dataset(dsname, shape=(n_segs,)+row_shape, dtype=dtype)
+                walltimes = []
+                for _rep in xrange(n_reps):
+                    t0 = time.time()
+                    writefn(dset, dsname, segments)
+                    h5file.flush()
+                    walltimes.append(time.time() - t0)
+                timings[dsname] = min(walltimes)
+    finally:
+        os.unlink(filename)
+    return timings
+
+segments = make_segments()
+# Segments must be sorted for the per-segment path to be a fair comparison of HDF5 call overhead
+per_segment = time_writes(per_segment_write, sorted(segments, key=lambda segment: segment.seg_id))
+coalesced = time_writes(write_aux_data, segments)
+
+print('{:d} segments, best of {:d} writes'.format(n_segs, n_reps))
+for dsname in sorted(per_segment):
+    print('{}:'.format(dsname))
+    print('  per-segment:     {:.4f} s'.format(per_segment[dsname]))
+    print('  coalesced:       {:.4f} s'.format(coalesced[dsname]))
+    print('  speedup:         {:.1f}x'.format(per_segment[dsname]/coalesced[dsname]))
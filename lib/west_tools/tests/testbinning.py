@@ -17,11 +17,12 @@
 
 from __future__ import division, print_function
 from westpa.binning.assign import (RectilinearBinMapper, PiecewiseBinMapper, FuncBinMapper, VectorizingFuncBinMapper, 
-                                 VoronoiBinMapper, RecursiveBinMapper)
+                                 VoronoiBinMapper, RecursiveBinMapper, euclidean_dfunc)
 from westpa.binning.assign import index_dtype, coord_dtype
 from westpa.binning._assign import testfunc #@UnresolvedImport
 
 import numpy
+import cPickle as pickle
 from scipy.spatial.distance import cdist
 import nose
 import nose.tools
@@ -62,6 +63,34 @@ class TestRectilinearBinMapper:
         
         assert (assigner.assign(coords) == [0, 5, 10, 10, 15, 7, 8]).all()
 
+class TestPickleAndHash:
+    def test_cached_until_changed(self):
+        mapper = RectilinearBinMapper([[0,1,2]])
+        result = mapper.pickle_and_hash()
+        assert mapper.pickle_and_hash() is result
+
+        mapper.boundaries = [[0,1,2,3]]
+        changed = mapper.pickle_and_hash()
+        assert changed[1] != result[1]
+
+        mapper.boundaries = [[0,1,2]]
+        assert mapper.pickle_and_hash()[1] == result[1]
+
+    def test_mark_changed(self):
+        mapper = RectilinearBinMapper([[0,1,2]])
+        result = mapper.pickle_and_hash()
+        mapper.mark_changed()
+        assert mapper.pickle_and_hash() is not result
+        assert mapper.pickle_and_hash()[1] == result[1]
+
+    def test_nested_change(self):
+        inner_mapper = RectilinearBinMapper([[0,0.5,1]])
+        rmapper = RecursiveBinMapper(RectilinearBinMapper([[0,1,2]]))
+        rmapper.add_mapper(inner_mapper, [0.5])
+        result = rmapper.pickle_and_hash()
+        inner_mapper.boundaries = [[0,0.25,1]]
+        assert rmapper.pickle_and_hash()[1] != result[1]
+
 class TestPiecewiseBinMapper:
     def test_bin_mapping(self):
         coords = numpy.array([[-0.5], [0.0], [0.5]], dtype=numpy.float32)
@@ -118,8 +147,72 @@ class TestVoronoiBinMapper:
         mapper = VoronoiBinMapper(self.distfunc, centers)
         output = mapper.assign(coords)
         assert list(output) == [0,1,0,1]
-        
- 
+
+    def test_vmapper_euclidean(self):
+        centers = numpy.random.random((50,3)).astype(coord_dtype)
+        coords = numpy.random.random((500,3)).astype(coord_dtype)
+        mask = numpy.random.random((500,)) < 0.5
+
+        generic = VoronoiBinMapper(self.distfunc, centers)
+        fast = VoronoiBinMapper(euclidean_dfunc, centers)
+        assert fast.metric == 'euclidean'
+        fast.block_size = 64
+        assert (fast.assign(coords) == generic.assign(coords)).all()
+
+        output = numpy.zeros((500,), dtype=index_dtype)
+        fast.assign(coords, mask, output)
+        assert (output[mask] == generic.assign(coords)[mask]).all()
+        assert (output[~mask] == 0).all()
+
+    def test_vmapper_periodic(self):
+        centers = numpy.array([[0.5,0.5], [9.5,9.5]], dtype=coord_dtype)
+        coords = numpy.array([[0.1,0.1], [0.0,9.8], [5.2,5.2], [4.8,4.8]], dtype=coord_dtype)
+
+        mapper = VoronoiBinMapper(None, centers, metric='periodic', box=[10.0,10.0])
+        assert list(mapper.assign(coords)) == [0,1,1,0]
+
+    def test_vmapper_centers_update(self):
+        mapper = VoronoiBinMapper(None, [[0,0],[2,2]], metric='euclidean')
+        coords = numpy.array([[0.9,0.9], [1.9,1.9]], dtype=coord_dtype)
+        assert list(mapper.assign(coords)) == [0,1]
+        mapper.centers = numpy.array([[1,1],[5,5],[2,2]], dtype=coord_dtype)
+        assert mapper.nbins == 3
+        assert list(mapper.assign(coords)) == [0,2]
+
+    def test_vmapper_hash_ignores_index(self):
+        mapper = VoronoiBinMapper(euclidean_dfunc, [[0,0],[2,2]])
+        hash_before = mapper.pickle_and_hash()[1]
+        mapper.assign(numpy.array([[1.5,1.5]], dtype=coord_dtype))
+        assert mapper.pickle_and_hash()[1] == hash_before
+
+    def test_vmapper_pickle_state(self):
+        # The state of a mapper with an implied metric is the same as before metrics existed
+        mapper = VoronoiBinMapper(euclidean_dfunc, [[0,0],[2,2]])
+        mapper.assign(numpy.array([[1.5,1.5]], dtype=coord_dtype))
+        assert sorted(mapper.__getstate__()) == ['centers', 'dfargs', 'dfkwargs', 'dfunc', 'labels', 'nbins', 'ndim']
+        other = VoronoiBinMapper(euclidean_dfunc, [[0,0],[2,2]])
+        assert other.pickle_and_hash()[1] == mapper.pickle_and_hash()[1]
+
+        restored = pickle.loads(mapper.pickle_and_hash()[0])
+        assert restored.metric == 'euclidean'
+        assert list(restored.assign(numpy.array([[0.5,0.5],[1.5,1.5]], dtype=coord_dtype))) == [0,1]
+
+    def test_vmapper_pickle_explicit_metric(self):
+        mapper = VoronoiBinMapper(euclidean_dfunc, [[0.5,0.5],[9.5,9.5]], metric='periodic', box=[10.0,10.0])
+        restored = pickle.loads(mapper.pickle_and_hash()[0])
+        assert restored.metric == 'periodic'
+        assert (restored.box == [10.0,10.0]).all()
+        assert list(restored.assign(numpy.array([[0.0,9.8]], dtype=coord_dtype))) == [1]
+
+    def test_vmapper_periodic_wrap(self):
+        # numpy.mod() of a tiny negative coordinate gives exactly the box length
+        mapper = VoronoiBinMapper(None, [[0.5],[5.5]], metric='periodic', box=[10.0])
+        coords = numpy.array([[-1e-20], [10.0], [4.9]], dtype=coord_dtype)
+        wrapped = mapper._wrap(numpy.require(coords, dtype=numpy.float64))
+        assert (wrapped >= 0).all() and (wrapped < 10.0).all()
+        assert list(mapper.assign(coords)) == [0,0,1]
+
+
 class TestNestingBinMapper:
     #pass
     '''         
@@ -342,3 +435,26 @@ class TestNestingBinMapper:
         assert (rmapper.assign(pairs) == [0,4,5,2,3,1]).all()
 
 
+
+    def testGroupedDispatchWithMask(self):
+        '''Each nested mapper is called once, on only the coordinates in its outer bin,
+        and masked-out outputs are left untouched.'''
+
+        calls = []
+        def counting_fn2(coords, mask, output):
+            calls.append(len(coords))
+            self.fn2(coords, mask, output)
+
+        outer_mapper = FuncBinMapper(self.fn1,2)
+        inner_mapper = FuncBinMapper(counting_fn2,2)
+        rmapper = RecursiveBinMapper(outer_mapper)
+        rmapper.add_mapper(inner_mapper, [0.5])
+        del calls[:]
+
+        coords = numpy.array([[0.1], [1.1], [0.6], [1.4], [0.2], [0.7]])
+        mask = numpy.array([True, True, True, True, False, True])
+        output = numpy.empty((len(coords),), dtype=index_dtype)
+        output[4] = 17
+        rmapper.assign(coords, mask, output)
+        assert list(output) == [1, 0, 2, 0, 17, 2]
+        assert calls == [3]
@@ -58,12 +58,12 @@ significant analysis tasks).
         self.print_pcoords = args.print_pcoords
     
     def go(self):
-        segments = self.data_reader.get_segments(self.n_iter)
+        segments = self.data_reader.get_segment_table(self.n_iter)
         
-        max_seg_id_len = len(str(max(segment.seg_id for segment in segments)))
+        max_seg_id_len = len(str(segments.seg_ids.max()))
         max_status_name_len = max(map(len,Segment.status_names.itervalues()))
         max_endpoint_type_len = max(map(len,Segment.endpoint_type_names.itervalues()))
-        max_n_parents_len = len(str(max(len(segment.wtg_parent_ids) for segment in segments)))
+        max_n_parents_len = len(str(segments.wtg_n_parents.max()))
         
         report_line = ( '{segment.n_iter:d}  {segment.seg_id:{max_seg_id_len}d}  {segment.weight:20.14g}' 
                         +'  {status_name:{max_status_name_len}s} ({segment.status})'
@@ -206,13 +206,14 @@ class RWReweight(AverageCommands):
         for iiter in xrange(start_iter, stop_iter):
             iter_grp = self.kinetics_file['iterations']['iter_{:08d}'.format(iiter)]
 
-            rows.append(iter_grp['rows'][...])
-            cols.append(iter_grp['cols'][...])
-            obs.append(iter_grp['obs'][...])
-            flux.append(iter_grp['flux'][...])
+            (iter_rows, iter_cols, iter_flux, iter_obs, _shape) = h5io.read_flux_matrix(iter_grp)
+            rows.append(iter_rows)
+            cols.append(iter_cols)
+            obs.append(iter_obs)
+            flux.append(iter_flux)
             # 'insert' is the insertion point for each iteration; that is,
             # at what point do we look into the list for iteration X?
-            insert.append(iter_grp['rows'][...].shape[0] + insert[-1])
+            insert.append(iter_rows.shape[0] + insert[-1])
         self.rows = np.concatenate(rows)
         self.cols = np.concatenate(cols)
         self.obs = np.concatenate(obs)
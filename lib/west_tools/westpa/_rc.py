@@ -270,6 +270,8 @@ class WESTRC:
         drivername = self.config.get(['west', 'drivers', 'we_driver'], 'default')
         if drivername.lower() == 'default':
             we_driver = west.we_driver.WEDriver()
+        elif drivername.lower() == 'array':
+            we_driver = west.we_driver.ArrayWEDriver(rc=self)
         else:
             we_driver = extloader.get_object(drivername)(rc=self)
         log.debug('loaded WE algorithm driver: {!r}'.format(we_driver))
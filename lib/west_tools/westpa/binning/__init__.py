@@ -7,4 +7,5 @@ from _assign import accumulate_labeled_populations, assign_and_label, accumulate
 from _assign import assignments_list_to_table #@UnresolvedImport
 
 from assign import coord_dtype, index_dtype
+from assign import euclidean_dfunc, periodic_dfunc
 from bins import Bin
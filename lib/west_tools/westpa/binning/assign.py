@@ -61,7 +61,12 @@ from __future__ import division, print_function; __metaclass__ = type
 
 import cPickle as pickle
 import hashlib, logging
+from itertools import izip
 import numpy
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
 
 from bins import Bin
 
@@ -83,10 +88,37 @@ log = logging.getLogger(__name__)
 class BinMapper:
     hashfunc = hashlib.sha256
 
+    # Derived or cached data is kept in slots rather than in the instance dictionary, so
+    # that it is not pickled and the mapper hash is unaffected by it
+    __slots__ = ('__dict__', '__weakref__', '_version', '_pickle_and_hash_cache')
+
+    # Attributes whose assignment does not count as a change to the mapper
+    _transient_attrs = frozenset(['_version', '_pickle_and_hash_cache'])
+
     def __init__(self):
         self.labels = None
         self.nbins = 0
 
+    def __setattr__(self, name, value):
+        if name not in self._transient_attrs:
+            object.__setattr__(self, '_version', getattr(self, '_version', 0) + 1)
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        return self.__dict__
+
+    @property
+    def version(self):
+        '''A counter which changes whenever an attribute of this mapper is assigned. Changes
+        made in place (e.g. to the contents of an array) are not detected; call
+        :meth:`mark_changed` after making them. May be None if the version cannot be
+        determined, in which case the mapper is always assumed to have changed.'''
+        return getattr(self, '_version', 0)
+
+    def mark_changed(self):
+        '''Record that this mapper has been modified in place.'''
+        object.__setattr__(self, '_version', getattr(self, '_version', 0) + 1)
+
     def construct_bins(self, type_=Bin):
         '''Construct and return an array of bins of type ``type``'''
         return numpy.array([type_() for _i in xrange(self.nbins)], dtype=numpy.object_)
@@ -97,11 +129,26 @@ class BinMapper:
         This will raise PickleError if this mapper cannot be pickled, in which case
         code that would otherwise rely on detecting a topology change must assume
         a topology change happened, even if one did not.
+
+        The result is cached, and returned again without re-pickling until the
+        mapper's :attr:`version` changes.
         '''
 
+        version = self.version
+        try:
+            (cached_version, cached_result) = self._pickle_and_hash_cache
+        except AttributeError:
+            pass
+        else:
+            if version is not None and version == cached_version:
+                return cached_result
+
         pkldat = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
         hash = self.hashfunc(pkldat)
-        return (pkldat, hash.hexdigest())
+        result = (pkldat, hash.hexdigest())
+        if version is not None:
+            self._pickle_and_hash_cache = (version, result)
+        return result
 
     def __repr__(self):
         return '<{} at 0x{:x} with {:d} bins>'.format(self.__class__.__name__, id(self), self.nbins or 0)
@@ -292,25 +339,190 @@ class VectorizingFuncBinMapper(BinMapper):
 
         return output
 
+def euclidean_dfunc(coordvec, centers):
+    '''Euclidean distance from ``coordvec`` to each of ``centers``. Passing this
+    function as the ``dfunc`` of a :class:`VoronoiBinMapper` enables its vectorized
+    assignment path.'''
+    return numpy.sqrt(((centers - coordvec)**2).sum(axis=1))
+
+def periodic_dfunc(coordvec, centers, box):
+    '''Euclidean distance from ``coordvec`` to each of ``centers`` under the minimum
+    image convention in an orthorhombic box with edge lengths ``box``. Passing this
+    function as the ``dfunc`` of a :class:`VoronoiBinMapper` enables its vectorized
+    assignment path.'''
+    delta = centers - coordvec
+    delta -= box * numpy.round(delta / box)
+    return numpy.sqrt((delta**2).sum(axis=1))
+
 class VoronoiBinMapper(BinMapper):
     '''A one-dimensional mapper which assigns a multidimensional pcoord to the
     closest center based on a distance metric. Both the list of centers and the
-    distance function must be supplied.'''
+    distance function must be supplied.
+
+    If ``metric`` is 'euclidean' or 'periodic' (or ``dfunc`` is :func:`euclidean_dfunc`
+    or :func:`periodic_dfunc`), assignment uses a KD-tree over the centers (if
+    scipy is available) or a blocked, vectorized distance calculation, instead of calling
+    ``dfunc`` once per coordinate. The 'periodic' metric requires the box edge lengths
+    ``box``. The index is rebuilt whenever ``centers`` is assigned; modifying the centers
+    array in place is not detected.'''
+
+    metrics = (None, 'euclidean', 'periodic')
+
+    # Number of coordinates per block in the vectorized (non-KD-tree) path
+    block_size = 1024
+
+    # KD-trees lose their advantage over brute force in high dimensions
+    max_kdtree_ndim = 16
+
+    # The spatial index is rebuilt on demand and must not affect the mapper hash; the metric
+    # and box are pickled only if they cannot be recovered from the distance function
+    __slots__ = ('_index', 'metric', 'box')
+    _transient_attrs = BinMapper._transient_attrs | frozenset(['_index'])
+
+    def __init__(self, dfunc, centers, dfargs=None, dfkwargs=None, metric=None, box=None):
+        if metric not in self.metrics:
+            raise ValueError('unknown metric {!r}'.format(metric))
+        if dfunc is None:
+            if metric == 'euclidean':
+                dfunc = euclidean_dfunc
+            elif metric == 'periodic':
+                if box is None:
+                    raise TypeError('the periodic metric requires box dimensions')
+                dfunc = periodic_dfunc
+                dfkwargs = {'box': box}
+            else:
+                raise TypeError('a distance function or metric is required')
 
-    def __init__(self, dfunc, centers, dfargs=None, dfkwargs=None):
+        # Attributes are set in the same order as before the vectorized path existed, so that
+        # mappers pickle (and hash) as they always have
         self.dfunc = dfunc
         self.dfargs = dfargs or ()
         self.dfkwargs = dfkwargs or {}
-        self.centers = numpy.asarray(centers)
-        self.nbins = self.centers.shape[0]
-        self.ndim = self.centers.shape[1]
-        self.labels = ['center={!r}'.format(center) for center in self.centers]
+        self.centers = centers
+
+        (implied_metric, implied_box) = self._implied_metric()
+        if metric is None or metric == implied_metric:
+            (metric, box) = (implied_metric, implied_box)
+        elif metric == 'periodic' and box is None:
+            raise TypeError('the periodic metric requires box dimensions')
+        self._set_metric(metric, box)
 
         # Sanity check: does the distance map the centers to themselves?
         check = self.assign(self.centers)
         if (check != numpy.arange(len(self.centers))).any():
             raise TypeError('dfunc does not map centers to themselves')
 
+    def __setattr__(self, name, value):
+        if name == 'centers':
+            value = numpy.asarray(value)
+        super(VoronoiBinMapper, self).__setattr__(name, value)
+        if name == 'centers':
+            # Keep the attributes derived from the centers consistent with them
+            self.nbins = value.shape[0]
+            self.ndim = value.shape[1]
+            self.labels = ['center={!r}'.format(center) for center in value]
+
+    def _implied_metric(self):
+        '''Return the metric (and box) implied by the distance function, or (None, None).'''
+        if self.dfunc is euclidean_dfunc:
+            return ('euclidean', None)
+        elif self.dfunc is periodic_dfunc:
+            return ('periodic', self.dfkwargs.get('box', self.dfargs[0] if self.dfargs else None))
+        else:
+            return (None, None)
+
+    def _set_metric(self, metric, box):
+        self.metric = metric
+        if metric == 'periodic':
+            self.box = numpy.require(box, dtype=numpy.float64)
+            if self.box.shape != (self.ndim,):
+                raise TypeError('box must have one entry per coordinate dimension')
+        else:
+            self.box = None
+
+    def __getstate__(self):
+        state = self.__dict__
+        # Mappers are identified by the hash of their pickles, so the state is left exactly
+        # as it was before the metric existed unless the metric is explicit
+        if getattr(self, 'metric', None) != self._implied_metric()[0]:
+            state = dict(state, metric=self.metric, box=self.box)
+        return state
+
+    def __setstate__(self, state):
+        # Mappers pickled by an earlier version of the vectorized path stored centers as _centers
+        if '_centers' in state:
+            state['centers'] = state.pop('_centers')
+        metric = state.pop('metric', None)
+        box = state.pop('box', None)
+        state.pop('_index', None)
+        self.__dict__.update(state)
+        if metric is None:
+            (metric, box) = self._implied_metric()
+        object.__setattr__(self, 'metric', metric)
+        object.__setattr__(self, 'box', numpy.require(box, dtype=numpy.float64) if metric == 'periodic' else None)
+
+    def _get_index(self):
+        # The index is rebuilt whenever the mapper changes (e.g. centers is assigned)
+        version = self.version
+        try:
+            (index_version, index) = self._index
+        except AttributeError:
+            pass
+        else:
+            if version is not None and version == index_version:
+                return index
+        index = self._build_index()
+        self._index = (version, index)
+        return index
+
+    def _build_index(self):
+        if cKDTree is not None and self.ndim <= self.max_kdtree_ndim:
+            centers = numpy.require(self.centers, dtype=numpy.float64)
+            if self.metric == 'periodic':
+                try:
+                    return cKDTree(self._wrap(centers), boxsize=self.box)
+                except TypeError:
+                    # scipy too old to support periodic boundaries
+                    return False
+            else:
+                return cKDTree(centers)
+        return False
+
+    def _wrap(self, coords):
+        '''Wrap ``coords`` into the half-open box [0, box).'''
+        wrapped = numpy.mod(coords, self.box)
+        # numpy.mod() returns exactly box for tiny negative values, which cKDTree rejects
+        return numpy.where(wrapped >= self.box, 0.0, wrapped)
+
+    def _assign_vectorized(self, coords, mask, output):
+        index = self._get_index()
+
+        if mask.all():
+            indices = None
+            coords = numpy.require(coords, dtype=numpy.float64)
+        else:
+            indices = numpy.flatnonzero(mask)
+            coords = numpy.require(coords[indices], dtype=numpy.float64)
+
+        if index is not False:
+            if self.metric == 'periodic':
+                coords = self._wrap(coords)
+            assignments = index.query(coords)[1]
+        else:
+            centers = numpy.require(self.centers, dtype=numpy.float64)
+            assignments = numpy.empty((len(coords),), dtype=numpy.intp)
+            for istart in xrange(0, len(coords), self.block_size):
+                istop = min(istart + self.block_size, len(coords))
+                delta = coords[istart:istop,numpy.newaxis,:] - centers[numpy.newaxis,:,:]
+                if self.metric == 'periodic':
+                    delta -= self.box * numpy.round(delta / self.box)
+                assignments[istart:istop] = numpy.argmin((delta**2).sum(axis=2), axis=1)
+
+        if indices is None:
+            output[:] = assignments
+        else:
+            output[indices] = assignments
+
     def assign(self, coords, mask=None, output=None):
         try:
             passed_coord_dtype = coords.dtype
@@ -332,14 +544,21 @@ class VoronoiBinMapper(BinMapper):
         elif len(output) != len(coords):
             raise TypeError('output has different length than coords')
 
-        apply_down_argmin_across(self.dfunc, (self.centers,) + self.dfargs, self.dfkwargs, self.nbins,
-                                 coords, mask, output)
+        if self.metric is not None:
+            self._assign_vectorized(coords, numpy.require(mask, dtype=numpy.bool_), output)
+        else:
+            apply_down_argmin_across(self.dfunc, (self.centers,) + self.dfargs, self.dfkwargs, self.nbins,
+                                     coords, mask, output)
 
         return output
 
 class RecursiveBinMapper(BinMapper):
     '''Nest mappers one within another.'''
 
+    # The dispatch table is derived data and must not affect the mapper hash
+    __slots__ = ('_dispatch_table',)
+    _transient_attrs = BinMapper._transient_attrs | frozenset(['_dispatch_table'])
+
     def __init__(self, base_mapper, start_index=0):
         self.base_mapper = base_mapper
         self.nbins = base_mapper.nbins
@@ -382,6 +601,11 @@ class RecursiveBinMapper(BinMapper):
             # No un-replaced bins
             self._output_map = None
 
+        try:
+            del self._dispatch_table
+        except AttributeError:
+            pass
+
         n_own_bins = self.base_mapper.nbins - self._recursion_map.sum()
         startindex = self.start_index + n_own_bins
         for mapper in self._recursion_targets.itervalues():
@@ -418,36 +642,73 @@ class RecursiveBinMapper(BinMapper):
         # reassignment of mappers' output values
         self.start_index = self.start_index        
 
+    @property
+    def version(self):
+        # Nested mappers may change independently of this one
+        versions = [super(RecursiveBinMapper, self).version, getattr(self.base_mapper, 'version', None)]
+        versions.extend(getattr(self._recursion_targets[rbin], 'version', None)
+                        for rbin in sorted(self._recursion_targets))
+        if None in versions:
+            return None
+        return tuple(versions)
+
+    @property
+    def _dispatch(self):
+        '''A tuple ``(rbins, rmappers)`` of the (sorted) base bins containing nested mappers
+        and the corresponding mappers, rebuilt only when the recursion structure or start
+        index changes.'''
+        try:
+            return self._dispatch_table
+        except AttributeError:
+            rbins = numpy.flatnonzero(self._recursion_map)
+            rmappers = [self._recursion_targets[rbin] for rbin in rbins]
+            self._dispatch_table = dispatch = (rbins, rmappers)
+            return dispatch
+
     def assign(self, coords, mask=None, output=None):
+        coords = numpy.asarray(coords)
+
         if mask is None:
             mask = numpy.ones((len(coords),), dtype=numpy.bool_)
+        else:
+            mask = numpy.require(mask, dtype=numpy.bool_)
 
         if output is None:
             output = numpy.empty((len(coords),), dtype=index_dtype)
 
-        # mapping mask -- which output values come from our base
-        # region set and therefore must be remapped            
-        mmask = numpy.zeros((len(coords),), dtype=numpy.bool_)
-
         # Assign based on this mapper
         self.base_mapper.assign(coords, mask, output)
 
+        (rbins, rmappers) = self._dispatch
+        if not len(rbins):
+            output_map(output, self._output_map, mask)
+            return output
+
         # Which coordinates do we need to reassign, because they landed in
         # bins with embedded mappers?
-        rmasks = {}
-        for (rindex, mapper) in self._recursion_targets.iteritems():
-            omask = (output == rindex)
-            mmask |= omask
-            rmasks[rindex] = omask
+        selected = numpy.flatnonzero(mask)
+        base_assignments = output[selected]
+        recursed = self._recursion_map[base_assignments]
 
         # remap output from our (base) mapper
         # omap may be None if every bin has a recursive mapper in it
         omap = self._output_map
         if omap is not None:
-            output_map(output, omap, mask & ~mmask)
-
-        # do any recursive assignments necessary
-        for (rindex, mapper) in self._recursion_targets.iteritems():
-            mapper.assign(coords, mask&rmasks[rindex], output)
+            own = selected[~recursed]
+            output[own] = omap[output[own]]
+
+        # Group coordinates by outer bin, so that each nested mapper is called
+        # exactly once, on a contiguous block of coordinates
+        rindices = selected[recursed]
+        rassignments = base_assignments[recursed]
+        order = numpy.argsort(rassignments, kind='mergesort')
+        rindices = rindices[order]
+        offsets = numpy.searchsorted(rassignments[order], rbins, side='left')
+        ends = numpy.searchsorted(rassignments[order], rbins, side='right')
+
+        for (mapper, istart, iend) in izip(rmappers, offsets, ends):
+            if iend > istart:
+                group = rindices[istart:iend]
+                output[group] = mapper.assign(coords[group])
 
         return output
@@ -209,7 +209,32 @@ def get_iteration_slice(h5object, iter_start, iter_stop=None, iter_stride=None):
 
 
 
-        
+
+###
+# Sparse (coordinate-form) flux matrices
+###
+def write_flux_matrix(h5group, rows, cols, flux, obs, nrows, ncols=None, compression=None):
+    '''Store a sparse bin-to-bin flux matrix and the corresponding matrix of observed transition
+    counts in ``h5group``, as coordinate triplets: entry k is a flux of ``flux[k]`` (from
+    ``obs[k]`` observed transitions) from bin ``rows[k]`` to bin ``cols[k]``. The full matrix
+    dimensions are stored in the ``nrows`` and ``ncols`` attributes.'''
+    if ncols is None:
+        ncols = nrows
+    for (dsname, data, dtype) in [('flux', flux, numpy.float64), ('obs', obs, numpy.int32),
+                                  ('rows', rows, numpy.int32), ('cols', cols, numpy.int32)]:
+        if dsname in h5group:
+            del h5group[dsname]
+        data = numpy.asarray(data, dtype=dtype)
+        h5group.create_dataset(dsname, data=data, dtype=dtype,
+                               compression=(compression if len(data) else None))
+    h5group.attrs['nrows'] = nrows
+    h5group.attrs['ncols'] = ncols
+
+def read_flux_matrix(h5group):
+    '''Read a sparse flux matrix stored by ``write_flux_matrix``, returning
+    ``(rows, cols, flux, obs, shape)``.'''
+    return (h5group['rows'][...], h5group['cols'][...], h5group['flux'][...], h5group['obs'][...],
+            (int(h5group.attrs['nrows']), int(h5group.attrs['ncols'])))
     
 ###
 # Axis label metadata
@@ -247,10 +272,17 @@ def _get_one_attr(h5object, namelist, default=NotGiven):
             return default
         
 class WESTPAH5File(h5py.File):
-    '''Generalized input/output for WESTPA simulation (or analysis) data.'''
+    '''Generalized input/output for WESTPA simulation (or analysis) data.
+    
+    If opened read-only with ``follow=True`` (or if ``default_follow`` is set), the file is
+    opened as an HDF5 SWMR reader, so that it may be read while a simulation writes to it in
+    SWMR mode. Call ``refresh()`` to see data written to already-open data sets.'''
     
     default_iter_prec = 8
     _this_fileformat_version = 8
+    
+    # Open read-only files as SWMR readers by default (set by analysis tools run with --follow)
+    default_follow = False
         
     def __init__(self, *args, **kwargs):
         
@@ -260,6 +292,13 @@ class WESTPAH5File(h5py.File):
         arg_iter_prec = kwargs.pop('westpa_iter_prec', self.default_iter_prec)
         arg_fileformat_version = kwargs.pop('westpa_fileformat_version', self._this_fileformat_version)
         arg_creating_program = kwargs.pop('creating_program', None)
+        follow = kwargs.pop('follow', self.default_follow)
+        
+        mode = args[1] if len(args) > 1 else kwargs.get('mode')
+        if follow and mode == 'r':
+            kwargs['libver'] = 'latest'
+            kwargs['swmr'] = True
+        self.follow = bool(follow and mode == 'r')
         
         # Initialize h5py file
         super(WESTPAH5File,self).__init__(*args, **kwargs)
@@ -282,6 +321,14 @@ class WESTPAH5File(h5py.File):
             if arg_creating_program:
                 stamp_creator_data(self, creating_program=arg_creating_program)
 
+    def refresh(self):
+        '''When following a file being written in SWMR mode, refresh the metadata of all open data
+        sets, so that data written since they were opened (e.g. new rows) becomes visible. New
+        iterations only become visible when the file is reopened.'''
+        if self.follow:
+            for dsid in self.id.get_obj_ids(types=h5py.h5f.OBJ_DATASET):
+                dsid.refresh()
+        
     # Helper function to automatically replace a group, if it exists.
     # Should really only be called when one is certain a dataset should be blown away.
     def replace_dataset(self, *args, **kwargs):
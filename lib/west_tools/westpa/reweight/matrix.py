@@ -125,12 +125,7 @@ class FluxMatrix():
             assert fluxes_sp.nnz == trans_sp.nnz
 
             flux_iter_grp = flux_grp.create_group('iter_{:08d}'.format(n_iter))
-            flux_iter_grp.create_dataset('flux', data=fluxes_sp.data, dtype=weight_dtype)
-            flux_iter_grp.create_dataset('obs', data=trans_sp.data, dtype=np.int32)
-            flux_iter_grp.create_dataset('rows', data=fluxes_sp.row, dtype=np.int32)
-            flux_iter_grp.create_dataset('cols', data=fluxes_sp.col, dtype=np.int32)
-            flux_iter_grp.attrs['nrows'] = nfbins
-            flux_iter_grp.attrs['ncols'] = nfbins
+            h5io.write_flux_matrix(flux_iter_grp, fluxes_sp.row, fluxes_sp.col, fluxes_sp.data, trans_sp.data, nfbins)
 
             # Do a little manual clean-up to prevent memory explosion
             del iter_group, weights, bin_assignments
@@ -21,7 +21,7 @@ from numpy import index_exp
 from core import WESTToolComponent
 import westpa
 from westpa.extloader import get_object
-from westpa.h5io import FnDSSpec, MultiDSSpec, SingleSegmentDSSpec, SingleIterDSSpec
+from westpa.h5io import FnDSSpec, MultiDSSpec, SingleSegmentDSSpec, SingleIterDSSpec, WESTPAH5File
 
 
 def _get_parent_ids(n_iter, iter_group):
@@ -47,6 +47,7 @@ class WESTDataReader(WESTToolComponent):
         super(WESTDataReader,self).__init__()
         self.data_manager = westpa.rc.get_data_manager() 
         self.we_h5filename = None
+        self.follow = False
         
         self._weight_dsspec = None
         self._parent_id_dsspec = None
@@ -55,19 +56,35 @@ class WESTDataReader(WESTToolComponent):
         group = parser.add_argument_group('WEST input data options')
         group.add_argument('-W', '--west-data', dest='we_h5filename', metavar='WEST_H5FILE',
                            help='''Take WEST data from WEST_H5FILE (default: read from the HDF5 file specified in west.cfg).''')
+        group.add_argument('--follow', dest='follow', action='store_true',
+                           help='''Open WEST_H5FILE as a SWMR reader, so that it may be read safely while a simulation
+                           running with the west.data.swmr option writes to it.''')
         
     def process_args(self, args):
         if args.we_h5filename:
             self.data_manager.we_h5filename = self.we_h5filename = args.we_h5filename
         else:
             self.we_h5filename = self.data_manager.we_h5filename
+        self.follow = args.follow
+        if self.follow:
+            # Applies to other files opened by analysis, e.g. through data set specifications
+            WESTPAH5File.default_follow = True
         
     def open(self, mode='r'):
-        self.data_manager.open_backing(mode)
+        if self.follow and mode == 'r':
+            self.data_manager.open_backing(mode, follow=True)
+        else:
+            self.data_manager.open_backing(mode)
         
     def close(self):
         self.data_manager.close_backing()
         
+    def refresh(self):
+        '''In follower mode, reopen the WEST HDF5 file so that newly-committed iterations are visible.
+        Returns the current iteration.'''
+        self._weight_dsspec = self._parent_id_dsspec = None
+        return self.data_manager.refresh_backing()
+        
     def __getattr__(self, key):
         return getattr(self.data_manager, key)
     
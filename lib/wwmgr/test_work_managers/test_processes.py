@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, signal
+import os, signal, tempfile, shutil
 
 from work_managers.processes import ProcessWorkManager
 from tsupport import *
@@ -86,5 +86,30 @@ class TestProcessWorkManagerAux:
             work_manager.wait_all(futures)
             results = set(future.get_result() for future in futures)
             assert results == set(str(n) for n in xrange(work_manager.n_workers)), results
-        
-        
\ No newline at end of file
+
+    @nose.tools.timed(5)
+    def test_speculative_execution(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            work_manager = ProcessWorkManager(2, speculation_factor=2)
+            work_manager.straggler_check_interval = 0.05
+            with work_manager:
+                straggler = work_manager.submit(slow_first_time, args=(os.path.join(tempdir, 'marker'),))
+                futures = work_manager.submit_many([(busy_identity, (i,), {}) for i in xrange(4)])
+                work_manager.wait_all(futures)
+                assert straggler.get_result() == 'fast'
+                assert work_manager.straggler_monitor.n_speculative_launches == 1
+                assert work_manager.straggler_monitor.n_speculative_wins == 1
+        finally:
+            shutil.rmtree(tempdir)
+
+    @nose.tools.timed(5)
+    def test_no_speculation_unless_allowed(self):
+        work_manager = ProcessWorkManager(2, speculation_factor=2)
+        work_manager.straggler_check_interval = 0.05
+        with work_manager:
+            straggler = work_manager.submit(sleep_identity, args=('slow',))
+            futures = work_manager.submit_many([(busy_identity, (i,), {}) for i in xrange(4)])
+            work_manager.wait_all(futures)
+            assert straggler.get_result() == 'slow'
+            assert work_manager.straggler_monitor.n_speculative_launches == 0
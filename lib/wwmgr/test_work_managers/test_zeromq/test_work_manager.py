@@ -8,7 +8,7 @@ from __future__ import division, print_function; __metaclass__ = type
 
 import time
 from work_managers.zeromq import ZMQWorkManager, ZMQWorker, ZMQWorkerMissing
-from work_managers.zeromq.core import Message, Task
+from work_managers.zeromq.core import Message, Task, Result, ZMQCore
 from test_work_managers.tsupport import *
 
 from contextlib import contextmanager
@@ -176,6 +176,106 @@ class TestZMQWorkManagerBasic(ZMQTestBase):
             self.test_core.send_message(s, Message.RESULT, result)
         assert future.result == r
 
+class TestZMQWorkManagerSpeculation(ZMQTestBase):
+    
+    '''Speculative re-execution of stragglers, with the test playing two remote workers.'''
+    def setUp(self):
+        super(TestZMQWorkManagerSpeculation,self).setUp()
+        
+        self.test_wm = ZMQWorkManager(n_local_workers=0, speculation_factor=2)
+        self.test_wm.validation_fail_action = 'raise'
+        self.test_wm.master_beacon_period = BEACON_PERIOD
+        self.test_wm.task_beacon_period = BEACON_PERIOD
+        self.test_wm.straggler_check_interval = 0.05
+
+        self.rr_endpoint = self.make_endpoint()
+        self.ann_endpoint = self.make_endpoint()
+        self.test_wm.downstream_rr_endpoint = self.rr_endpoint
+        self.test_wm.downstream_ann_endpoint = self.ann_endpoint
+        self.test_wm.startup()
+        
+        # Two workers, each with its own identity and request/reply connection
+        self.workers = []
+        for _i in xrange(2):
+            core = ZMQCore()
+            core.context = self.test_context
+            core.validation_fail_action = 'raise'
+            core.master_id = self.test_wm.master_id
+            socket = self.test_context.socket(zmq.REQ)
+            socket.connect(self.rr_endpoint)
+            self.workers.append((core, socket))
+            
+        self.ann_socket = self.test_context.socket(zmq.SUB)
+        self.ann_socket.setsockopt(zmq.SUBSCRIBE,'')
+        self.ann_socket.connect(self.ann_endpoint)
+        
+        self.test_core.master_id = self.test_wm.master_id
+        
+        time.sleep(SETUP_WAIT)
+
+    def tearDown(self):
+        time.sleep(TEARDOWN_WAIT)
+        
+        for (_core, socket) in self.workers:
+            socket.close(linger=1)
+        self.ann_socket.close(linger=0)
+        
+        self.test_wm.signal_shutdown()
+        self.test_wm.comm_thread.join()
+        
+        super(TestZMQWorkManagerSpeculation,self).tearDown()
+        
+    def request_task(self, worker):
+        (core, socket) = worker
+        core.send_message(socket, Message.TASK_REQUEST)
+        msg = core.recv_message(socket)
+        return msg.payload if msg.message == Message.TASK else None
+        
+    def send_result(self, worker, task_id, result):
+        (core, socket) = worker
+        core.send_message(socket, Message.RESULT, Result(task_id, result=result))
+        core.recv_ack(socket)
+        
+    def announcements(self, message):
+        return [msg for msg in self.test_core.recv_all(self.ann_socket) if msg.message == message]
+        
+    @timed(5)
+    def test_straggler_duplicated_and_loser_cancelled(self):
+        (slow_worker, fast_worker) = self.workers
+        straggler = self.test_wm.submit(slow_first_time, ('unused',))
+        futures = self.test_wm.submit_many([(identity, (i,), {}) for i in xrange(3)])
+        
+        # One worker hangs on the straggler while the other establishes a median task time
+        first_copy = self.request_task(slow_worker)
+        assert first_copy.task_id == straggler.task_id
+        for future in futures:
+            task = self.request_task(fast_worker)
+            self.send_result(fast_worker, task.task_id, task.args[0])
+        assert [future.get_result() for future in futures] == [0, 1, 2]
+        
+        # The idle worker receives a duplicate of the straggler, and finishes it first
+        second_copy = None
+        while second_copy is None:
+            time.sleep(0.05)
+            second_copy = self.request_task(fast_worker)
+        assert second_copy.task_id == straggler.task_id
+        assert self.test_wm.straggler_monitor.n_speculative_launches == 1
+        self.send_result(fast_worker, second_copy.task_id, 'fast')
+        assert straggler.result == 'fast'
+        assert self.test_wm.straggler_monitor.n_speculative_wins == 1
+        
+        # The losing copy is cancelled, and its worker is not idle until it asks for more work
+        time.sleep(0.1)
+        cancellations = self.announcements(Message.CANCEL_TASK)
+        assert [msg.payload for msg in cancellations] == [straggler.task_id]
+        assert self.test_wm.assigned_tasks[slow_worker[0].node_id].task_id == straggler.task_id
+        assert self.request_task(slow_worker) is None
+        assert slow_worker[0].node_id not in self.test_wm.assigned_tasks
+        
+        # A late result from the losing copy is discarded
+        self.send_result(slow_worker, first_copy.task_id, 'slow')
+        assert straggler.result == 'fast'
+
 class BaseInternal(ZMQTestBase,CommonWorkManagerTests):
     def setUp(self):
         super(BaseInternal,self).setUp()
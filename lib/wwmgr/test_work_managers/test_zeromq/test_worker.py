@@ -1,6 +1,6 @@
 from __future__ import division, print_function; __metaclass__ = type
 
-import time
+import time, uuid
 from work_managers.zeromq import ZMQWorker
 from work_managers.zeromq.core import Message, Task, Result, TIMEOUT_MASTER_BEACON
 from test_work_managers.tsupport import *
@@ -112,6 +112,34 @@ class TestZMQWorkerBasic(ZMQTestBase):
         rsl = self.roundtrip_task(task)
         assert isinstance(rsl.exception, ExceptionForTest)
         
+    def test_worker_cancels_task(self):
+        task = Task(sleep_identity, ('slow',), {'delay': 60})
+        self.send_task(task)
+        time.sleep(0.1)
+        executor_pid = self.test_worker.executor_process.pid
+        self.test_core.send_message(self.ann_socket, Message.CANCEL_TASK, payload=task.task_id)
+        
+        # the worker restarts its executor and asks for more work
+        msg = self.test_core.recv_message(self.rr_socket)
+        assert msg.message == Message.TASK_REQUEST
+        assert self.test_worker.executor_process.pid != executor_pid
+        
+        r = random_int()
+        self.test_core.send_message(self.rr_socket, Message.TASK, payload=Task(identity, (r,), {}))
+        rsl = self.recv_result()
+        assert rsl.result == r
+        
+    def test_worker_ignores_cancel_of_other_task(self):
+        task = Task(sleep_identity, ('slow',), {'delay': 0.5})
+        self.send_task(task)
+        time.sleep(0.1)
+        executor_pid = self.test_worker.executor_process.pid
+        self.test_core.send_message(self.ann_socket, Message.CANCEL_TASK, payload=uuid.uuid4())
+        rsl = self.recv_result()
+        assert rsl.task_id == task.task_id
+        assert rsl.result == 'slow'
+        assert self.test_worker.executor_process.pid == executor_pid
+        
     def test_hung_worker_interruptible(self):
         task = Task(will_busyhang, (), {})
         self.send_task(task)
@@ -16,6 +16,7 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 from nose.tools import raises, nottest, timed
+from work_managers import allow_speculation
 
 class ExceptionForTest(Exception):
     pass
@@ -68,6 +69,21 @@ def random_int(seed=None):
     
     return random.randint(0,sys.maxint)
 
+@allow_speculation
+def slow_first_time(marker):
+    '''Hang the first time this is called with a given marker filename; return immediately thereafter.'''
+    import os, time
+    if not os.path.exists(marker):
+        open(marker, 'wb').close()
+        time.sleep(60)
+        return 'slow'
+    return 'fast'
+
+def sleep_identity(x, delay=1.0):
+    import time
+    time.sleep(delay)
+    return x
+
 def get_process_index():
     import os, time
     time.sleep(1) # this ensures that each task gets its own worker
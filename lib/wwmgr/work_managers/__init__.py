@@ -25,7 +25,7 @@ futures implementation).
 import logging
 log = logging.getLogger(__name__)
 
-from core import WorkManager, WMFuture, FutureWatcher
+from core import WorkManager, WMFuture, FutureWatcher, StragglerMonitor, allow_speculation, speculation_allowed
 
 
 # Import core work managers, which should run most everywhere that
@@ -21,7 +21,7 @@
 
 __metaclass__ = type
 import logging
-import uuid, threading, signal
+import uuid, threading, signal, time
 from itertools import islice
 from contextlib import contextmanager
 log = logging.getLogger(__name__)
@@ -31,6 +31,9 @@ class WorkManager:
     ``submit()`` function and a ``n_workers`` attribute (which may be a property),
     though most will also override ``startup()`` and ``shutdown()``.'''
     
+    # A StragglerMonitor, for work managers which support speculative re-execution of slow tasks
+    straggler_monitor = None
+    
     @classmethod
     def from_environ(cls, wmenv=None):
         raise NotImplementedError
@@ -81,6 +84,13 @@ class WorkManager:
     def run(self):
         '''Run the worker loop (in clients only).'''
         pass
+    
+    def reset_task_statistics(self):
+        '''Discard the task run times used to identify stragglers for speculative re-execution
+        (e.g. at the start of a new batch of tasks whose run times are expected to differ from those
+        of the last). Work managers which do not support speculative execution ignore this.'''
+        if self.straggler_monitor is not None:
+            self.straggler_monitor.reset()
         
     def submit(self, fn, args=None, kwargs=None):
         '''Submit a task to the work manager, returning a `WMFuture` object representing the pending
@@ -202,6 +212,113 @@ class WorkManager:
         return True
             
 
+def allow_speculation(fn):
+    '''Mark ``fn`` as safe to run more than once at the same time, so that work managers may
+    speculatively re-execute tasks calling it when they straggle. Tasks calling unmarked functions
+    are never speculated. Returns ``fn``, so that this may be used as a decorator.'''
+    fn.allow_speculation = True
+    return fn
+
+def speculation_allowed(fn):
+    '''Return True if ``fn`` has been marked with ``allow_speculation()``.'''
+    return bool(getattr(fn, 'allow_speculation', False))
+
+class StragglerMonitor:
+    '''Tracks the run times of tasks, in order to identify stragglers -- tasks which have been running
+    for more than ``factor`` times the median run time of tasks completed since the last call to
+    ``reset()`` -- for speculative re-execution. Speculative launches and the number of times a
+    speculative copy finished first are counted in ``n_speculative_launches`` and
+    ``n_speculative_wins``. This object is not thread-safe; callers must serialize access to it.'''
+    
+    def __init__(self, factor, min_completed=3):
+        if factor <= 1:
+            raise ValueError('speculation factor must be greater than 1')
+        self.factor = factor
+        
+        # Number of tasks which must complete before any task is considered a straggler
+        self.min_completed = min_completed
+        
+        # Run times of completed tasks
+        self.run_times = []
+        
+        # Start time of the first copy of each running task, indexed by task ID
+        self.start_times = {}
+        
+        # IDs of running tasks for which a speculative copy has been launched
+        self.speculated = set()
+        
+        # IDs of running tasks which must not be speculatively re-executed
+        self.unspeculable = set()
+        
+        self.n_speculative_launches = 0
+        self.n_speculative_wins = 0
+        
+    def reset(self):
+        '''Discard accumulated run times.'''
+        self.run_times = []
+        
+    @property
+    def median_run_time(self):
+        '''The median run time of completed tasks, or None if too few tasks have completed.'''
+        run_times = sorted(self.run_times)
+        n = len(run_times)
+        if n < max(self.min_completed,1):
+            return None
+        elif n % 2:
+            return run_times[n//2]
+        else:
+            return (run_times[n//2-1] + run_times[n//2]) / 2.0
+        
+    def task_started(self, task_id, at=None, speculable=True):
+        '''Record that a copy of the given task has started. Only the start of the first copy
+        is recorded. Tasks which are not ``speculable`` contribute to the median run time but
+        are never reported as stragglers.'''
+        self.start_times.setdefault(task_id, at or time.time())
+        if not speculable:
+            self.unspeculable.add(task_id)
+        
+    def task_finished(self, task_id, speculative=False, at=None):
+        '''Record that the given task has finished; ``speculative`` is true if the copy which finished
+        first was a speculative copy.'''
+        started = self.start_times.pop(task_id, None)
+        self.speculated.discard(task_id)
+        self.unspeculable.discard(task_id)
+        if started is not None:
+            self.run_times.append((at or time.time()) - started)
+        if speculative:
+            self.n_speculative_wins += 1
+            
+    def task_abandoned(self, task_id):
+        '''Stop tracking the given task without recording its run time (e.g. because it failed
+        or its worker disappeared).'''
+        self.start_times.pop(task_id, None)
+        self.speculated.discard(task_id)
+        self.unspeculable.discard(task_id)
+        
+    def stragglers(self, at=None):
+        '''Return the IDs of running tasks which are stragglers and have not already been speculatively
+        re-executed, longest-running first.'''
+        median = self.median_run_time
+        if median is None:
+            return []
+        
+        at = at or time.time()
+        threshold = self.factor * median
+        late = [(at - started, task_id) for (task_id, started) in self.start_times.iteritems()
+                if task_id not in self.speculated and task_id not in self.unspeculable
+                and at - started > threshold]
+        late.sort(reverse=True)
+        return [task_id for (_elapsed, task_id) in late]
+    
+    def speculate(self, task_id, at=None):
+        '''Record (and log) the launch of a speculative copy of the given task.'''
+        self.speculated.add(task_id)
+        self.n_speculative_launches += 1
+        elapsed = (at or time.time()) - self.start_times[task_id]
+        log.info('speculatively re-executing task {!s} after {:.1f} s (median task time {:.1f} s); '
+                 '{:d} speculative launches so far'
+                 .format(task_id, elapsed, self.median_run_time, self.n_speculative_launches))
+
 class FutureWatcher:
     '''A device to wait on multiple results and/or exceptions with only one lock.'''
     
@@ -108,6 +108,11 @@ class WMEnvironment:
                               help='''Use up to N_WORKERS on this host, for work managers which support this option.
                                       Use 0 for a dedicated server. (Ignored by work managers which do not support
                                       this option.)''')
+        wm_group.add_argument(self.arg_flag('speculation_factor'), metavar='FACTOR', type=float,
+                              help='''Speculatively re-execute tasks which have been running for more than FACTOR
+                                      times the median task run time on an idle worker, keeping the result
+                                      of whichever copy finishes first, for work managers which support this
+                                      option. (Default: no speculative re-execution.)''')
         
         for wm in self.valid_work_managers:
             _available_work_managers[wm].add_wm_args(parser,self)
@@ -17,19 +17,45 @@
 
 from __future__ import division, print_function; __metaclass__ = type
 
-import sys, logging, multiprocessing, threading, traceback, signal, os, random
+import sys, logging, multiprocessing, threading, traceback, signal, os, random, time
 import work_managers
-from . import WorkManager, WMFuture
+from . import WorkManager, WMFuture, StragglerMonitor, speculation_allowed
 
 log = logging.getLogger(__name__)
 
 # Tasks are tuples ('task', task_id, fn, args, kwargs).
-# Results are tuples (rtype, task_id, payload) where rtype is 'result' or 'exception' and payload is the return value
-# or exception, respectively.
+# Results are tuples (rtype, task_id, payload, worker_index) where rtype is 'result' or 'exception' and payload is
+# the return value or exception, respectively. When speculative re-execution is enabled, workers also send
+# ('started', task_id, pgid, worker_index) when they begin a task, where pgid is the process group in which
+# the task is running (and which the master kills to cancel the task).
 
 task_shutdown_sentinel   = ('shutdown', None, None, (), {})
 result_shutdown_sentinel = ('shutdown', None, None)
 
+def execute_task(task_id, fn, args, kwargs):
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        return ('exception', task_id, (e, traceback.format_exc()))
+    else:
+        return ('result', task_id, result)
+    
+def isolated_task_main(conn, task_id, fn, args, kwargs):
+    '''Run a task in its own process group, sending the result tuple over ``conn``.'''
+    try:
+        os.setpgid(0,0)
+    except OSError:
+        pass
+    random.seed()
+    
+    result_tuple = execute_task(task_id, fn, args, kwargs)
+    try:
+        conn.send(result_tuple)
+    except Exception as e:
+        # most likely, the result is not picklable
+        conn.send(('exception', task_id, (e, traceback.format_exc())))
+    conn.close()
+
 class ProcessWorkManager(WorkManager):
     '''A work manager using the ``multiprocessing`` module.'''
     
@@ -37,9 +63,10 @@ class ProcessWorkManager(WorkManager):
     def from_environ(cls, wmenv=None): 
         if wmenv is None:
             wmenv = work_managers.environment.default_env 
-        return cls(wmenv.get_val('n_workers', multiprocessing.cpu_count(), int))
+        return cls(wmenv.get_val('n_workers', multiprocessing.cpu_count(), int),
+                   speculation_factor=wmenv.get_val('speculation_factor', 0, float) or None)
     
-    def __init__(self, n_workers = None, shutdown_timeout = 1):
+    def __init__(self, n_workers = None, shutdown_timeout = 1, speculation_factor = None):
         super(ProcessWorkManager,self).__init__()
         self.n_workers = n_workers or multiprocessing.cpu_count()
         self.workers = None
@@ -51,7 +78,19 @@ class ProcessWorkManager(WorkManager):
         self.shutdown_received = False
         self.shutdown_timeout = shutdown_timeout or 1
         
-    def task_loop(self):
+        # Speculative re-execution of stragglers; when enabled, each task runs in a child process of its
+        # worker, in its own process group, so that the losing copy of a duplicated task can be killed
+        # without disturbing the worker or the queues it shares with the master.
+        if speculation_factor:
+            self.straggler_monitor = StragglerMonitor(speculation_factor)
+        self.straggler_check_interval = 1.0
+        self.lock = threading.Lock()
+        self.tasks = None           # task tuples, indexed by task ID, for re-dispatch
+        self.running_copies = None  # [(worker_index, pgid), ...] in order of start, indexed by task ID
+        self.busy_workers = None    # indices of workers executing a task
+        self.n_queued = 0           # copies of tasks in the task queue
+        
+    def task_loop(self, worker_index=None):
         # Close standard input, so we don't get SIGINT from ^C
         try:
             sys.stdin.close()
@@ -67,39 +106,138 @@ class ProcessWorkManager(WorkManager):
             if message == 'shutdown':
                 break
             
-            try:
-                result = fn(*args, **kwargs)
-            except BaseException as e:
-                result_tuple = ('exception', task_id, (e, traceback.format_exc()))
+            if self.straggler_monitor is None:
+                result_tuple = execute_task(task_id, fn, args, kwargs)
             else:
-                result_tuple = ('result', task_id, result)
-            self.result_queue.put(result_tuple)
+                result_tuple = self.execute_isolated(task_id, fn, args, kwargs, worker_index)
+            self.result_queue.put(result_tuple + (worker_index,))
 
         log.debug('exiting task_loop')
         return
+    
+    def execute_isolated(self, task_id, fn, args, kwargs, worker_index):
+        '''Execute a task in a child process leading its own process group, announcing the process
+        group to the master so that it may cancel the task by killing the group.'''
+        recv_conn, send_conn = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target=isolated_task_main, args=(send_conn, task_id, fn, args, kwargs))
+        process.start()
+        send_conn.close()
+        try:
+            os.setpgid(process.pid, process.pid)
+        except OSError:
+            pass
+        self.result_queue.put(('started', task_id, process.pid, worker_index))
+        
+        try:
+            result_tuple = recv_conn.recv()
+        except EOFError:
+            process.join()
+            error = RuntimeError('task process exited with code {!r}'.format(process.exitcode))
+            result_tuple = ('exception', task_id, (error, ''))
+        else:
+            process.join()
+        recv_conn.close()
+        return result_tuple
         
     def results_loop(self):
+        timeout = self.straggler_check_interval if self.straggler_monitor is not None else None
+        last_check = time.time()
         while not self.shutdown_received:
-            message, task_id, payload = self.result_queue.get()[:3]
-            
-            if message == 'shutdown':
-                break
-            elif message == 'exception':
-                future = self.pending.pop(task_id)
-                future._set_exception(*payload)
-            elif message == 'result':
-                future = self.pending.pop(task_id)
-                future._set_result(payload)
+            try:
+                item = self.result_queue.get(timeout=timeout)
+            except multiprocessing.queues.Empty:
+                item = None
             else:
-                raise AssertionError('unknown message {!r}'.format((message, task_id, payload)))
+                message, task_id, payload = item[:3]
+                worker_index = item[3] if len(item) > 3 else None
+            
+                if message == 'shutdown':
+                    break
+                elif message == 'started':
+                    self.task_started(task_id, worker_index, payload)
+                elif message == 'exception':
+                    future = self.task_finished(task_id, worker_index)
+                    if future is not None:
+                        future._set_exception(*payload)
+                elif message == 'result':
+                    future = self.task_finished(task_id, worker_index)
+                    if future is not None:
+                        future._set_result(payload)
+                else:
+                    raise AssertionError('unknown message {!r}'.format(item))
+            
+            if timeout is not None and (item is None or time.time() - last_check >= timeout):
+                self.speculate_stragglers()
+                last_check = time.time()
 
         log.debug('exiting results_loop')
+        
+    def task_started(self, task_id, worker_index, pgid):
+        with self.lock:
+            self.n_queued -= 1
+            self.busy_workers.add(worker_index)
+            if task_id in self.pending:
+                self.running_copies.setdefault(task_id, []).append((worker_index, pgid))
+                self.straggler_monitor.task_started(task_id,
+                                                    speculable=speculation_allowed(self.tasks[task_id][2]))
+                return
+        # A duplicate copy of a task which has already finished
+        self.cancel_copy(task_id, worker_index, pgid)
+        
+    def task_finished(self, task_id, worker_index):
+        '''Record that a copy of the given task has finished, returning its future, or None if
+        another copy of the task finished first.'''
+        if self.straggler_monitor is None:
+            return self.pending.pop(task_id)
+        
+        with self.lock:
+            self.busy_workers.discard(worker_index)
+            future = self.pending.pop(task_id, None)
+            if future is None:
+                log.debug('discarding result of duplicate copy of task {!s}'.format(task_id))
+                return None
+            
+            del self.tasks[task_id]
+            copies = self.running_copies.pop(task_id, [])
+            workers = [index for (index, _pgid) in copies]
+            speculative = worker_index in workers and workers.index(worker_index) > 0
+            self.straggler_monitor.task_finished(task_id, speculative)
+            losers = [(index, pgid) for (index, pgid) in copies if index != worker_index]
+            
+        for (index, pgid) in losers:
+            self.cancel_copy(task_id, index, pgid)
+        return future
+            
+    def cancel_copy(self, task_id, worker_index, pgid, sig=signal.SIGKILL):
+        log.info('cancelling duplicate copy of task {!s} on worker {!r}'.format(task_id, worker_index))
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            # already finished
+            pass
+        
+    def speculate_stragglers(self):
+        '''Launch a duplicate copy of each straggling task (longest-running first) for which there is
+        an idle worker and no other work queued.'''
+        with self.lock:
+            n_idle = self.n_workers - len(self.busy_workers) - self.n_queued
+            if n_idle <= 0:
+                return
+            for task_id in self.straggler_monitor.stragglers()[:n_idle]:
+                self.straggler_monitor.speculate(task_id)
+                self.n_queued += 1
+                self.task_queue.put(self.tasks[task_id])
 
     def submit(self, fn, args=None, kwargs=None):
         ft = WMFuture()
         log.debug('dispatching {!r}'.format(fn))
-        self.pending[ft.task_id] = ft
-        self.task_queue.put(('task', ft.task_id, fn, args or (), kwargs or {}))        
+        task = ('task', ft.task_id, fn, args or (), kwargs or {})
+        with self.lock:
+            self.pending[ft.task_id] = ft
+            if self.straggler_monitor is not None:
+                self.tasks[ft.task_id] = task
+                self.n_queued += 1
+        self.task_queue.put(task)
         return ft
                 
     def startup(self):
@@ -107,7 +245,7 @@ class ProcessWorkManager(WorkManager):
         if not self.running:
             log.debug('starting up work manager {!r}'.format(self))
             self.running = True
-            self.workers = [multiprocessing.Process(target=self.task_loop, 
+            self.workers = [multiprocessing.Process(target=self.task_loop, args=(i,),
                                                     name='worker-{:d}-{:x}'.format(i,id(self))) for i in xrange(self.n_workers)]
             
             pi_name = '{}_PROCESS_INDEX'.format(environment.WMEnvironment.env_prefix)
@@ -120,6 +258,10 @@ class ProcessWorkManager(WorkManager):
                 pass
                 
             self.pending = dict()
+            self.tasks = dict()
+            self.running_copies = dict()
+            self.busy_workers = set()
+            self.n_queued = 0
     
             self.receive_thread = threading.Thread(target=self.results_loop, name='receiver')
             self.receive_thread.daemon = True
@@ -142,6 +284,7 @@ class ProcessWorkManager(WorkManager):
         if self.running:
             log.debug('shutting down {!r}'.format(self))
             self._empty_queues()
+            self._signal_running_copies(signal.SIGINT)
     
             # Send shutdown signal
             for _i in xrange(self.n_workers):
@@ -162,9 +305,19 @@ class ProcessWorkManager(WorkManager):
                 else:
                     log.debug('worker process {:d} terminated gracefully with code {:d}'.format(worker.pid, worker.exitcode))
             
+            self._signal_running_copies(signal.SIGKILL)
             self._empty_queues()
             self.result_queue.put(result_shutdown_sentinel)
             self.running = False
-        
-    
-    
\ No newline at end of file
+
+    def _signal_running_copies(self, sig):
+        '''Send the given signal to all tasks running in isolated process groups.'''
+        if self.straggler_monitor is None:
+            return
+        with self.lock:
+            running = [pgid for copies in self.running_copies.itervalues() for (_index, pgid) in copies]
+        for pgid in running:
+            try:
+                os.killpg(pgid, sig)
+            except OSError:
+                pass
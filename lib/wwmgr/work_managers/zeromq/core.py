@@ -77,6 +77,8 @@ class Message:
     TASK = 'task'
     RESULT = 'result'
     
+    CANCEL_TASK = 'cancel_task'    # Announcement; payload is the ID of the task to cancel
+    
     idempotent_announcement_messages = {SHUTDOWN, TASKS_AVAILABLE, MASTER_BEACON}
 
     
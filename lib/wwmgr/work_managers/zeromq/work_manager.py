@@ -12,7 +12,7 @@ from core import randport
 from worker import ZMQWorker
 from node import ZMQNode
 import work_managers
-from work_managers import WorkManager, WMFuture
+from work_managers import WorkManager, WMFuture, StragglerMonitor, speculation_allowed
 import multiprocessing
 
 from core import PassiveMultiTimer
@@ -126,10 +126,11 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         worker_heartbeat = wmenv.get_val('zmq_worker_heartbeat', cls.default_worker_heartbeat, float)
         timeout_factor = wmenv.get_val('zmq_timeout_factor', cls.default_timeout_factor, float)
         startup_timeout = wmenv.get_val('zmq_startup_timeout', cls.default_startup_timeout, float)
+        speculation_factor = wmenv.get_val('speculation_factor', 0, float) or None
         
         
         if mode == 'master':
-            instance = ZMQWorkManager(n_workers)
+            instance = ZMQWorkManager(n_workers, speculation_factor=speculation_factor)
         else: # mode =='node'
             
             upstream_info = {}
@@ -228,7 +229,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         else:
             raise ValueError('unrecognized/unsupported endpoint: {!r}'.format(endpoint))        
     
-    def __init__(self, n_local_workers=1):
+    def __init__(self, n_local_workers=1, speculation_factor=None):
         ZMQCore.__init__(self)
         WorkManager.__init__(self)
         IsNode.__init__(self, n_local_workers)
@@ -253,6 +254,19 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         self.shutdown_timeout = 0.5
         
         self.master_id = self.node_id
+        
+        # Speculative re-execution of stragglers
+        if speculation_factor:
+            self.straggler_monitor = StragglerMonitor(speculation_factor)
+        
+        # Number of seconds between checks for straggling tasks
+        self.straggler_check_interval = 1.0
+        
+        # IDs of workers running a copy of each task, in order of assignment (indexed by task_id)
+        self.task_copies = dict()
+        
+        # IDs of tasks whose duplicate copies are to be cancelled
+        self.tasks_to_cancel = []
             
     @property
     def n_workers(self):
@@ -295,19 +309,38 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         with self.message_validation(msg):
             assert msg.message == Message.RESULT
             assert isinstance(msg.payload, Result)
-            assert msg.payload.task_id in self.futures
-            assert self.assigned_tasks[msg.src_id].task_id == msg.payload.task_id
+            if self.straggler_monitor is None:
+                assert msg.payload.task_id in self.futures
+                assert self.assigned_tasks[msg.src_id].task_id == msg.payload.task_id
                         
         result = msg.payload
         
-        future = self.futures.pop(result.task_id)
-        del self.assigned_tasks[msg.src_id]
+        assigned_task = self.assigned_tasks.get(msg.src_id)
+        if assigned_task is not None and assigned_task.task_id == result.task_id:
+            del self.assigned_tasks[msg.src_id]
+        
+        future = self.futures.pop(result.task_id, None)
+        if future is None:
+            # A duplicate copy of a task which has already finished
+            self.log.debug('discarding result of duplicate copy of task {!s}'.format(result.task_id))
+            return
+        
+        if self.straggler_monitor is not None:
+            self.speculative_task_finished(result.task_id, msg.src_id)
+            
         if result.exception is not None:
             future._set_exception(result.exception, result.traceback)
         else:
             future._set_result(result.result)
             
     def handle_task_request(self, socket, msg):
+        # A worker only asks for a task once it has none (e.g. after its copy of a task was cancelled)
+        self.assigned_tasks.pop(msg.src_id, None)
+        
+        # Skip duplicate copies of tasks which have already finished
+        while self.outgoing_tasks and self.outgoing_tasks[0].task_id not in self.futures:
+            self.outgoing_tasks.popleft()
+            
         if not self.outgoing_tasks:
             # No tasks available
             self.send_nak(socket,msg)
@@ -316,9 +349,45 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             
             worker_id = msg.src_id
             self.assigned_tasks[worker_id] = task
+            if self.straggler_monitor is not None:
+                self.task_copies.setdefault(task.task_id, []).append(worker_id)
+                self.straggler_monitor.task_started(task.task_id, speculable=speculation_allowed(task.fn))
             
             self.send_message(socket, Message.TASK, task)
             
+    def speculative_task_finished(self, task_id, worker_id):
+        '''Record that the copy of the given task on the given worker finished first, and arrange 
+        for any other copies to be cancelled.'''
+        copies = self.task_copies.pop(task_id, [])
+        speculative = worker_id in copies and copies.index(worker_id) > 0
+        self.straggler_monitor.task_finished(task_id, speculative)
+        
+        # Losing workers remain assigned (and so are not counted as idle) until they have restarted
+        # their executors and ask for another task
+        losers = [loser_id for loser_id in copies if loser_id != worker_id]
+        for loser_id in losers:
+            self.log.info('cancelling duplicate copy of task {!s} on worker {!s}'.format(task_id, loser_id))
+        if losers:
+            self.tasks_to_cancel.append(task_id)
+                
+    def speculate_stragglers(self):
+        '''Queue a duplicate copy of each straggling task (longest-running first) for which there is
+        an idle worker and no other work queued. Returns True if any tasks were queued.'''
+        if self.outgoing_tasks:
+            return False
+        
+        n_idle = self.n_workers - len(self.assigned_tasks)
+        if n_idle <= 0:
+            return False
+        
+        stragglers = self.straggler_monitor.stragglers()[:n_idle]
+        for task_id in stragglers:
+            # any worker running a copy will do to find the task itself
+            task = self.assigned_tasks[self.task_copies[task_id][0]]
+            self.straggler_monitor.speculate(task_id)
+            self.outgoing_tasks.append(task)
+        return bool(stragglers)
+            
     def update_worker_information(self, msg):
         if msg.message == Message.IDENTIFY:
             with self.message_validation(msg):
@@ -351,10 +420,25 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         except KeyError:
             pass
         else:
-            self.log.error('aborting task {!r} running on expired worker {!s}'
-                           .format(expired_task, worker_id))
-            future = self.futures.pop(expired_task.task_id)
-            future._set_exception(ZMQWorkerMissing('worker running this task disappeared'))
+            copies = self.task_copies.get(expired_task.task_id, [])
+            if worker_id in copies:
+                copies.remove(worker_id)
+            
+            if expired_task.task_id not in self.futures:
+                # A cancelled duplicate copy of a task which has already finished
+                pass
+            elif copies:
+                # Another (speculative) copy of this task is still running
+                self.log.error('abandoning copy of task {!r} running on expired worker {!s}'
+                               .format(expired_task, worker_id))
+            else:
+                self.log.error('aborting task {!r} running on expired worker {!s}'
+                               .format(expired_task, worker_id))
+                self.task_copies.pop(expired_task.task_id, None)
+                if self.straggler_monitor is not None:
+                    self.straggler_monitor.task_abandoned(expired_task.task_id)
+                future = self.futures.pop(expired_task.task_id)
+                future._set_exception(ZMQWorkerMissing('worker running this task disappeared'))
         del self.worker_information[worker_id]
         
     def shutdown_clear_tasks(self):
@@ -390,6 +474,8 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         timers.add_timer('master_beacon', self.master_beacon_period)
         timers.add_timer('worker_timeout_check', self.worker_beacon_period*self.timeout_factor)
         timers.add_timer('startup_timeout', self.startup_timeout)
+        if self.straggler_monitor is not None:
+            timers.add_timer('straggler_check', self.straggler_check_interval)
         timers.reset()
         
         self.log.debug('master beacon period: {!r}'.format(self.master_beacon_period))
@@ -434,6 +520,14 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
                         
                     if self.worker_information:
                         peer_found = True
+                        
+                while self.tasks_to_cancel:
+                    self.send_message(ann_socket, Message.CANCEL_TASK, self.tasks_to_cancel.pop(0))
+                    
+                if self.straggler_monitor is not None and timers.expired('straggler_check'):
+                    if self.speculate_stragglers():
+                        self.send_message(ann_socket, Message.TASKS_AVAILABLE)
+                    timers.reset('straggler_check')
                 
                 if timers.expired('tasks_avail'):
                     if self.outgoing_tasks:
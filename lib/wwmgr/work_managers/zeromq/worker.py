@@ -44,6 +44,7 @@ class ZMQWorker(ZMQCore):
         
         self.shutdown_timeout = 5.0 # Five second wait between shutdown message and SIGINT and SIGINT and SIGKILL
         self.executor_process = None
+        self.process_index = None
 
     @property
     def is_master(self):
@@ -86,12 +87,32 @@ class ZMQWorker(ZMQCore):
         timers.change_duration(timer, new_period)
         timers.reset(timer)
         
+    def handle_cancel_task(self, msg):
+        '''Cancel the pending task if it is the one named in ``msg``, by restarting the executor.
+        Returns True if the executor was restarted.'''
+        with self.message_validation(msg):
+            assert msg.payload is not None
+        
+        if self.pending_task is None or self.pending_task.task_id != msg.payload:
+            # Not ours
+            return False
+        
+        self.log.info('cancelling task {!r}'.format(self.pending_task))
+        self.kill_executor()
+        self.pending_task = None
+        self.start_executor()
+        return True
+        
     def handle_result(self, result_socket, rr_socket):
         msg = self.recv_message(result_socket)
         with self.message_validation(msg):
             assert msg.message == Message.RESULT
             assert isinstance(msg.payload, Result)
-            assert msg.payload.task_id == self.pending_task.task_id
+            
+        if self.pending_task is None or msg.payload.task_id != self.pending_task.task_id:
+            # Result of a task cancelled after it completed
+            self.log.debug('discarding result of cancelled task {!s}'.format(msg.payload.task_id))
+            return
         
         msg.src_id = self.node_id
         self.pending_task = None
@@ -190,6 +211,15 @@ class ZMQWorker(ZMQCore):
                     elif tag == Message.RECONFIGURE_TIMEOUT:
                         for msg in msgs:
                             self.handle_reconfigure_timeout(msg, timers)
+                    elif tag == Message.CANCEL_TASK:
+                        for msg in msgs:
+                            if self.handle_cancel_task(msg):
+                                # The old connection may still route to the killed executor,
+                                # losing the next task sent, so connect afresh
+                                task_socket.close(linger=0)
+                                task_socket = self.context.socket(zmq.PUSH)
+                                task_socket.connect(self.task_endpoint)
+                        self.request_task(rr_socket,task_socket)
                     elif tag == Message.TASKS_AVAILABLE:
                         self.request_task(rr_socket,task_socket)      
                         
@@ -229,11 +259,11 @@ class ZMQWorker(ZMQCore):
         self.executor_process.join(self.shutdown_timeout)
         if self.executor_process.is_alive():            
             self.log.debug('sending SIGINT to worker process {:d}'.format(self.executor_process.pid))
-            os.kill(self.executor_process.pid, signal.SIGINT)
+            self.signal_executor(signal.SIGINT)
             self.executor_process.join(self.shutdown_timeout)
             if self.executor_process.is_alive():
                 self.log.warning('sending SIGKILL to worker process {:d}'.format(self.executor_process.pid))
-                os.kill(self.executor_process.pid, signal.SIGKILL)
+                self.signal_executor(signal.SIGKILL)
                 self.executor_process.join()
                 
             self.log.debug('worker process {:d} terminated with code {:d}'.format(self.executor_process.pid, self.executor_process.exitcode))
@@ -241,6 +271,28 @@ class ZMQWorker(ZMQCore):
             self.log.debug('worker process {:d} terminated gracefully with code {:d}'.format(self.executor_process.pid, self.executor_process.exitcode))        
         assert not self.executor_process.is_alive()
         
+    def signal_executor(self, sig):
+        '''Send the given signal to the executor and any processes it has started (the executor
+        leads its own process group).'''
+        try:
+            os.killpg(self.executor_process.pid, sig)
+        except OSError:
+            os.kill(self.executor_process.pid, sig)
+            
+    def kill_executor(self):
+        self.log.debug('killing executor process {:d}'.format(self.executor_process.pid))
+        self.signal_executor(signal.SIGKILL)
+        self.executor_process.join()
+        
+    def start_executor(self):
+        executor = ZMQExecutor(self.task_endpoint, self.result_endpoint)
+        self.executor_process = multiprocessing.Process(target = executor.startup, args=(self.process_index,))
+        self.executor_process.start()
+        try:
+            os.setpgid(self.executor_process.pid, self.executor_process.pid)
+        except OSError:
+            pass
+        
     def install_signal_handlers(self, signals = None):
         if not signals:
             signals = {signal.SIGINT, signal.SIGQUIT, signal.SIGTERM}
@@ -250,9 +302,8 @@ class ZMQWorker(ZMQCore):
 
     def startup(self, process_index=None):
         self.install_signal_handlers()
-        executor = ZMQExecutor(self.task_endpoint, self.result_endpoint)
-        self.executor_process = multiprocessing.Process(target = executor.startup, args=(process_index,))
-        self.executor_process.start()
+        self.process_index = process_index
+        self.start_executor()
         self.context = zmq.Context()
         self.comm_thread = threading.Thread(target=self.comm_loop)
         self.comm_thread.start()
@@ -302,6 +353,13 @@ class ZMQExecutor(ZMQCore):
             
             
     def startup(self, process_index=None):
+        # Lead a process group, so that the worker can cancel a task by killing this process and
+        # everything the task has started
+        try:
+            os.setpgid(0,0)
+        except OSError:
+            pass
+        
         if process_index is not None:
             from work_managers import environment
             pi_name = '{}_PROCESS_INDEX'.format(environment.WMEnvironment.env_prefix)
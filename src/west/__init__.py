@@ -3,7 +3,7 @@ logging.getLogger('')
 log = logging.getLogger('west')
 
 import segment 
-from segment import Segment
+from segment import Segment, SegmentTable
 import propagators, work_managers, data_manager, sim_manager, we_driver, states, systems
 from systems import WESTSystem
 from states import BasisState, TargetState
@@ -44,6 +44,9 @@ Version history:
     Version 8
         - Added in support for 'restart' and 'trajectory' information.
         - restart information should be passed as references, not actual data.
+        - restart data is stored as raw (optionally compressed) tar archives in variable-length
+          uint8 fields; restart data stored as base64-encoded pickles in variable-length strings,
+          as written by earlier revisions of this version, remains readable.
     Version 7
         - Removed bin_assignments, bin_populations, and bin_rates from iteration group.
         - Added new_segments subgroup to iteration group
@@ -58,21 +61,23 @@ import sys, time
 import posixpath
 from operator import attrgetter
 from itertools import imap, izip
+from collections import OrderedDict
 import cPickle as pickle
 import numpy
 import h5py
 from westpa import h5io
 from h5py import h5s
 import threading
+import Queue
 import os
 
 import logging
 log = logging.getLogger(__name__)
 
 import westpa
-from west.segment import Segment
+from west.segment import Segment, SegmentTable
 from west.states import BasisState, TargetState, InitialState
-from west.we_driver import NewWeightEntry
+from west.we_driver import NewWeightEntry, NewWeightTable
 
 file_format_version = 8
 
@@ -102,6 +107,62 @@ class expiring_flushing_lock:
             self.flush_method()
         self.lock.release()
 
+class IterationCache:
+    '''A bounded, least-recently-used cache of per-iteration objects (iteration group handles and
+    small arrays derived from the segment index), keyed by iteration number. Entries for an
+    iteration are discarded with ``invalidate(n_iter)`` whenever that iteration is written to, and
+    all entries with ``clear()`` whenever the backing file is (re)opened or closed. Cache
+    effectiveness may be checked through the ``hits`` and ``misses`` counters.'''
+
+    def __init__(self, max_iters=32):
+        self.max_iters = max_iters
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, n_iter, key, loader):
+        '''Return the object stored under ``key`` for iteration ``n_iter``, calling ``loader()`` to
+        obtain (and cache) it if it is not present.'''
+        n_iter = long(n_iter)
+        iter_entries = self._entries.get(n_iter, {})
+
+        try:
+            value = iter_entries[key]
+        except KeyError:
+            self.misses += 1
+            # Only (re-)insert the entry once the loader has succeeded, so that a failed load
+            # leaves no empty entry behind
+            value = loader()
+            iter_entries[key] = value
+        else:
+            self.hits += 1
+
+        # Re-insert to mark as most recently used
+        self._entries.pop(n_iter, None)
+        self._entries[n_iter] = iter_entries
+        while len(self._entries) > self.max_iters:
+            self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, n_iter):
+        '''Discard all cached objects for iteration ``n_iter``.'''
+        self._entries.pop(long(n_iter), None)
+
+    def clear(self):
+        '''Discard all cached objects.'''
+        self._entries.clear()
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    def stats(self):
+        '''Return a dictionary of cache statistics.'''
+        n_lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'n_iters': len(self._entries),
+                'hit_rate': (self.hits / n_lookups if n_lookups else 0.0)}
 
 # Data types for use in the HDF5 file
 seg_id_dtype = numpy.int64  # Up to 9 quintillion segments per iteration; signed so that initial states can be stored negative
@@ -114,6 +175,7 @@ vstr_dtype = h5py.new_vlen(str)
 #vvoid_dtype = h5py.special_dtype(vlen=numpy.dtype('V')) # Trying to store arbitrary data.  Not working so well...
 vvoid_dtype = h5py.special_dtype(vlen=str) # Trying to store arbitrary data.  Not working so well...
 #vvoid_dtype = h5py.new_vlen(str)
+vbytes_dtype = h5py.special_dtype(vlen=numpy.uint8) # Raw binary data (e.g. restart archives)
 h5ref_dtype = h5py.special_dtype(ref=h5py.Reference)
 binhash_dtype = numpy.dtype('|S64')
 
@@ -168,7 +230,7 @@ ibstate_index_dtype = numpy.dtype([('iter_valid', numpy.uint),
 bstate_dtype = numpy.dtype( [ ('label', vstr_dtype),            # An optional descriptive label
                               ('probability', weight_dtype),   # Probability that this state will be selected
                               ('auxref', vstr_dtype),           # An optional auxiliar data reference
-                              ('restart', vvoid_dtype),           # An optional bit of restart data
+                              ('restart', vbytes_dtype),           # An optional bit of restart data
                               ])
 
 # Even when initial state generation is off and basis states are passed through directly, an initial state entry
@@ -179,7 +241,7 @@ istate_dtype = numpy.dtype( [('iter_created', numpy.uint),      # Iteration duri
                              ('basis_state_id', seg_id_dtype),    # Which basis state this state was generated from
                              ('istate_type', istate_type_dtype),  # What type this initial state is (generated or basis)
                              ('istate_status', istate_status_dtype), # Whether this initial state is ready to go
-                             ('restart', vvoid_dtype),           # An optional bit of restart data
+                             ('restart', vbytes_dtype),           # An optional bit of restart data
                              ])
 
 tstate_index_dtype = numpy.dtype([('iter_valid', numpy.uint), # Iteration when this state list is valid
@@ -200,6 +262,122 @@ nw_index_dtype = numpy.dtype([('source_type', nw_source_dtype),
 binning_index_dtype = numpy.dtype([('hash', binhash_dtype),
                                    ('pickle_len', numpy.uint32)])
 
+class WriteBehindWriter:
+    '''Write segments and initial states to HDF5 from a dedicated thread, so that the caller (the
+    sim manager, collecting results from workers) does not block on HDF5 I/O. Submissions are
+    queued (up to ``queue_size`` of them; further submissions block, which provides back-pressure),
+    coalesced, and written once ``batch_size`` objects are pending or the oldest pending object
+    has waited ``period`` seconds. ``close()`` writes everything outstanding and flushes the file;
+    nothing is durable until it returns. An error in the writer thread is re-raised in the caller
+    on the next submission, or on ``close()``.'''
+
+    _stop = object()
+
+    def __init__(self, data_manager, queue_size=16, batch_size=256, period=5.0):
+        self.data_manager = data_manager
+        self.batch_size = batch_size
+        self.period = period
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.n_written = 0
+        self.n_writes = 0
+        self.thread = threading.Thread(target=self._run, name='WriteBehindWriter')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit_segments(self, n_iter, segments):
+        '''Queue ``segments`` (from iteration ``n_iter``) for ``update_segments``.'''
+        self._check()
+        self.queue.put(('segments', n_iter, list(segments)))
+
+    def submit_initial_states(self, n_iter, initial_states):
+        '''Queue ``initial_states`` (for iteration ``n_iter``) for ``update_initial_states``.'''
+        self._check()
+        self.queue.put(('initial_states', n_iter, list(initial_states)))
+
+    def close(self, check=True):
+        '''Write all pending data, flush the HDF5 file, and stop the writer thread. If ``check`` is
+        false (as when the caller is already handling an exception), an error in the writer thread is
+        not re-raised; it has been logged already.'''
+        self.queue.put(self._stop)
+        self.thread.join()
+        if check:
+            self._check()
+        self.data_manager.flush_backing()
+        log.debug('write-behind writer wrote {:d} objects in {:d} writes'.format(self.n_written, self.n_writes))
+
+    def _write(self, pending):
+        with self.data_manager.expiring_flushing_lock():
+            for ((kind, n_iter), objects) in sorted(pending.iteritems()):
+                if kind == 'segments':
+                    self.data_manager.update_segments(n_iter, objects)
+                else:
+                    self.data_manager.update_initial_states(objects, n_iter=n_iter)
+                self.n_written += len(objects)
+        self.n_writes += 1
+
+    def _run(self):
+        pending = {}
+        n_pending = 0
+        first_pending = None
+        done = False
+        try:
+            while not done:
+                if first_pending is None:
+                    timeout = None
+                else:
+                    timeout = max(0.0, first_pending + self.period - time.time())
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    item = None
+
+                if item is self._stop:
+                    done = True
+                elif item is not None:
+                    (kind, n_iter, objects) = item
+                    pending.setdefault((kind, n_iter), []).extend(objects)
+                    n_pending += len(objects)
+                    if first_pending is None:
+                        first_pending = time.time()
+
+                if n_pending and (done or n_pending >= self.batch_size or time.time() >= first_pending + self.period):
+                    self._write(pending)
+                    pending = {}
+                    n_pending = 0
+                    first_pending = None
+        except Exception as e:
+            log.exception('error in write-behind writer thread')
+            self.error = e
+            # Keep consuming, so that producers blocked on a full queue are released
+            while item is not self._stop:
+                item = self.queue.get()
+
+class suspended_swmr:
+    '''Temporarily take a data manager out of SWMR mode (if it is in SWMR mode), so that new objects
+    may be created in the HDF5 file. Any HDF5 objects obtained before entering this context are
+    invalid within and after it.'''
+    def __init__(self, data_manager):
+        self.data_manager = data_manager
+        self.resume = False
+
+    def __enter__(self):
+        self.data_manager.lock.acquire()
+        self.resume = self.data_manager.end_swmr()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if self.resume:
+                self.data_manager.begin_swmr()
+        finally:
+            self.data_manager.lock.release()
+
 class WESTDataManager:
     """Data manager for assisiting the reading and writing of WEST data from/to HDF5 files."""
 
@@ -210,6 +388,20 @@ class WESTDataManager:
     default_flush_period = 60
     default_data_refs          = '$WEST_SIM_ROOT/trajectories/{segment.n_iter:06d}.h5'
     default_store_external_aux = False
+    default_swmr = False
+
+    # Sharding of iteration groups into separate files (disabled unless iterations_per_shard is set)
+    default_iterations_per_shard = None
+    default_shard_file = '{basename}_iters_{first_iter:08d}.h5'
+
+    # Asynchronous (write-behind) writes of segments during propagation
+    default_write_behind = False
+    default_write_behind_queue_size = 16
+    default_write_behind_batch_size = 256
+    default_write_behind_period = 5.0
+
+    # Number of iterations for which group handles and small segment index arrays are cached
+    default_iter_cache_size = 32
 
     # Compress any auxiliary dataset whose total size (across all segments) is more than 1MB
     default_aux_compression_threshold = 1048576
@@ -227,6 +419,14 @@ class WESTDataManager:
         next_flush = self.last_flush + self.flush_period
         return expiring_flushing_lock(self.lock, self.flush_backing, next_flush)
 
+    def suspended_swmr(self):
+        return suspended_swmr(self)
+
+    def write_behind_writer(self):
+        '''Return a new (not yet started) ``WriteBehindWriter`` configured for this data manager.'''
+        return WriteBehindWriter(self, queue_size=self.write_behind_queue_size, batch_size=self.write_behind_batch_size,
+                                 period=self.write_behind_period)
+
     def process_config(self):
         config = self.rc.config
 
@@ -241,6 +441,16 @@ class WESTDataManager:
         self.aux_compression_threshold = config.get(['west','data','aux_compression_threshold'],
                                                     self.default_aux_compression_threshold)
         self.flush_period = config.get(['west','data','flush_period'], self.default_flush_period)
+        self.swmr = config.get(['west','data','swmr'], self.default_swmr)
+        self.iterations_per_shard = config.get(['west','data','iterations_per_shard'], self.default_iterations_per_shard)
+        self.shard_file = config.get(['west','data','shard_file'], self.default_shard_file)
+        self.write_behind = config.get(['west','data','write_behind'], self.default_write_behind)
+        self.write_behind_queue_size = config.get(['west','data','write_behind_queue_size'],
+                                                  self.default_write_behind_queue_size)
+        self.write_behind_batch_size = config.get(['west','data','write_behind_batch_size'],
+                                                  self.default_write_behind_batch_size)
+        self.write_behind_period = config.get(['west','data','write_behind_period'], self.default_write_behind_period)
+        self.iter_cache.max_iters = config.get(['west','data','iter_cache_size'], self.default_iter_cache_size)
 
         # For storing trajectory coordinates as axudata...
         # We'll probably want to fancy this up later, but for now, it should work.
@@ -279,8 +489,30 @@ class WESTDataManager:
 
         self.lock = threading.RLock()
         self.flush_period = None
+        self.swmr = self.default_swmr
+        self.we_h5file_follow = False
+        self.iterations_per_shard = self.default_iterations_per_shard
+        self.shard_file = self.default_shard_file
+        self.write_behind = self.default_write_behind
+        self.write_behind_queue_size = self.default_write_behind_queue_size
+        self.write_behind_batch_size = self.default_write_behind_batch_size
+        self.write_behind_period = self.default_write_behind_period
+        self.iter_cache = IterationCache(self.default_iter_cache_size)
         self.last_flush = 0
 
+        # Shard files holding iteration groups opened through this data manager, which are
+        # written through their own file handles and must be flushed separately
+        self._shard_files = {}
+
+        # Variable-length data received while the file is in SWMR mode (in which HDF5 cannot write it),
+        # to be written when the file leaves SWMR mode: lists of (n_iter, dsname, dsopts, shape, dtype,
+        # [(seg_id, data), ...]) for segments and of (n_iter, state_id, restart) for initial states
+        self._deferred_aux_data = []
+        self._deferred_istate_restarts = []
+
+        # In-memory map of bin mapper hash to row in /bin_topologies/index
+        self._reset_bin_mapper_rows()
+
         self._system = None
 
         self.dataset_options = {}
@@ -306,23 +538,111 @@ class WESTDataManager:
         else:
             return 'iter_{:0{prec}d}'.format(long(n_iter), prec=self.iter_prec)
 
+    def shard_filename(self, n_iter):
+        '''Return the name (relative to the directory containing the main HDF5 file) of the shard file
+        holding the data for iteration ``n_iter``, when iteration sharding is enabled.'''
+        ishard = (long(n_iter)-1) // self.iterations_per_shard
+        first_iter = ishard*self.iterations_per_shard + 1
+        basename = os.path.splitext(os.path.basename(self.we_h5filename))[0]
+        return self.shard_file.format(basename=basename, shard=ishard, first_iter=first_iter,
+                                      last_iter=first_iter+self.iterations_per_shard-1)
+
+    def _create_sharded_iter_group(self, n_iter):
+        '''Create the group for iteration ``n_iter`` in its shard file, and link it into the main file.'''
+        iter_group_name = self.iter_group_name(n_iter)
+        shard_name = self.shard_filename(n_iter)
+        shard_path = os.path.join(os.path.dirname(os.path.abspath(self.we_h5filename)), shard_name)
+        log.debug('creating group for iteration {:d} in shard {!r}'.format(n_iter, shard_path))
+        shard_file = h5io.WESTPAH5File(shard_path, 'a', westpa_iter_prec=self.iter_prec, **self._backing_file_options())
+        try:
+            shard_file.require_group(iter_group_name)
+        finally:
+            shard_file.close()
+        # Relative links are resolved with respect to the directory containing the main file
+        self.we_h5file[iter_group_name] = h5py.ExternalLink(shard_name, iter_group_name)
+
     def require_iter_group(self, n_iter):
-        '''Get the group associated with n_iter, creating it if necessary.'''
+        '''Get the group associated with n_iter, creating it if necessary. If iteration sharding is
+        enabled (``west.data.iterations_per_shard``), new groups are created in shard files and
+        linked into the main file.'''
         with self.lock:
-            iter_group = self.we_h5file.require_group('/iterations/iter_{:0{prec}d}'.format(long(n_iter), prec=self.iter_prec))
+            iter_group_name = self.iter_group_name(n_iter)
+            link = self.we_h5file.get(iter_group_name, getlink=True)
+            if self.iterations_per_shard and link is None:
+                self._create_sharded_iter_group(n_iter)
+                link = self.we_h5file.get(iter_group_name, getlink=True)
+            iter_group = self.we_h5file.require_group(iter_group_name)
             iter_group.attrs['n_iter'] = n_iter
+            if isinstance(link, h5py.ExternalLink):
+                self._shard_files[iter_group.file.filename] = iter_group.file
         return iter_group
 
     def del_iter_group(self, n_iter):
         with self.lock:
-            del self.we_h5file['/iterations/iter_{:0{prec}d}'.format(long(n_iter), prec=self.iter_prec)]
+            iter_group_name = '/iterations/iter_{:0{prec}d}'.format(long(n_iter), prec=self.iter_prec)
+            link = self.we_h5file.get(iter_group_name, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                # Remove the data in the shard, too
+                shard_path = os.path.join(os.path.dirname(os.path.abspath(self.we_h5filename)), link.filename)
+                try:
+                    shard_file = h5py.File(shard_path, 'r+')
+                except IOError:
+                    log.warning('could not open shard file {!r} for iteration {:d}'.format(shard_path, n_iter))
+                else:
+                    with shard_file:
+                        if link.path in shard_file:
+                            del shard_file[link.path]
+            del self.we_h5file[iter_group_name]
+            self.iter_cache.invalidate(n_iter)
+
+    def dereference(self, ref, n_iter=None):
+        '''Dereference an HDF5 object or region reference. References to objects in an iteration group
+        (``n_iter`` not None) are dereferenced in the file holding that group, which may be a shard
+        file; otherwise references are dereferenced in the main file.'''
+        with self.lock:
+            if n_iter is None:
+                return self.we_h5file[ref]
+            else:
+                return self.get_iter_group(n_iter).file[ref]
+
+    def _lookup_iter_group(self, n_iter):
+        iter_group_name = '/iterations/iter_{:0{prec}d}'.format(long(n_iter), prec=self.iter_prec)
+        try:
+            iter_group = self.we_h5file[iter_group_name]
+        except KeyError:
+            return self.we_h5file['/iter_{:0{prec}d}'.format(long(n_iter),prec=self.iter_prec)]
+        if isinstance(self.we_h5file.get(iter_group_name, getlink=True), h5py.ExternalLink):
+            self._shard_files[iter_group.file.filename] = iter_group.file
+        return iter_group
 
     def get_iter_group(self, n_iter):
         with self.lock:
-            try:
-                return self.we_h5file['/iterations/iter_{:0{prec}d}'.format(long(n_iter), prec=self.iter_prec)]
-            except KeyError:
-                return self.we_h5file['/iter_{:0{prec}d}'.format(long(n_iter),prec=self.iter_prec)]
+            return self.iter_cache.get(n_iter, 'iter_group', lambda: self._lookup_iter_group(n_iter))
+
+    def get_seg_index_field(self, n_iter, field):
+        '''Return (as a read-only array) one field (e.g. ``weight``, ``parent_id``, or
+        ``endpoint_type``) of the segment index for iteration ``n_iter``. Results are cached until
+        the iteration is next written to.'''
+        def load_field():
+            if field == 'parent_id' and self.we_h5file_version < 5:
+                iter_group = self.get_iter_group(n_iter)
+                values = iter_group['parents'][...].take(iter_group['seg_index']['parents_offset'])
+            else:
+                values = self.get_iter_group(n_iter)['seg_index'][field]
+            values.setflags(write=False)
+            return values
+
+        with self.lock:
+            return self.iter_cache.get(n_iter, ('seg_index', field), load_field)
+
+    def invalidate_iter_cache(self, n_iter=None):
+        '''Discard cached data for iteration ``n_iter``, or for all iterations if ``n_iter`` is None.
+        Must be called if the file is modified other than through this data manager.'''
+        with self.lock:
+            if n_iter is None:
+                self.iter_cache.clear()
+            else:
+                self.iter_cache.invalidate(n_iter)
 
     def get_seg_index(self, n_iter):
         with self.lock:
@@ -345,12 +665,27 @@ class WESTDataManager:
         with self.lock:
             self.we_h5file['/'].attrs['west_current_iteration'] = n_iter
 
-    def open_backing(self, mode=None):
-        '''Open the (already-created) HDF5 file named in self.west_h5filename.'''
+    def _backing_file_options(self):
+        options = {'driver': self.we_h5file_driver}
+        if self.swmr:
+            # SWMR requires the newest file format
+            options['libver'] = 'latest'
+        return options
+
+    def open_backing(self, mode=None, follow=False):
+        '''Open the (already-created) HDF5 file named in self.west_h5filename. If ``follow`` is true,
+        the file is opened read-only as a SWMR reader, so that it may be read while a simulation
+        (running with the ``west.data.swmr`` option) is writing to it; see ``refresh_backing``.'''
         mode = mode or self.h5_access_mode
         if not self.we_h5file:
             log.debug('attempting to open {} with mode {}'.format(self.we_h5filename, mode))
-            self.we_h5file = h5io.WESTPAH5File(self.we_h5filename, mode, driver=self.we_h5file_driver)
+            if follow:
+                self.we_h5file = h5io.WESTPAH5File(self.we_h5filename, 'r', driver=self.we_h5file_driver, follow=True)
+            else:
+                self.we_h5file = h5io.WESTPAH5File(self.we_h5filename, mode, **self._backing_file_options())
+            self.we_h5file_follow = follow
+            self.iter_cache.clear()
+            self._reset_bin_mapper_rows()
 
             h5file_attrs = self.we_h5file['/'].attrs
             h5file_attr_keys = h5file_attrs.keys()
@@ -375,7 +710,9 @@ class WESTDataManager:
     def prepare_backing(self): #istates):
         '''Create new HDF5 file'''
         #self.we_h5file = h5py.File(self.we_h5filename, 'w', driver=self.we_h5file_driver, flags="NPY_ARRAY_FORCECAST")
-        self.we_h5file = h5py.File(self.we_h5filename, 'w', driver=self.we_h5file_driver)#, flags="NPY_ARRAY_FORCECAST")
+        self.we_h5file = h5py.File(self.we_h5filename, 'w', **self._backing_file_options())#, flags="NPY_ARRAY_FORCECAST")
+        self.iter_cache.clear()
+        self._reset_bin_mapper_rows()
 
         with self.flushing_lock():
             self.we_h5file_version = file_format_version
@@ -391,15 +728,86 @@ class WESTDataManager:
     def close_backing(self):
         if self.we_h5file is not None:
             with self.lock:
+                self.iter_cache.clear()
+                self._reset_bin_mapper_rows()
+                self._shard_files.clear()
                 self.we_h5file.close()
+            log.debug('iteration cache: {hits:d} hits, {misses:d} misses'.format(**self.iter_cache.stats()))
             self.we_h5file = None
 
     def flush_backing(self):
         if self.we_h5file is not None:
             with self.lock:
                 self.we_h5file.flush()
+                for shard_file in self._shard_files.itervalues():
+                    shard_file.flush()
                 self.last_flush = time.time()
 
+    def refresh_backing(self):
+        '''For a file opened as a SWMR reader (``open_backing(follow=True)``), reopen the file so that
+        iterations committed since it was opened become visible. Returns the current iteration.'''
+        with self.lock:
+            follow = self.we_h5file_follow
+            self.close_backing()
+            self.open_backing(follow=follow)
+            return self.current_iteration
+
+    @property
+    def in_swmr(self):
+        return self.we_h5file is not None and bool(getattr(self.we_h5file, 'swmr_mode', False)) and not self.we_h5file_follow
+
+    def begin_swmr(self):
+        '''If SWMR mode is enabled (``west.data.swmr``), start single-writer/multiple-reader access to
+        the HDF5 file, so that analysis tools may read it (with ``--follow``) as it is written. No new
+        groups, data sets, or attributes may be created in this state; use ``suspended_swmr`` (or
+        ``end_swmr``) for that. Returns True if the file is now in SWMR mode.'''
+        if not self.swmr or self.we_h5file is None or self.we_h5file_follow:
+            return False
+        with self.lock:
+            if not self.in_swmr:
+                self.we_h5file.flush()
+                try:
+                    self.we_h5file.swmr_mode = True
+                except (ValueError, RuntimeError, AttributeError) as e:
+                    log.warning('could not enter SWMR mode ({}); disabling SWMR'.format(e))
+                    self.swmr = False
+                    return False
+                log.debug('entered SWMR mode')
+            return True
+
+    def end_swmr(self):
+        '''Leave SWMR mode, which (as HDF5 does not allow otherwise) requires reopening the file.
+        Returns True if the file was in SWMR mode.'''
+        with self.lock:
+            if not self.in_swmr:
+                return False
+            self.close_backing()
+            self.open_backing()
+            log.debug('left SWMR mode')
+            self._write_deferred_data()
+            return True
+
+    def _write_deferred_data(self):
+        '''Write variable-length data deferred while the file was in SWMR mode.'''
+        deferred_aux_data, self._deferred_aux_data = self._deferred_aux_data, []
+        deferred_istate_restarts, self._deferred_istate_restarts = self._deferred_istate_restarts, []
+
+        for (n_iter, dsname, dsopts, shape, dtype, entries) in deferred_aux_data:
+            dset = require_dataset_from_dsopts(self.get_iter_group(n_iter), dsopts, shape, dtype,
+                                               autocompress_threshold=self.aux_compression_threshold, n_iter=n_iter)
+            write_aux_data(dset, dsname, [Segment(n_iter=n_iter, seg_id=seg_id, data={dsname: data})
+                                          for (seg_id, data) in entries])
+
+        for (n_iter, state_id, restart) in deferred_istate_restarts:
+            istate_index = self.find_ibstate_group(n_iter)['istate_index']
+            index_entry = istate_index[state_id]
+            index_entry['restart'] = restart_data_for_dtype(restart, istate_index.dtype['restart'])
+            istate_index[state_id] = index_entry
+
+        if deferred_aux_data or deferred_istate_restarts:
+            log.debug('wrote {:d} deferred auxiliary data sets and {:d} initial state restarts'
+                      .format(len(deferred_aux_data), len(deferred_istate_restarts)))
+
     def create_new_external_h5file(self, h5filename): #istates):
         '''Create new HDF5 file that can be used to symlink in extra.'''
         # This is mostly just here for convenience, right now.  I think it's the right place to put it in there.
@@ -561,7 +969,8 @@ class WESTDataManager:
                     state_table[i]['auxref'] = state.auxref or ''
                     state_pcoords[i] = state.pcoord
                     if self.we_h5file_version == 8:
-                        state_table[i]['restart'] = state.data['trajectories/restart']
+                        state_table['restart'][i] = restart_data_for_dtype(state.data['trajectories/restart'],
+                                                                           state_table.dtype['restart'])
                         #assert state_table[i]['restart'] == state.data['trajectories/restart']
                         #del(state.data)
                 state_group['bstate_index'] = state_table
@@ -591,6 +1000,15 @@ class WESTDataManager:
             return bstates
 
 
+    def _create_istate_tables(self, ibstate_group, n_states):
+        system = westpa.rc.get_system_driver()
+        istate_index = ibstate_group.create_dataset('istate_index', dtype=istate_dtype,
+                                                    shape=(n_states,), maxshape=(None,))
+        istate_pcoords = ibstate_group.create_dataset('istate_pcoord', dtype=system.pcoord_dtype,
+                                                      shape=(n_states,system.pcoord_ndim),
+                                                      maxshape=(None,system.pcoord_ndim))
+        return (istate_index, istate_pcoords)
+
     def create_initial_states(self, n_states, n_iter=None):
         '''Create storage for ``n_states`` initial states associated with iteration ``n_iter``, and
         return bare InitialState objects with only state_id set.'''
@@ -603,11 +1021,9 @@ class WESTDataManager:
             try:
                 istate_index = ibstate_group['istate_index']
             except KeyError:
-                istate_index = ibstate_group.create_dataset('istate_index', dtype=istate_dtype,
-                                                            shape=(n_states,), maxshape=(None,))
-                istate_pcoords = ibstate_group.create_dataset('istate_pcoord', dtype=system.pcoord_dtype,
-                                                              shape=(n_states,system.pcoord_ndim),
-                                                              maxshape=(None,system.pcoord_ndim))
+                with self.suspended_swmr():
+                    ibstate_group = self.find_ibstate_group(n_iter)
+                    (istate_index, istate_pcoords) = self._create_istate_tables(ibstate_group, n_states)
                 len_index = len(istate_index)
                 first_id = 0
             else:
@@ -617,16 +1033,15 @@ class WESTDataManager:
                 istate_pcoords = ibstate_group['istate_pcoord']
                 istate_pcoords.resize((len_index,system.pcoord_ndim))
 
+            # All new rows are initialized in one read and one write
+            index_entries = istate_index[first_id:len_index]
+            index_entries['iter_created'] = n_iter
+            index_entries['istate_status'] = InitialState.ISTATE_STATUS_PENDING
+            istate_index[first_id:len_index] = index_entries
 
-        index_entries = istate_index[first_id:len_index]
-        new_istates = []
-        for irow, row in enumerate(index_entries):
-            row['iter_created'] = n_iter
-            row['istate_status'] = InitialState.ISTATE_STATUS_PENDING
-            new_istates.append(InitialState(state_id=first_id+irow, basis_state_id=None,
-                                            iter_created=n_iter, istate_status=InitialState.ISTATE_STATUS_PENDING))
-        istate_index[first_id:len_index] = index_entries
-        return new_istates
+        return [InitialState(state_id=state_id, basis_state_id=None, iter_created=n_iter,
+                             istate_status=InitialState.ISTATE_STATUS_PENDING)
+                for state_id in xrange(first_id, len_index)]
 
     def update_initial_states(self, initial_states, n_iter = None):
         '''Save the given initial states in the HDF5 file'''
@@ -640,6 +1055,9 @@ class WESTDataManager:
             n_iter = n_iter or self.current_iteration
             ibstate_group = self.find_ibstate_group(n_iter)
             state_ids = [state.state_id for state in initial_states]
+            if len(state_ids) == 1 or numpy.all(numpy.diff(state_ids) == 1):
+                # States allocated together are contiguous; a slice is much faster than a point selection
+                state_ids = slice(state_ids[0], state_ids[-1]+1)
             index_entries = (ibstate_group['istate_index'][state_ids] )
             pcoord_vals = numpy.empty((len(initial_states), system.pcoord_ndim), dtype=system.pcoord_dtype)
             for i, initial_state in enumerate(initial_states):
@@ -649,11 +1067,18 @@ class WESTDataManager:
                 index_entries[i]['istate_type'] = initial_state.istate_type or InitialState.ISTATE_TYPE_UNSET
                 index_entries[i]['istate_status'] = initial_state.istate_status or InitialState.ISTATE_STATUS_PENDING
                 pcoord_vals[i] = initial_state.pcoord
-                if self.we_h5file_version == 8:
+                if self.we_h5file_version == 8 and self.in_swmr:
+                    # Restart data is variable-length, and is written when the file leaves SWMR mode
+                    restart = initial_state.data.get('trajectories/restart')
+                    if restart is not None:
+                        self._deferred_istate_restarts.append((n_iter, initial_state.state_id, restart))
+                        del(initial_state.data)
+                elif self.we_h5file_version == 8:
                     try:
                         # It seems this function is called a few times; not sure how best to handle it.
                     #if initial_state.istate_status != InitialState.ISTATE_STATUS_PENDING:
-                        index_entries[i]['restart'] = initial_state.data['trajectories/restart']
+                        index_entries['restart'][i] = restart_data_for_dtype(initial_state.data['trajectories/restart'],
+                                                                             index_entries.dtype['restart'])
                         #assert index_entries[i]['restart'] == initial_state.data['trajectories/restart']
                         del(initial_state.data)
                     except:
@@ -776,6 +1201,7 @@ class WESTDataManager:
             if len(summary_table) < n_iter:
                 summary_table.resize((n_iter+1,))
 
+            self.iter_cache.invalidate(n_iter)
             iter_group = self.require_iter_group(n_iter)
 
             for linkname in ('seg_index', 'pcoord', 'wtgraph'):
@@ -899,6 +1325,45 @@ class WESTDataManager:
             seg_index_table_ds[:] = seg_index_table
             pcoord_ds[...] = pcoord
 
+            if self.swmr:
+                self._prepare_swmr_datasets(n_iter, iter_group, n_particles)
+
+    def _prepare_swmr_datasets(self, n_iter, iter_group, n_segments):
+        '''Create the data sets which would otherwise be created during propagation, when the file
+        is in SWMR mode and nothing may be created in it: auxiliary data sets (shaped and typed as in
+        the previous iteration) and the initial state tables used by the next iteration. Auxiliary data
+        first seen during propagation still requires SWMR mode to be suspended while it is created.'''
+        try:
+            prev_iter_group = self.get_iter_group(n_iter-1)
+        except KeyError:
+            prev_iter_group = None
+
+        if prev_iter_group is not None:
+            dsnames = set(self.dataset_options)
+            if 'auxdata' in prev_iter_group:
+                prev_iter_group['auxdata'].visititems(lambda name, obj: dsnames.add(name) if isinstance(obj, h5py.Dataset) else None)
+            dsnames.discard('pcoord')
+
+            for dsname in dsnames:
+                try:
+                    dsopts = self.dataset_options[dsname]
+                except KeyError:
+                    dsopts = normalize_dataset_options({'name': dsname}, path_prefix='auxdata')
+                if not dsopts.get('store', True) or 'file' in dsopts:
+                    continue
+                prev_dset = prev_iter_group.get(dsopts['h5path'])
+                if not isinstance(prev_dset, h5py.Dataset):
+                    continue
+                require_dataset_from_dsopts(iter_group, dsopts, (n_segments,) + prev_dset.shape[1:], prev_dset.dtype,
+                                            autocompress_threshold=self.aux_compression_threshold, n_iter=n_iter)
+
+        try:
+            ibstate_group = self.find_ibstate_group(n_iter+1)
+        except KeyError:
+            ibstate_group = None
+        if ibstate_group is not None and 'istate_index' not in ibstate_group:
+            self._create_istate_tables(ibstate_group, 0)
+
     def update_iter_group_links(self, n_iter):
         '''Update the per-iteration hard links pointing to the tables of target and initial/basis states for the
         given iteration.  These links are not used by this class, but are remarkably convenient for third-party
@@ -913,7 +1378,12 @@ class WESTDataManager:
                 except KeyError:
                     pass
 
-            iter_group['ibstates'] = self.find_ibstate_group(n_iter)
+            ibstate_group = self.find_ibstate_group(n_iter)
+            if iter_group.file.filename != self.we_h5file.filename:
+                # Iteration group is in a shard; hard links cannot cross files
+                iter_group['ibstates'] = h5py.ExternalLink(os.path.basename(self.we_h5filename), ibstate_group.name)
+            else:
+                iter_group['ibstates'] = ibstate_group
 
             tstate_group = self.find_tstate_group(n_iter)
             if tstate_group is not None:
@@ -940,6 +1410,8 @@ class WESTDataManager:
         segments = sorted(segments, key=attrgetter('seg_id'))
 
         with self.lock:
+            # Cached weights, endpoint types, etc. are about to become stale
+            self.iter_cache.invalidate(n_iter)
             iter_group = self.get_iter_group(n_iter)
 
             pc_dsid = iter_group['pcoord'].id
@@ -1020,41 +1492,72 @@ class WESTDataManager:
                         raise ValueError('Failed to load any data from dset: {}'.format(dsname))
 
                     shape = (n_total_segments,) + shape
+                    # Variable-length data cannot be written to a file in SWMR mode; it is written
+                    # (e.g. at the end of propagation) when the file leaves SWMR mode
+                    defer = (self.in_swmr and dsopts.get('store', True) and 'file' not in dsopts
+                             and h5py.check_dtype(vlen=dtype) is not None)
+                    if self.in_swmr and dsopts.get('store', True) and dsopts['h5path'] not in iter_group:
+                        # New data sets cannot be created in SWMR mode
+                        with self.suspended_swmr():
+                            iter_group = self.get_iter_group(n_iter)
+                            require_dataset_from_dsopts(iter_group, dsopts, shape, dtype,
+                                                        autocompress_threshold=self.aux_compression_threshold, n_iter=n_iter)
                     dset = require_dataset_from_dsopts(iter_group, dsopts, shape, dtype,
                                                        autocompress_threshold=self.aux_compression_threshold, n_iter=n_iter)
                     if dset is None:
                         # storage is suppressed
                         continue
-                    for segment in segments:
-                        try:
-                            auxdataset = segment.data[dsname]
-                        except KeyError:
-                            pass
-                        else:
-                            source_rank = len(auxdataset.shape)
-                            source_sel = h5s.create_simple(auxdataset.shape, (h5s.UNLIMITED,)*source_rank)
-                            source_sel.select_all()
-                            dest_sel = dset.id.get_space()
-                            dest_sel.select_hyperslab((segment.seg_id,)+(0,)*source_rank, (1,)+auxdataset.shape)
-                            dset.id.write(source_sel, dest_sel, auxdataset)
-                        #if 'delram' in dsopts.keys():
-                        if dsopts['name'] == 'trajectories/restart' or dsopts['name'] == 'trajectories/trajectory':
-                        #if dsopts['name'] == 'trajectories/trajectory':
-                            del(auxdataset)
-                            del(segment.data[dsname])
+                    if dsname == 'trajectories/restart' and h5py.check_dtype(vlen=dset.dtype) is str:
+                        # This iteration was begun with the legacy restart format
+                        for segment in segments:
+                            if dsname in segment.data:
+                                segment.data[dsname] = numpy.array(restart_data_for_dtype(segment.data[dsname], dset.dtype),
+                                                                   dtype=dset.dtype)
+                    if defer:
+                        self._deferred_aux_data.append((n_iter, dsname, dsopts, shape, dtype,
+                                                        [(segment.seg_id, segment.data[dsname]) for segment in segments
+                                                         if dsname in segment.data]))
+                    else:
+                        write_aux_data(dset, dsname, segments)
+                    #if 'delram' in dsopts.keys():
+                    if dsopts['name'] == 'trajectories/restart' or dsopts['name'] == 'trajectories/trajectory':
+                    #if dsopts['name'] == 'trajectories/trajectory':
+                        for segment in segments:
+                            segment.data.pop(dsname, None)
             	    if 'delram' in dsopts.keys():
                         del dsets[dsname]
 
-    def get_segments(self, n_iter=None, seg_ids=None, load_pcoords = True):
-        '''Return the given (or all) segments from a given iteration.
+    def get_restart_reference(self, segment):
+        '''Return a :class:`RestartReference` to the restart data from which ``segment`` is to be
+        continued, which may be in the previous iteration's restart data set or in the table of
+        initial states, or None if that data cannot safely be read by another process while this
+        one holds the WEST HDF5 file open. References are only issued in SWMR mode (so that workers
+        can open the file as SWMR readers) and only for data in the WEST HDF5 file itself; restart
+        data in external files must be dereferenced by the caller.'''
 
-        If the optional parameter ``load_auxdata`` is true, then all auxiliary datasets
-        available are loaded and mapped onto the ``data`` dictionary of each segment. If
-        ``load_auxdata`` is None, then use the default ``self.auto_load_auxdata``, which can
-        be set by the option ``load_auxdata`` in the ``[data]`` section of ``west.cfg``. This
-        essentially requires as much RAM as there is per-iteration auxiliary data, so this
-        behavior is not on by default.'''
+        n_iter = segment.n_iter
+        with self.lock:
+            if not self.in_swmr:
+                return None
+            if segment.parent_id >= 0:
+                try:
+                    dsopts = self.dataset_options['trajectories/restart']
+                except KeyError:
+                    dsopts = normalize_dataset_options({'name': 'trajectories/restart'}, path_prefix='auxdata')
+                if 'file' in dsopts:
+                    return None
+                h5path = posixpath.join(self.iter_group_name(n_iter-1), dsopts['h5path'])
+                return RestartReference(n_iter, os.path.abspath(self.we_h5filename), h5path, long(segment.parent_id))
+            else:
+                istate_index = self.find_ibstate_group(n_iter)['istate_index']
+                return RestartReference(n_iter, os.path.abspath(self.we_h5filename), istate_index.name,
+                                        long(segment.initial_state_id), field='restart')
 
+    def get_segment_table(self, n_iter=None, seg_ids=None, load_pcoords=True):
+        '''Return the given (or all) segments from a given iteration as a
+        :class:`west.segment.SegmentTable`. The segment index, progress coordinates, and
+        weight transfer graph are each read from HDF5 in one bulk read, and ``Segment``
+        objects are only constructed when they are requested from the table.'''
 
         n_iter = n_iter or self.current_iteration
         file_version = self.we_h5file_version
@@ -1063,126 +1566,126 @@ class WESTDataManager:
             iter_group = self.get_iter_group(n_iter)
             seg_index_ds = iter_group['seg_index']
 
-            if file_version < 5:
-                all_parent_ids = iter_group['parents'][...]
-            else:
-                all_parent_ids = iter_group['wtgraph'][...]
-
             if seg_ids is not None:
-                seg_ids = list(sorted(seg_ids))
-                seg_index_entries = seg_index_ds[seg_ids]
+                seg_ids = numpy.array(sorted(seg_ids), dtype=seg_id_dtype)
+                if len(seg_ids):
+                    seg_index_entries = seg_index_ds[list(seg_ids)]
+                else:
+                    seg_index_entries = numpy.empty((0,), dtype=seg_index_ds.dtype)
                 if load_pcoords:
-                    pcoord_entries = iter_group['pcoord'][seg_ids]
+                    pcoord_ds = iter_group['pcoord']
+                    if len(seg_ids):
+                        pcoords = pcoord_ds[list(seg_ids)]
+                    else:
+                        pcoords = numpy.empty((0,)+pcoord_ds.shape[1:], dtype=pcoord_ds.dtype)
             else:
-                seg_ids = range(len(seg_index_ds))
                 seg_index_entries = seg_index_ds[...]
+                seg_ids = numpy.arange(len(seg_index_entries), dtype=seg_id_dtype)
                 if load_pcoords:
-                    pcoord_entries = iter_group['pcoord'][...]
+                    pcoords = iter_group['pcoord'][...]
+            n_segs = len(seg_ids)
 
-            segments = []
+            if file_version < 5:
+                all_parent_ids = iter_group['parents'][...]
+                wtg_n_parents = seg_index_entries['n_parents']
+                wtg_src_offsets = seg_index_entries['parents_offset']
+                parent_ids = numpy.require(all_parent_ids[wtg_src_offsets], dtype=seg_id_dtype)
+            else:
+                try:
+                    all_parent_ids = iter_group['wtgraph'][...]
+                except KeyError:
+                    all_parent_ids = numpy.empty((0,), dtype=seg_id_dtype)
+                wtg_n_parents = seg_index_entries['wtg_n_parents']
+                wtg_src_offsets = seg_index_entries['wtg_offset']
+                parent_ids = seg_index_entries['parent_id']
+
+            # Gather the weight transfer graph into CSR form in one vectorized step; this is
+            # an identity gather when the whole iteration is loaded
+            wtg_n_parents = numpy.require(wtg_n_parents, dtype=numpy.int64)
+            wtg_offsets = numpy.zeros((n_segs+1,), dtype=numpy.int64)
+            numpy.cumsum(wtg_n_parents, out=wtg_offsets[1:])
+            wtg_gather = (numpy.repeat(numpy.require(wtg_src_offsets, dtype=numpy.int64) - wtg_offsets[:-1], wtg_n_parents)
+                          + numpy.arange(wtg_offsets[-1], dtype=numpy.int64))
+            wtg_parent_ids = all_parent_ids[wtg_gather]
+            del all_parent_ids
 
-            for iseg, (seg_id, row) in enumerate(izip(seg_ids, seg_index_entries)):
-                segment = Segment(seg_id = seg_id,
-                                  n_iter = n_iter,
-                                  status = int(row['status']),
-                                  endpoint_type = int(row['endpoint_type']),
-                                  walltime = float(row['walltime']),
-                                  cputime = float(row['cputime']),
-                                  weight = float(row['weight']))
+            restarts = None
+            if file_version == 8:
+                # One reference serves every segment continuing from the previous iteration;
+                # only segments starting from initial states need their own region reference
+                restarts = numpy.empty((n_segs,), dtype=numpy.object_)
+                continues = (parent_ids >= 0)
+                if continues.any():
+                    try:
+                        parent_ref = self.get_iter_group(n_iter-1)['auxdata'].ref
+                    except KeyError:
+                        parent_ref = None
+                    for iseg in numpy.flatnonzero(continues):
+                        restarts[iseg] = parent_ref
+                if not continues.all():
+                    istate_index = self.find_ibstate_group(n_iter)['istate_index']
+                    for iseg in numpy.flatnonzero(~continues):
+                        restarts[iseg] = istate_index.regionref[-(long(parent_ids[iseg])+1)]
+
+            return SegmentTable(n_iter,
+                                weights=seg_index_entries['weight'],
+                                parent_ids=parent_ids,
+                                seg_ids=seg_ids,
+                                status=seg_index_entries['status'],
+                                endpoint_types=seg_index_entries['endpoint_type'],
+                                walltimes=seg_index_entries['walltime'],
+                                cputimes=seg_index_entries['cputime'],
+                                pcoords=pcoords if load_pcoords else None,
+                                wtg_offsets=wtg_offsets,
+                                wtg_parent_ids=wtg_parent_ids,
+                                restarts=restarts)
 
-                if load_pcoords:
-                    segment.pcoord = pcoord_entries[iseg]
+    def get_segments(self, n_iter=None, seg_ids=None, load_pcoords = True):
+        '''Return the given (or all) segments from a given iteration.
 
-                if file_version < 5:
-                    wtg_n_parents = row['n_parents']
-                    wtg_offset = row['parents_offset']
-                    wtg_parent_ids = all_parent_ids[wtg_offset:wtg_offset+wtg_n_parents]
-                    segment.parent_id = long(wtg_parent_ids[0])
-                else:
-                    wtg_n_parents = row['wtg_n_parents']
-                    wtg_offset = row['wtg_offset']
-                    wtg_parent_ids = all_parent_ids[wtg_offset:wtg_offset+wtg_n_parents]
-                    segment.parent_id = long(row['parent_id'])
-                if self.we_h5file_version == 8:
-                    if segment.parent_id >= 0:
-                        parent_group = self.get_iter_group(n_iter-1)
-                        #segment.restart = parent_group['auxdata/trajectories']['restart'][segment.parent_id]
-                        segment.restart = parent_group['auxdata'].ref
-                        #segment.restart = parent_group['auxdata/trajectories/restart'].ref
-                        #segment.restart = parent_group['auxdata/trajectories'].ref
-                        #segment.ref_function = _read_only_ref_return_
-                        #segment.we_h5filename = self.we_h5filename
-                        #self.h5file = self.we_h5file
-                        #segment.h5file = self.we_h5file
-                    else:
-                        ibstate = self.find_ibstate_group(n_iter)
-                        #segment.restart = ibstate['istate_index'].regionref[(segment.parent_id*-1)-1]
-                        #segment.h5filename = self.h5_file_name
-                        #segment.ref_function = self._read_only_ref_return_
-                        #segment.h5file = self.we_h5file
-                        segment.restart = ibstate['istate_index'].regionref[(segment.parent_id*-1)-1]
-                        #segment.restart = ibstate['istate_index']['restart'][(segment.parent_id*-1)-1]
-                segment.wtg_parent_ids = set(imap(long,wtg_parent_ids))
-                assert len(segment.wtg_parent_ids) == wtg_n_parents
-                segments.append(segment)
-            del all_parent_ids
-            if load_pcoords:
-                del pcoord_entries
+        If the optional parameter ``load_auxdata`` is true, then all auxiliary datasets
+        available are loaded and mapped onto the ``data`` dictionary of each segment. If
+        ``load_auxdata`` is None, then use the default ``self.auto_load_auxdata``, which can
+        be set by the option ``load_auxdata`` in the ``[data]`` section of ``west.cfg``. This
+        essentially requires as much RAM as there is per-iteration auxiliary data, so this
+        behavior is not on by default.
+
+        This is a thin wrapper around ``get_segment_table``; code which can operate on
+        arrays should use that instead.'''
+
+        n_iter = n_iter or self.current_iteration
+
+        with self.lock:
+            segment_table = self.get_segment_table(n_iter, seg_ids, load_pcoords)
+            segments = list(segment_table)
 
             # If any other data sets are requested, load them as well
+            iter_group = self.get_iter_group(n_iter)
             for dsinfo in self.dataset_options.itervalues():
                 if dsinfo.get('load', False):
                     dsname = dsinfo['name']
                     ds = iter_group[dsinfo['h5path']]
-                    for (seg_id, segment) in enumerate(segments):
-                        segment.data[dsname] = ds[seg_id]
+                    for segment in segments:
+                        segment.data[dsname] = ds[segment.seg_id]
 
         return segments
 
     def get_all_parent_ids(self, n_iter):
-        file_version = self.we_h5file_version
-        with self.lock:
-            iter_group = self.get_iter_group(n_iter)
-            seg_index = iter_group['seg_index']
-
-            if file_version < 5:
-                offsets = seg_index['parents_offset']
-                all_parents = iter_group['parents'][...]
-                return all_parents.take(offsets)
-            else:
-                return seg_index['parent_id']
+        return self.get_seg_index_field(n_iter, 'parent_id')
 
     def get_parent_ids(self, n_iter, seg_ids=None):
         '''Return a sequence of the parent IDs of the given seg_ids.'''
 
-        file_version = self.we_h5file_version
-
-        with self.lock:
-            iter_group = self.get_iter_group(n_iter)
-            seg_index = iter_group['seg_index']
-
-            if seg_ids is None:
-                seg_ids = xrange(len(seg_index))
-
-            if file_version < 5:
-                offsets = seg_index['parents_offset']
-                all_parents = iter_group['parents'][...]
-                return [all_parents[offsets[seg_id]] for seg_id in seg_ids]
-            else:
-                all_parents = seg_index['parent_id']
-                return [all_parents[seg_id] for seg_id in seg_ids]
+        all_parents = self.get_seg_index_field(n_iter, 'parent_id')
+        if seg_ids is None:
+            seg_ids = xrange(len(all_parents))
+        return [all_parents[seg_id] for seg_id in seg_ids]
 
     def get_weights(self, n_iter, seg_ids):
         '''Return the weights associated with the given seg_ids'''
 
-        unique_ids = sorted(set(seg_ids))
-        if not unique_ids:
-            return []
-        with self.lock:
-            iter_group = self.get_iter_group(n_iter)
-            index_subset = iter_group['seg_index'][unique_ids]
-            weight_map = dict(izip(unique_ids, index_subset['weight']))
-            return [weight_map[seg_id] for seg_id in seg_ids]
+        all_weights = self.get_seg_index_field(n_iter, 'weight')
+        return [all_weights[seg_id] for seg_id in seg_ids]
 
     def get_child_ids(self, n_iter, seg_id):
         '''Return the seg_ids of segments who have the given segment as a parent.'''
@@ -1190,18 +1693,8 @@ class WESTDataManager:
         with self.lock:
             if n_iter == self.current_iteration: return []
 
-            iter_group = self.get_iter_group(n_iter+1)
-            seg_index = iter_group['seg_index']
-            seg_ids = numpy.arange(len(seg_index), dtype=seg_id_dtype)
-
-            if self.we_h5file_version < 5:
-                offsets = seg_index['parents_offset']
-                all_parent_ids = iter_group['parents'][...]
-                parent_ids = numpy.array([all_parent_ids[offset] for offset in offsets])
-            else:
-                parent_ids = seg_index['parent_id']
-
-            return seg_ids[parent_ids == seg_id]
+            parent_ids = self.get_seg_index_field(n_iter+1, 'parent_id')
+            return numpy.flatnonzero(parent_ids == seg_id).astype(seg_id_dtype)
 
     def get_children(self, segment):
         '''Return all segments which have the given segment as a parent'''
@@ -1214,19 +1707,13 @@ class WESTDataManager:
         # gives the primary parent ID
 
         with self.lock:
-            iter_group = self.get_iter_group(segment.n_iter+1)
-            seg_index = iter_group['seg_index'][...]
-
             # This is one of the slowest pieces of code I've ever written...
             #seg_index = iter_group['seg_index'][...]
             #seg_ids = [seg_id for (seg_id,row) in enumerate(seg_index)
             #           if all_parent_ids[row['parents_offset']] == segment.seg_id]
             #return self.get_segments_by_id(segment.n_iter+1, seg_ids)
-            if self.we_h5file_version < 5:
-                parents = iter_group['parents'][seg_index['parent_offsets']]
-            else:
-                parents = seg_index['parent_id']
-            all_seg_ids = numpy.arange(seg_index.len(), dtype=numpy.uintp)
+            parents = self.get_seg_index_field(segment.n_iter+1, 'parent_id')
+            all_seg_ids = numpy.arange(len(parents), dtype=numpy.uintp)
             seg_ids = all_seg_ids[parents == segment.seg_id]
             # the above will return a scalar if only one is found, so convert
             # to a list if necessary
@@ -1244,42 +1731,18 @@ class WESTDataManager:
     def finalize_run(self):
         self.flush_backing()
         self.close_backing()
+        close_restart_files()
 
     def save_new_weight_data(self, n_iter, new_weights):
-        '''Save a set of NewWeightEntry objects to HDF5. Note that this should
-        be called for the iteration in which the weights appear in their
-        new locations (e.g. for recycled walkers, the iteration following
-        recycling).'''
+        '''Save new weight data (a NewWeightTable, or a sequence of NewWeightEntry objects) to HDF5.
+        Note that this should be called for the iteration in which the weights appear in their
+        new locations (e.g. for recycled walkers, the iteration following recycling).'''
 
         if not new_weights:
             return
 
-        system = westpa.rc.get_system_driver()
-
-        index = numpy.empty(len(new_weights), dtype=nw_index_dtype)
-        prev_init_pcoords = system.new_pcoord_array(len(new_weights))
-        prev_final_pcoords = system.new_pcoord_array(len(new_weights))
-        new_init_pcoords = system.new_pcoord_array(len(new_weights))
-
-        for ientry, nwentry in enumerate(new_weights):
-            row = index[ientry]
-            row['source_type'] = nwentry.source_type
-            row['weight'] = nwentry.weight
-            row['prev_seg_id'] = nwentry.prev_seg_id
-            # the following use -1 as a sentinel for a missing value
-            row['target_state_id'] = nwentry.target_state_id if nwentry.target_state_id is not None else -1
-            row['initial_state_id'] = nwentry.initial_state_id if nwentry.initial_state_id is not None else -1
-
-            index[ientry] = row
-
-            if nwentry.prev_init_pcoord is not None:
-                prev_init_pcoords[ientry] = nwentry.prev_init_pcoord
-
-            if nwentry.prev_final_pcoord is not None:
-                prev_final_pcoords[ientry] = nwentry.prev_final_pcoord
-
-            if nwentry.new_init_pcoord is not None:
-                new_init_pcoords[ientry] = nwentry.new_init_pcoord
+        if not isinstance(new_weights, NewWeightTable):
+            new_weights = NewWeightTable.from_entries(new_weights, westpa.rc.get_system_driver())
 
         with self.lock:
             iter_group = self.get_iter_group(n_iter)
@@ -1289,12 +1752,43 @@ class WESTDataManager:
                 pass
 
             nwgroup = iter_group.create_group('new_weights')
-            nwgroup['index'] = index
-            nwgroup['prev_init_pcoord'] = prev_init_pcoords
-            nwgroup['prev_final_pcoord'] = prev_final_pcoords
-            nwgroup['new_init_pcoord'] = new_init_pcoords
+            nwgroup['index'] = new_weights.index
+            nwgroup['prev_init_pcoord'] = new_weights.prev_init_pcoords
+            nwgroup['prev_final_pcoord'] = new_weights.prev_final_pcoords
+            nwgroup['new_init_pcoord'] = new_weights.new_init_pcoords
+
+    def save_bin_flux_matrix(self, n_iter, triplets, nbins):
+        '''Save the bin-to-bin fluxes and transition counts observed in iteration ``n_iter``, given
+        as ``(rows, cols, fluxes, counts)`` triplets among ``nbins`` bins, in the
+        ``bin_flux_matrix`` group of the iteration.'''
+        (rows, cols, fluxes, counts) = triplets
+        with self.lock:
+            iter_group = self.get_iter_group(n_iter)
+            for key in ['bin_ntrans', 'bin_fluxes', 'bin_flux_matrix']:
+                try:
+                    del iter_group[key]
+                except KeyError:
+                    pass
+            h5io.write_flux_matrix(iter_group.create_group('bin_flux_matrix'), rows, cols, fluxes, counts, nbins,
+                                   compression=(9 if len(rows) >= 1024 else None))
+
+    def get_bin_flux_matrix(self, n_iter):
+        '''Return the bin-to-bin fluxes and transition counts for iteration ``n_iter`` as
+        ``(rows, cols, fluxes, counts, shape)``, reading either the sparse form or the dense
+        ``bin_fluxes`` and ``bin_ntrans`` matrices written by earlier versions of WESTPA.'''
+        with self.lock:
+            iter_group = self.get_iter_group(n_iter)
+            try:
+                return h5io.read_flux_matrix(iter_group['bin_flux_matrix'])
+            except KeyError:
+                fluxes = iter_group['bin_fluxes'][...]
+                counts = iter_group['bin_ntrans'][...]
+        (rows, cols) = numpy.nonzero(counts)
+        return (rows, cols, fluxes[rows, cols], counts[rows, cols], fluxes.shape)
 
     def get_new_weight_data(self, n_iter):
+        '''Return the new weight data stored for iteration ``n_iter`` as a NewWeightTable
+        (or an empty list, if there is none).'''
         with self.lock:
             iter_group = self.get_iter_group(n_iter)
 
@@ -1311,30 +1805,21 @@ class WESTDataManager:
             except (KeyError,ValueError): #zero-length selections raise ValueError
                 return []
 
-        entries = []
-        for i in xrange(len(index)):
-            irow = index[i]
-
-            prev_seg_id = irow['prev_seg_id']
-            if prev_seg_id == -1: prev_seg_id = None
-
-            initial_state_id = irow['initial_state_id']
-            if initial_state_id == -1: initial_state_id = None
+        return NewWeightTable(index, prev_init_pcoords, prev_final_pcoords, new_init_pcoords)
 
-            target_state_id = irow['target_state_id']
-            if target_state_id == -1: target_state_id = None
+    def _reset_bin_mapper_rows(self):
+        self._bin_mapper_rows = {}
+        self._bin_mapper_rows_scanned = 0
 
-            entry = NewWeightEntry(source_type=irow['source_type'],
-                                   weight=irow['weight'],
-                                   prev_seg_id=prev_seg_id,
-                                   prev_init_pcoord=prev_init_pcoords[i].copy(),
-                                   prev_final_pcoord=prev_final_pcoords[i].copy(),
-                                   new_init_pcoord=new_init_pcoords[i].copy(),
-                                   target_state_id=target_state_id,
-                                   initial_state_id=initial_state_id)
-
-            entries.append(entry)
-        return entries
+    def _scan_bin_mapper_index(self, index):
+        '''Add any rows of the binning index not yet seen to the in-memory hash->row map.
+        The index is only ever appended to, so each row is read once while the file is open.'''
+        n_entries = len(index)
+        n_scanned = self._bin_mapper_rows_scanned
+        if n_entries > n_scanned:
+            for (irow, rowhash) in enumerate(index[n_scanned:n_entries]['hash'], n_scanned):
+                self._bin_mapper_rows.setdefault(rowhash, irow)
+            self._bin_mapper_rows_scanned = n_entries
 
     def find_bin_mapper(self, hashval):
         '''Check to see if the given has value is in the binning table. Returns the index in the
@@ -1346,6 +1831,11 @@ class WESTDataManager:
             pass
 
         with self.lock:
+            try:
+                return self._bin_mapper_rows[hashval]
+            except KeyError:
+                pass
+
             # these will raise KeyError if the group doesn't exist, which also means
             # that bin data is not available, so no special treatment here
             try:
@@ -1354,19 +1844,14 @@ class WESTDataManager:
             except KeyError:
                 raise KeyError('hash {} not found'.format(hashval))
 
-            n_entries = len(index)
-            if n_entries == 0:
+            # Pick up rows written since the map was last updated (e.g. by another
+            # process, when following a file being written)
+            self._scan_bin_mapper_index(index)
+            try:
+                return self._bin_mapper_rows[hashval]
+            except KeyError:
                 raise KeyError('hash {} not found'.format(hashval))
 
-            chunksize = self.table_scan_chunksize
-            for istart in xrange(0,n_entries,chunksize):
-                chunk = index[istart:min(istart+chunksize,n_entries)]
-                for i in xrange(len(chunk)):
-                    if chunk[i]['hash'] == hashval:
-                        return istart+i
-
-            raise KeyError('hash {} not found'.format(hashval))
-
     def get_bin_mapper(self,  hashval):
         '''Look up the given hash value in the binning table, unpickling and returning the corresponding
         bin mapper if available, or raising KeyError if not.'''
@@ -1378,32 +1863,14 @@ class WESTDataManager:
             pass
 
         with self.lock:
-            # these will raise KeyError if the group doesn't exist, which also means
-            # that bin data is not available, so no special treatment here
-            try:
-                binning_group = self.we_h5file['/bin_topologies']
-                index = binning_group['index']
-                pkl = binning_group['pickles']
-            except KeyError:
-                raise KeyError('hash {} not found. Could not retrieve binning group'.format(hashval))
-
-            n_entries = len(index)
-            if n_entries == 0:
-                raise KeyError('hash {} not found. No entries in index'.format(hashval))
-
-            chunksize = self.table_scan_chunksize
-
-            for istart in xrange(0, n_entries, chunksize):
-                chunk = index[istart:min(istart+chunksize, n_entries)]
-                for i in xrange(len(chunk)):
-                    if chunk[i]['hash'] == hashval:
-                        pkldat = bytes(pkl[istart+i, 0:chunk[i]['pickle_len']].data)
-                        mapper = pickle.loads(pkldat)
-                        log.debug('loaded {!r} from {!r}'.format(mapper, binning_group))
-                        log.debug('hash value {!r}'.format(hashval))
-                        return mapper
-
-            raise KeyError('hash {} not found'.format(hashval))
+            irow = self.find_bin_mapper(hashval)
+            binning_group = self.we_h5file['/bin_topologies']
+            pickle_len = binning_group['index'][irow]['pickle_len']
+            pkldat = bytes(binning_group['pickles'][irow, 0:pickle_len].data)
+            mapper = pickle.loads(pkldat)
+            log.debug('loaded {!r} from {!r}'.format(mapper, binning_group))
+            log.debug('hash value {!r}'.format(hashval))
+            return mapper
 
     def save_bin_mapper(self, hashval, pickle_data):
         '''Store the given mapper in the table of saved mappers. If the mapper cannot be stored,
@@ -1445,6 +1912,7 @@ class WESTDataManager:
             index_row['pickle_len'] = len(pickle_data)
             index[n_entries-1] = index_row
             pickle_ds[n_entries-1,:len(pickle_data)] = memoryview(pickle_data)
+            self._scan_bin_mapper_index(index)
             return n_entries-1
 
     def save_iter_binning(self, n_iter, hashval, pickled_mapper, target_counts):
@@ -1626,6 +2094,62 @@ def require_dataset_from_dsopts(group, dsopts, shape=None, dtype=None, data=None
 
 
 
+def write_aux_data(dset, dsname, segments):
+    '''Write the auxiliary data ``dsname`` of each of the given segments to row ``seg_id`` of
+    ``dset``. Rows are coalesced into a single buffer, sorted by segment ID, and written with one
+    HDF5 call covering a hyperslab per contiguous run of segment IDs. Entries whose shape differs
+    from that of a row of ``dset`` are written individually.'''
+
+    row_shape = dset.shape[1:]
+    row_rank = len(row_shape)
+    batch_ids = []
+    batch_data = []
+
+    for segment in segments:
+        try:
+            auxdataset = segment.data[dsname]
+        except KeyError:
+            continue
+
+        if auxdataset.shape == row_shape:
+            batch_ids.append(segment.seg_id)
+            batch_data.append(auxdataset)
+        else:
+            source_rank = len(auxdataset.shape)
+            source_sel = h5s.create_simple(auxdataset.shape, (h5s.UNLIMITED,)*source_rank)
+            source_sel.select_all()
+            dest_sel = dset.id.get_space()
+            dest_sel.select_hyperslab((segment.seg_id,)+(0,)*source_rank, (1,)+auxdataset.shape)
+            dset.id.write(source_sel, dest_sel, auxdataset)
+
+    if not batch_ids:
+        return
+
+    batch_ids = numpy.array(batch_ids, dtype=seg_id_dtype)
+    order = numpy.argsort(batch_ids, kind='mergesort')
+    batch_ids = batch_ids[order]
+
+    # Stack into one buffer of the on-disk type; for variable-length types this is an object array,
+    # so assign through a (zero-rank) view to store the contents rather than the array itself
+    buffer = numpy.empty((len(batch_ids),)+row_shape, dtype=dset.dtype)
+    for (irow, idata) in enumerate(order):
+        buffer[irow,...] = batch_data[idata]
+    del batch_data
+
+    # One hyperslab per contiguous run of segment IDs
+    run_bounds = numpy.flatnonzero(numpy.diff(batch_ids) != 1) + 1
+    run_starts = numpy.concatenate(([0], run_bounds))
+    run_ends = numpy.concatenate((run_bounds, [len(batch_ids)]))
+
+    dest_sel = dset.id.get_space()
+    for (irun, (istart, iend)) in enumerate(izip(run_starts, run_ends)):
+        op = h5s.SELECT_OR if irun != 0 else h5s.SELECT_SET
+        dest_sel.select_hyperslab((long(batch_ids[istart]),)+(0,)*row_rank, (long(iend-istart),)+row_shape, op=op)
+
+    source_sel = h5s.create_simple(buffer.shape, (h5s.UNLIMITED,)*buffer.ndim)
+    source_sel.select_all()
+    dset.id.write(source_sel, dest_sel, buffer)
+
 
 def calc_chunksize(shape, dtype, max_chunksize=262144):
     '''Calculate a chunk size for HDF5 data, anticipating that access will slice
@@ -1646,5 +2170,146 @@ def calc_chunksize(shape, dtype, max_chunksize=262144):
               .format(chunk_shape, dtype, shape, chunk_nbytes))
     return chunk_shape
 
+def create_aggregate_views(h5file, iter_start, iter_stop, iter_prec=8, group_name='/aggregates'):
+    '''Create (or replace) HDF5 virtual data sets in ``group_name`` of ``h5file`` which present
+    per-iteration data for iterations ``iter_start`` to ``iter_stop-1`` as single arrays, without
+    copying any data. Iteration groups may live in the file itself or in iteration shards linked
+    into it. Two views are created:
+    
+      ``seg_index``
+        The segment index for each iteration, shaped (n_iters, max_segs); weights of a whole
+        run are thus available as ``seg_index['weight']`` in one read.
+      ``final_pcoord``
+        The final progress coordinate of each segment, shaped (n_iters, max_segs, pcoord_ndim).
+        
+    Entries beyond the number of segments in an iteration read as the fill value (zero for
+    ``seg_index``, NaN for ``final_pcoord``). Requires HDF5 1.10 and h5py 2.9 or later.'''
+
+    if not hasattr(h5py, 'VirtualLayout'):
+        raise RuntimeError('aggregate views require virtual data set support (HDF5 1.10 and h5py 2.9 or later)')
+
+    sources = []
+    for n_iter in xrange(iter_start, iter_stop):
+        iter_group_name = '/iterations/iter_{:0{prec}d}'.format(long(n_iter), prec=iter_prec)
+        link = h5file.get(iter_group_name, getlink=True)
+        if isinstance(link, h5py.ExternalLink):
+            (filename, group_path) = (link.filename, link.path)
+        else:
+            # '.' denotes the file containing the virtual data set itself
+            (filename, group_path) = ('.', iter_group_name)
+        iter_group = h5file[iter_group_name]
+        sources.append((filename, group_path, iter_group['seg_index'], iter_group['pcoord']))
+
+    if not sources:
+        raise ValueError('no iterations in range [{}, {})'.format(iter_start, iter_stop))
+
+    n_iters = len(sources)
+    max_segs = max(seg_index.shape[0] for (_f, _g, seg_index, _p) in sources)
+    (_f, _g, seg_index_ds, pcoord_ds) = sources[0]
+    pcoord_ndim = pcoord_ds.shape[2]
+
+    seg_index_layout = h5py.VirtualLayout(shape=(n_iters, max_segs), dtype=seg_index_ds.dtype)
+    final_pcoord_layout = h5py.VirtualLayout(shape=(n_iters, max_segs, pcoord_ndim), dtype=pcoord_ds.dtype)
+    for (iiter, (filename, group_path, seg_index_ds, pcoord_ds)) in enumerate(sources):
+        n_segs = seg_index_ds.shape[0]
+        if not n_segs:
+            continue
+        seg_index_source = h5py.VirtualSource(filename, posixpath.join(group_path, 'seg_index'),
+                                              shape=seg_index_ds.shape, dtype=seg_index_ds.dtype)
+        pcoord_source = h5py.VirtualSource(filename, posixpath.join(group_path, 'pcoord'),
+                                           shape=pcoord_ds.shape, dtype=pcoord_ds.dtype)
+        seg_index_layout[iiter, :n_segs] = seg_index_source
+        final_pcoord_layout[iiter, :n_segs, :] = pcoord_source[:, pcoord_ds.shape[1]-1, :]
+
+    group = h5file.require_group(group_name)
+    for dsname in ('seg_index', 'final_pcoord'):
+        if dsname in group:
+            del group[dsname]
+    group.create_virtual_dataset('seg_index', seg_index_layout)
+    group.create_virtual_dataset('final_pcoord', final_pcoord_layout, fillvalue=numpy.nan)
+    group.attrs['iter_start'] = iter_start
+    group.attrs['iter_stop'] = iter_stop
+    return group
+
+def pack_restart_data(tar_data):
+    '''Wrap raw restart data (an in-memory tar archive) for storage as a scalar entry of
+    type ``vbytes_dtype``, as is expected for data sets on the ``data`` field of segments.'''
+    restart = numpy.empty((), dtype=vbytes_dtype)
+    restart[()] = numpy.frombuffer(tar_data, dtype=numpy.uint8)
+    return restart
+
+def restart_data_bytes(restart):
+    '''Return the raw tar archive held in stored restart data, which may be in either the current
+    (variable-length uint8) format or the legacy format (base64-encoded pickle in a variable-length
+    string). The result supports the buffer interface; no copy is made for the current format.'''
+    if isinstance(restart, numpy.ndarray) and restart.dtype == numpy.object_:
+        restart = restart[()]
+    if isinstance(restart, basestring):
+        return pickle.loads(str(restart).decode('base64'))
+    else:
+        return numpy.asarray(restart, dtype=numpy.uint8)
+
+def restart_data_for_dtype(restart, dtype):
+    '''Return restart data in the representation stored in an HDF5 field or data set of type
+    ``dtype``. This re-encodes restart data in the legacy format when appending to a data set
+    created before restart data was stored as raw bytes.'''
+    if restart is None:
+        return None
+    data = restart_data_bytes(restart)
+    if h5py.check_dtype(vlen=dtype) is str:
+        if not isinstance(data, basestring):
+            data = data.tostring()
+        return pickle.dumps(data, protocol=0).encode('base64')
+    elif isinstance(data, basestring):
+        return numpy.frombuffer(data, dtype=numpy.uint8)
+    else:
+        return data
+
+# SWMR read handles on HDF5 files containing restart data, opened by workers; maps file name
+# to (n_iter, h5py.File) so that files are reopened (and metadata refreshed) each iteration
+_restart_h5files = {}
+
+def close_restart_files():
+    '''Close any handles opened by :meth:`RestartReference.load` in this process.'''
+    while _restart_h5files:
+        (_n_iter, h5file) = _restart_h5files.popitem()[1]
+        h5file.close()
+
+class RestartReference:
+    '''A picklable reference to the restart data for one segment, resolved on the worker with
+    :meth:`load` rather than by the master when segments are dispatched. ``h5path`` names a data set
+    in ``filename``; ``index`` is the row holding the restart data, and ``field`` is the field of that
+    row to read, if any.'''
+
+    def __init__(self, n_iter, filename, h5path, index, field=None):
+        self.n_iter = n_iter
+        self.filename = filename
+        self.h5path = h5path
+        self.index = index
+        self.field = field
+
+    def __repr__(self):
+        return '<{} at 0x{:x}: {}:{}[{}]{}>'.format(self.__class__.__name__, id(self), self.filename, self.h5path, self.index,
+                                                    '[{!r}]'.format(self.field) if self.field else '')
+
+    def load(self):
+        '''Read the referenced restart data, using an SWMR read handle on the containing file which is
+        kept open for the remainder of the iteration (see :func:`close_restart_files`).'''
+        try:
+            (n_iter, h5file) = _restart_h5files[self.filename]
+        except KeyError:
+            n_iter = h5file = None
+
+        if n_iter != self.n_iter:
+            if h5file is not None:
+                h5file.close()
+            h5file = h5io.WESTPAH5File(self.filename, 'r', follow=True)
+            _restart_h5files[self.filename] = (self.n_iter, h5file)
+
+        if self.field:
+            return h5file[self.h5path][self.index][self.field]
+        else:
+            return h5file[self.h5path][self.index]
+
 def _read_only_ref_return_(ref, we_h5file):
     return we_h5file[ref]
@@ -25,6 +25,11 @@ def blocked_iter(blocksize, iterable, fillvalue = None):
     return itertools.izip_longest(fillvalue=fillvalue, *args)
 
 class WESTPropagator:
+    # True if two copies of a propagation task may safely run at the same time, in which case
+    # work managers may speculatively re-execute straggling propagation tasks; subclasses may set
+    # this per instance, according to their configuration
+    allow_speculation = False
+    
     def __init__(self, rc=None):
         
         # For maximum flexibility, the basis states and initial states valid
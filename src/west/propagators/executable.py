@@ -16,7 +16,8 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import os, shutil, sys, signal, random, subprocess, time, tempfile
+import os, re, shutil, sys, signal, random, subprocess, time, tempfile, threading, json, resource, Queue
+import multiprocessing.util
 import numpy
 import logging
 from west.states import BasisState, InitialState
@@ -32,8 +33,9 @@ from westpa.yamlcfg import check_bool, ConfigItemMissing
 import west
 from west import Segment
 from west.propagators import WESTPropagator
+from west.propagators.runner import rusage_fields
 from west import errors
-from west.data_manager import WESTDataManager
+from west.data_manager import WESTDataManager, RestartReference, vbytes_dtype, pack_restart_data, restart_data_bytes
 import tarfile, StringIO, os, io, cStringIO
 import cPickle
 import h5py
@@ -49,6 +51,23 @@ warnings.filterwarnings('ignore', category=RuntimeWarning)
 warnings.filterwarnings('ignore', category=FutureWarning)
 warnings.filterwarnings('ignore', category=UserWarning)
 
+# Formats in which child processes may return progress coordinate and auxiliary data, and the
+# suffixes of the corresponding return files (numpy.save() appends ".npy" to names lacking it)
+return_format_suffixes = {'text': '', 'npy': '.npy'}
+
+def load_return_data(filename, dtype=None):
+    """Load numerical data returned by a child process, in NumPy binary format if ``filename`` ends
+    in ``.npy`` (as written by ``numpy.save()``), and as whitespace-separated text otherwise."""
+    if filename.endswith('.npy'):
+        data = numpy.load(filename)
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+    elif dtype is not None:
+        return numpy.loadtxt(filename, dtype=dtype)
+    else:
+        return numpy.loadtxt(filename)
+
 def pcoord_loader(fieldname, pcoord_return_filename, destobj, single_point, **kwargs):
     """Read progress coordinate data into the ``pcoord`` field on ``destobj``.
     An exception will be raised if the data is malformed.  If ``single_point`` is true,
@@ -61,11 +80,11 @@ def pcoord_loader(fieldname, pcoord_return_filename, destobj, single_point, **kw
     assert fieldname == 'pcoord'
 
     try:
-        pcoord = numpy.loadtxt(pcoord_return_filename, dtype=system.pcoord_dtype)
+        pcoord = load_return_data(pcoord_return_filename, dtype=system.pcoord_dtype)
     except:
         # We failed to properly use numpy loadtxt.  This isn't because it's empty, but because it's probably malformed.
         #error.report_segment_error(error.PCOORD_LOADER_ERROR, segment=destobj, err=error.format_stderr(destobj.err))
-        destojb.error.append(error.report_segment_error(error.LOADTXT_ERROR, dataset=fieldname, segment=destobj, err=error.format_stderr(destobj.err)))
+        destobj.error.append(error.report_segment_error(error.LOADTXT_ERROR, dataset=fieldname, segment=destobj, err=error.format_stderr(destobj.err)))
         #error.raise_exception()
 
 
@@ -181,16 +200,26 @@ def size_format(filesize, n=0):
     if filesize > 1024:
         return size_format(float(filesize)/1024,n=n+1)
 
+restart_compression_modes = {None: 'w:', 'none': 'w:', 'gzip': 'w:gz', 'bz2': 'w:bz2'}
+
 def restart_input(fieldname, coord_file, segment, single_point):
-    # See http://docs.h5py.org/en/latest/strings.html
     # It's actually a directory, in this case.
-    # We load and tar in memory, then pickle as a string, which is stored in the HDF5 file as a variable length string to ensure data integrity.
-    # We're specifying the string encoding to ensure platform consistency.
+    # We tar it in memory (compressing the stream if west.executable.restart_compression is set),
+    # and store the raw archive as a variable length uint8 array.  No pickling or encoding is
+    # necessary, and tarfile detects the compression on the way back out.
+    compression = westpa.rc.config.get(['west', 'executable', 'restart_compression'], None)
+    try:
+        tar_mode = restart_compression_modes[compression]
+    except KeyError:
+        raise ValueError('invalid restart compression {!r}; choose one of none, gzip, or bz2'.format(compression))
     d = io.BytesIO()
-    t = tarfile.open(mode='w:', fileobj=d)
+    t = tarfile.open(mode=tar_mode, fileobj=d)
     t.add(coord_file, arcname='.')
+    n_members = len(t.getmembers())
+    # The archive must be closed before it is complete (and, if compressed, flushed).
+    t.close()
     # If it's greater than 2 MB, maybe log a warning.
-    tarsize = len(d.getvalue())
+    tarsize = d.tell()
     itarsize = 2*1024*1024
     try:
         # Just for convenient formatting of basis/istates.
@@ -202,14 +231,13 @@ def restart_input(fieldname, coord_file, segment, single_point):
         #log.warning('{fieldname} has a filesize of {tarsize}; this may result in RAM intensive WESTPA runs.'.format(fieldname=fieldname,tarsize=size_format(tarsize)))
         segment.error.append(error.report_segment_error(error.LARGE_RESTART, segment=segment, size=size_format(tarsize), see_wiki=False))
         #error.report_general_error_once(error.LARGE_RESTART, segment=segment, size=size_format(tarsize), see_wiki=False)
-    if len(t.getmembers()) <= 1:
+    if n_members <= 1:
         #log.warning('You have not supplied any {} data.  Disable restarts in your config file to remove this warning.'.format(fieldname))
         segment.error.append(error.report_segment_error(error.EMPTY_RESTART, segment=segment, see_wiki=False))
         #error.report_general_error_once(error.EMPTY_RESTART, segment=segment, see_wiki=False)
         #del(segment.data['trajectories/{}'.format(fieldname)])
     else:
-        segment.data['trajectories/{}'.format(fieldname)] = numpy.array(cPickle.dumps((d.getvalue()), protocol=0).encode('base64'), dtype=vvoid_dtype)
-    t.close()
+        segment.data['trajectories/{}'.format(fieldname)] = pack_restart_data(d.getvalue())
     d.close()
     del(d,t)
     #log.debug('{fieldname} with size {tarsize} for seg_id {segment.seg_id} successfully loaded in iter {segment.n_iter}.'.format(segment=segment, fieldname=fieldname, tarsize=tarsize))
@@ -224,13 +252,17 @@ def restart_input(fieldname, coord_file, segment, single_point):
 
 
 def restart_output(tarball, segment):
-    # See http://docs.h5py.org/en/latest/strings.html
-    # We 'recreate' the tarball by decoding, unpickling, and then loading it up as a file object in memory.
+    # We load the stored tarball up as a file object in memory; restart data stored in the older
+    # format (base64-encoded pickles) is decoded first.
     # We then untar to the location specified, and delete the restart data on the segment (as it is rather memory intensive).
 
     # print(segment.restart)
-    e = io.BytesIO(cPickle.loads(str(segment.restart).decode('base64')))
-    with tarfile.open(fileobj=e, mode='r:') as t:
+    restart = segment.restart
+    if isinstance(restart, RestartReference):
+        # The master sent only a reference (west.propagation.lazy_restarts); read the data ourselves.
+        restart = restart.load()
+    e = io.BytesIO(buffer(restart_data_bytes(restart)))
+    with tarfile.open(fileobj=e, mode='r:*') as t:
         t.extractall(path=tarball)
     del(segment.restart)
     log.debug('Restart for seg_id {segment.seg_id} successfully untarred in iter {segment.n_iter} .'.format(segment=segment))
@@ -239,7 +271,7 @@ def restart_output(tarball, segment):
     del(e,t)
 
 def aux_data_loader(fieldname, data_filename, segment, single_point):
-    data = numpy.loadtxt(data_filename)
+    data = load_return_data(data_filename)
     if data.nbytes == 0:
         #raise ValueError('could not read any data for {}'.format(fieldname))
         # We may wish to enable an environment in which everything is handled within python.
@@ -254,6 +286,153 @@ def aux_data_loader(fieldname, data_filename, segment, single_point):
         segment.data[fieldname] = data
 
 
+class PersistentRunner:
+    '''A long-lived child process to which segments are sent one at a time, using the protocol
+    described in ``west.propagators.runner``. The child is started on first use, and restarted
+    if it exits.'''
+
+    def __init__(self, executable, environ=None, cwd=None):
+        self.executable = executable
+        self.environ = environ
+        self.cwd = cwd
+        self.proc = None
+
+    def __repr__(self):
+        return '<{} {!r} at 0x{:x}>'.format(self.__class__.__name__, self.executable, id(self))
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.proc = subprocess.Popen([self.executable], cwd=self.cwd, env=self.environ,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        log.debug('started persistent runner {!r} (pid {:d})'.format(self.executable, self.proc.pid))
+
+    def run(self, request):
+        '''Send the given request to the runner and wait for its reply, returning (rc, rusage, err)
+        as for ``ExecutablePropagator.exec_child()``.'''
+        if not self.running:
+            self.start()
+
+        try:
+            self.proc.stdin.write(json.dumps(request) + '\n')
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        except IOError:
+            line = ''
+
+        if not line:
+            # The runner died; report the failure of this segment, and start a new runner next time
+            rc = self.proc.wait()
+            self.proc = None
+            err = 'persistent runner {!r} exited with code {!r}'.format(self.executable, rc)
+            log.error(err)
+            return (rc or 1, resource.struct_rusage((0,)*len(rusage_fields)), err)
+
+        reply = json.loads(line)
+        reply_rusage = reply.get('rusage') or {}
+        rusage = resource.struct_rusage(tuple(reply_rusage.get(field, 0) for field in rusage_fields))
+        return (int(reply['rc']), rusage, reply.get('err') or '')
+
+    def close(self, timeout=5.0):
+        '''Close the runner's input, waiting up to ``timeout`` seconds for it to exit before
+        killing it.'''
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        deadline = time.time() + timeout
+        while self.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if self.proc.poll() is None:
+            log.warning('killing persistent runner {!r} (pid {:d})'.format(self.executable, self.proc.pid))
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+
+class ScratchDirectory:
+    '''A per-process directory (normally on a memory-backed tmpfs such as /dev/shm) holding the files
+    in which child processes return data, so that creating and removing them costs no metadata
+    operations on a (possibly networked) temporary directory. Each segment being propagated gets a
+    slot, a subdirectory reused from segment to segment; slots are emptied by a background thread
+    once the segments using them are finished.'''
+
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir
+        self.root = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        # The propagator may be created before worker processes are forked, so the directory (and
+        # cleanup thread) are created on first use in each process
+        self.root = tempfile.mkdtemp(prefix='west-scratch-', dir=self.base_dir)
+        self.pid = os.getpid()
+        self.free_slots = []
+        self.n_slots = 0
+        self.cleanup_queue = Queue.Queue()
+        self.cleanup_thread = threading.Thread(target=self._cleanup_loop, name='scratch cleanup')
+        self.cleanup_thread.daemon = True
+        self.cleanup_thread.start()
+        # Unlike atexit handlers, this also runs when multiprocessing workers exit
+        multiprocessing.util.Finalize(self, shutil.rmtree, args=(self.root,), kwargs={'ignore_errors': True},
+                                      exitpriority=10)
+        log.debug('using scratch directory {!r}'.format(self.root))
+
+    def owns(self, path):
+        return self.root is not None and path.startswith(self.root + os.sep)
+
+    def acquire_slot(self):
+        '''Return the path of an empty directory for the return files of one segment.'''
+        with self.lock:
+            if self.pid != os.getpid():
+                self._start()
+            if self.free_slots:
+                return self.free_slots.pop()
+            self.n_slots += 1
+            slot = os.path.join(self.root, 'slot{:d}'.format(self.n_slots))
+        os.mkdir(slot)
+        return slot
+
+    def release_slot(self, slot):
+        '''Schedule the given slot to be emptied and reused.'''
+        self.cleanup_queue.put(slot)
+
+    def _empty_slot(self, slot):
+        '''Delete the contents of the given slot, returning True if it is now empty.'''
+        emptied = True
+        for name in os.listdir(slot):
+            path = os.path.join(slot, name)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            except Exception as e:
+                log.warning('could not delete scratch file {!r}: {!r}'.format(path, e))
+                emptied = False
+        return emptied
+
+    def _cleanup_loop(self):
+        while True:
+            slot = self.cleanup_queue.get()
+            try:
+                emptied = self._empty_slot(slot)
+            except Exception as e:
+                log.warning('could not empty scratch slot {!r}: {!r}'.format(slot, e))
+                emptied = False
+            if emptied:
+                with self.lock:
+                    self.free_slots.append(slot)
+            else:
+                # Leftover files could be mistaken for another segment's data, so the slot is not reused
+                log.warning('not reusing scratch slot {!r}'.format(slot))
+
+
 class ExecutablePropagator(WESTPropagator):
     ENV_CURRENT_ITER         = 'WEST_CURRENT_ITER'
 
@@ -275,9 +454,13 @@ class ExecutablePropagator(WESTPropagator):
 
     # Set everywhere a progress coordinate is required
     ENV_PCOORD_RETURN        = 'WEST_PCOORD_RETURN'
+    ENV_PCOORD_RETURN_FORMAT = 'WEST_PCOORD_RETURN_FORMAT'
     ENV_TRAJECTORY_RETURN    = 'WEST_TRAJECTORY_RETURN'
     ENV_RESTART_RETURN       = 'WEST_RESTART_RETURN'
 
+    # Set for multi-segment ("gang") invocations of the propagator
+    ENV_SEGMENT_MANIFEST     = 'WEST_SEGMENT_MANIFEST'
+
     ENV_RAND16               = 'WEST_RAND16'
     ENV_RAND32               = 'WEST_RAND32'
     ENV_RAND64               = 'WEST_RAND64'
@@ -300,6 +483,18 @@ class ExecutablePropagator(WESTPropagator):
         self.exe_info['get_pcoord'] = {}
         self.exe_info['gen_istate'] = {}
 
+        # Idle persistent runners, indexed by runner executable, and the process which started them
+        self.runners = {}
+        self.runner_lock = threading.Lock()
+        self._runners_pid = None
+
+        # Number of segments in a block to propagate at once, the pool of threads doing so, and
+        # the process which started them
+        self.segment_concurrency = 1
+        self._segment_pool = None
+        self._segment_pool_pid = None
+        self._segment_pool_lock = threading.Lock()
+
         # A mapping of data set name ('pcoord', 'coord', 'com', etc) to a dictionary of
         # attributes like 'loader', 'dtype', etc
         # We want the pcoord last in this case, so ordereddict it is!
@@ -343,6 +538,28 @@ class ExecutablePropagator(WESTPropagator):
         else:
             do_restart = True
 
+        # Default format in which progress coordinate and auxiliary data are returned
+        self.return_format = config.get(['west', 'executable', 'return_format'], 'text')
+
+        # Where return files are created: 'tempfile' (individually, with the tempfile module) or 'tmpfs'
+        # (in a per-process scratch directory, by default in /dev/shm, reused across segments)
+        scratch = config.get(['west', 'executable', 'scratch'], 'tempfile')
+        if scratch == 'tmpfs':
+            scratch_dir = config.get(['west', 'executable', 'scratch_dir'])
+            if scratch_dir:
+                scratch_dir = os.path.expandvars(os.path.expanduser(scratch_dir))
+            elif os.path.isdir('/dev/shm'):
+                scratch_dir = '/dev/shm'
+            self.scratch = ScratchDirectory(scratch_dir)
+        elif scratch in (None, 'tempfile'):
+            self.scratch = None
+        else:
+            raise ValueError('invalid scratch backend {!r}; choose tempfile or tmpfs'.format(scratch))
+
+        self.segment_concurrency = int(config.get(['west', 'executable', 'propagator', 'concurrency'], 1) or 1)
+        if self.segment_concurrency < 1:
+            raise ValueError('invalid propagator concurrency {!r}'.format(self.segment_concurrency))
+
         # Load additional environment variables for all child processes
         self.addtl_child_environ.update({k:str(v) for k,v in (config['west','executable','environ'] or {}).iteritems()})
 
@@ -364,6 +581,15 @@ class ExecutablePropagator(WESTPropagator):
             self.exe_info[child_type]['stderr'] = child_info.get('stderr', None)
             self.exe_info[child_type]['cwd'] = child_info.get('cwd', None)
 
+            # A persistent runner, to which segments are sent instead of starting the executable
+            # for each one (see west.propagators.runner)
+            self.exe_info[child_type]['runner'] = child_info.get('runner', None) if child_type == 'propagator' else None
+
+            # Run the propagator once for all segments in a block, describing them in a manifest
+            gang = child_info.get('gang', False) if child_type == 'propagator' else False
+            check_bool(gang)
+            self.exe_info[child_type]['gang'] = bool(gang)
+
             if child_type not in ('propagator', 'get_pcoord', 'gen_istate'):
                 self.exe_info[child_type]['enabled'] = child_info.get('enabled',True)
             else:
@@ -394,7 +620,7 @@ class ExecutablePropagator(WESTPropagator):
                                     'delram': True,
                                     'enabled': do_restart,
                                     'filename': None,
-                                    'dtype': h5py.new_vlen(str)}
+                                    'dtype': vbytes_dtype}
         dataset_configs = config.get(['west', 'executable', 'datasets']) or []
         for dsinfo in dataset_configs:
             loader = None
@@ -422,8 +648,26 @@ class ExecutablePropagator(WESTPropagator):
             self.data_info.setdefault(dsname,{}).update(dsinfo)
             del(loader)
 
+        # Progress coordinate and auxiliary data (but not trajectories or restarts) may be returned
+        # in any of the formats in return_format_suffixes
+        for dsname, dsinfo in self.data_info.iteritems():
+            if dsname in ('trajectory', 'restart'):
+                continue
+            dsinfo.setdefault('format', self.return_format)
+            if dsinfo['format'] not in return_format_suffixes:
+                raise ValueError('invalid return format {!r} for dataset {!r}; choose one of {}'
+                                 .format(dsinfo['format'], dsname, ', '.join(sorted(return_format_suffixes))))
+
         log.debug('data_info: {!r}'.format(self.data_info))
 
+        # Each copy of a segment runs in a private directory (see prepare_file_system()), and returns
+        # its data to the master, which keeps the result of the copy that finishes first; so work managers
+        # may run a second copy of a straggling segment, unless segment directories are kept as data
+        # references or some data set is returned in a file named after the segment
+        self.allow_speculation = bool(self.cleanup) and not any(dsinfo.get('enabled') and dsinfo.get('filename')
+                                                                for dsinfo in self.data_info.itervalues())
+        log.debug('speculative propagation {}allowed'.format('' if self.allow_speculation else 'not '))
+
     @staticmethod
     def makepath(template, template_args = None,
                   expanduser = True, expandvars = True, abspath = False, realpath = False):
@@ -477,7 +721,7 @@ class ExecutablePropagator(WESTPropagator):
 
         # Wait on child and get resource usage
         # Oddly, we never fail with 0 as the integer option.  Need to look into this more.
-        (_pid, _status, rusage) = os.wait4(proc.pid, 0)
+        (_pid, status, rusage) = os.wait4(proc.pid, 0)
         # Do a subprocess.Popen.wait() to let the Popen instance (and subprocess module) know that
         # we are done with the process, and to get a more friendly return code
         #rc = proc.wait()
@@ -497,14 +741,65 @@ class ExecutablePropagator(WESTPropagator):
             else:
                 stdout.write('\n\n\n' + error.linebreak + ' STDERR ' + error.linebreak + '\n\n\n')
                 stdout.write(err)
-        rc = proc.returncode
+        # The child has already been reaped by os.wait4(), so proc.returncode is meaningless
+        rc = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
         #return (rc, rusage, "\n        ".join(err.splitlines()[-10:]))
         #return (rc, rusage, "\n        ".join(err.splitlines()[-10:]))
         return (rc, rusage, "\n".join(err.splitlines()[-10:]))
 
+    def acquire_runner(self, executable):
+        '''Get an idle persistent runner for the given executable, creating one if necessary.'''
+        with self.runner_lock:
+            if self._runners_pid != os.getpid():
+                # Runners inherited from the process that forked this one belong to that process. Those
+                # started here are shut down when it exits; unlike atexit handlers, this also happens
+                # in multiprocessing workers.
+                self.runners = {}
+                self._runners_pid = os.getpid()
+                multiprocessing.util.Finalize(self, self.shutdown_runners, exitpriority=10)
+            idle = self.runners.setdefault(executable, [])
+            if idle:
+                return idle.pop()
+        all_environ = dict(os.environ)
+        all_environ.update(self.addtl_child_environ)
+        return PersistentRunner(executable, environ=all_environ)
+
+    def release_runner(self, runner):
+        with self.runner_lock:
+            self.runners.setdefault(runner.executable, []).append(runner)
+
+    def shutdown_runners(self):
+        '''Shut down all idle persistent runners.'''
+        with self.runner_lock:
+            runners = [runner for idle in self.runners.itervalues() for runner in idle]
+            self.runners = {}
+        for runner in runners:
+            runner.close()
+
+    def exec_runner(self, child_info, template_args, environ):
+        '''Send a request to run the executable described by ``child_info`` to a persistent runner,
+        returning (rc, rusage, err) as for ``exec_child()``. Only the variables which would have been
+        added to the current environment are sent; the runner already has the rest.'''
+        request_environ = dict(self.addtl_child_environ)
+        request_environ.update(self.random_val_env_vars())
+        request_environ.update(environ)
+        request = {'executable': self.makepath(child_info['executable'], template_args),
+                   'environ': request_environ,
+                   'cwd': self.makepath(child_info['cwd'], template_args) if child_info['cwd'] else None,
+                   'stdout': self.makepath(child_info['stdout'], template_args) if child_info['stdout'] else None,
+                   'stderr': self.makepath(child_info['stderr'], template_args) if child_info['stderr'] else None}
+
+        runner = self.acquire_runner(self.makepath(child_info['runner'], template_args))
+        try:
+            return runner.run(request)
+        finally:
+            self.release_runner(runner)
+
     def exec_child_from_child_info(self, child_info, template_args, environ):
         for (key, value) in child_info.get('environ', {}).iteritems():
             environ[key] = self.makepath(value)
+        if child_info.get('runner'):
+            return (environ, self.exec_runner(child_info, template_args, environ))
         return (environ, self.exec_child(executable = self.makepath(child_info['executable'], template_args),
                                environ = environ,
                                cwd = self.makepath(child_info['cwd'], template_args) if child_info['cwd'] else None,
@@ -598,6 +893,20 @@ class ExecutablePropagator(WESTPropagator):
         return self.exec_child_from_child_info(child_info, template_args, environ)
 
     def prepare_file_system(self, child_info, segment, environ):
+        if self.allow_speculation:
+            # Another copy of this segment may be running, so this one gets a directory of its own,
+            # named after the segment's
+            data_ref = environ[self.ENV_CURRENT_SEG_DATA_REF]
+            try:
+                os.makedirs(os.path.dirname(data_ref))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(data_ref)):
+                    raise
+            environ[self.ENV_CURRENT_SEG_DATA_REF] = tempfile.mkdtemp(prefix=os.path.basename(data_ref)+'.',
+                                                                     dir=os.path.dirname(data_ref))
+            if self.data_info['restart']['enabled']:
+                restart_output(tarball='{}/'.format(environ[self.ENV_CURRENT_SEG_DATA_REF]), segment=segment)
+            return
         try:
             # If the filesystem is properly clean.
             os.makedirs(environ['WEST_CURRENT_SEG_DATA_REF'])
@@ -611,6 +920,21 @@ class ExecutablePropagator(WESTPropagator):
     def cleanup_file_system(self, child_info, segment, environ):
         shutil.rmtree(environ['WEST_CURRENT_SEG_DATA_REF'])
 
+    def remove_cancelled_directories(self, segments):
+        '''Remove the private directories (see ``prepare_file_system()``) left behind by copies of the
+        given segments which were cancelled in favour of another copy.'''
+        for segment in segments:
+            data_ref = self.makepath(self.segment_ref_template, {'n_iter': segment.n_iter, 'segment': segment})
+            (dirname, prefix) = (os.path.dirname(data_ref), os.path.basename(data_ref)+'.')
+            try:
+                names = os.listdir(dirname)
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith(prefix):
+                    log.debug('removing directory {!r} of cancelled copy of segment {!r}'.format(name, segment))
+                    shutil.rmtree(os.path.join(dirname, name), ignore_errors=True)
+
     def exec_for_iteration(self, child_info, n_iter, addtl_env = None):
         '''Execute a child process with environment and template expansion from the given
         iteration number.'''
@@ -655,13 +979,15 @@ class ExecutablePropagator(WESTPropagator):
             raise TypeError('state must be a BasisState or InitialState')
 
         child_info = self.exe_info.get('get_pcoord')
-        pfd, prfname = tempfile.mkstemp()
+        pcoord_format = self.data_info['pcoord']['format']
+        pfd, prfname = tempfile.mkstemp(suffix=return_format_suffixes[pcoord_format])
         os.close(pfd)
         cfd, crfname = tempfile.mkstemp()
         os.close(cfd)
         erfname = tempfile.mkdtemp()
 
         addtl_env = {self.ENV_PCOORD_RETURN:     prfname,
+                     self.ENV_PCOORD_RETURN_FORMAT: pcoord_format,
                      self.ENV_RESTART_RETURN:    erfname,
                      self.ENV_TRAJECTORY_RETURN: crfname,
                      self.ENV_STRUCT_DATA_REF:   struct_ref}
@@ -755,6 +1081,9 @@ class ExecutablePropagator(WESTPropagator):
                     log.warning('pre-iteration executable {!r} returned {}'.format(child_info['executable'], rc))
 
     def finalize_iteration(self, n_iter, segments):
+        if self.allow_speculation:
+            self.remove_cancelled_directories(segments)
+
         child_info = self.exe_info.get('post_iteration')
         if child_info and child_info['enabled']:
             try:
@@ -768,147 +1097,310 @@ class ExecutablePropagator(WESTPropagator):
                     log.warning('post-iteration executable {!r} returned {}'.format(child_info['executable'], rc))
 
 
-    def propagate(self, segments):
-        child_info = self.exe_info['propagator']
+    def make_return_files(self, segment):
+        '''Choose (creating if necessary) the files in which the propagator returns each enabled dataset for
+        the given segment. Returns (return_files, del_return_files, addtl_env), where ``return_files`` maps
+        dataset name to filename, ``del_return_files`` maps dataset name to whether the file is temporary,
+        and ``addtl_env`` contains the corresponding WEST_*_RETURN environment variables.'''
+        return_files = {}
+        del_return_files = {}
+        addtl_env = {}
+        slot = None
 
-        for segment in segments:
-            #segment.error = []
-            starttime = time.time()
+        for dataset in self.data_info:
+            if not self.data_info[dataset].get('enabled',False):
+                continue
 
-            addtl_env = {}
+            return_template = self.data_info[dataset].get('filename')
+            return_format = self.data_info[dataset].get('format')
+            if return_template:
+                return_files[dataset] = self.makepath(return_template, self.template_args_for_segment(segment))
+                del_return_files[dataset] = False
+                if return_format is not None:
+                    # A given filename determines the format
+                    return_format = 'npy' if return_files[dataset].endswith('.npy') else 'text'
+            elif self.scratch is not None:
+                if slot is None:
+                    slot = self.scratch.acquire_slot()
+                rfname = os.path.join(slot, re.sub(r'[^\w.-]', '_', dataset) + return_format_suffixes.get(return_format, ''))
+                if dataset == 'restart':
+                    os.mkdir(rfname)
+                else:
+                    open(rfname, 'wb').close()
+                return_files[dataset] = rfname
+                del_return_files[dataset] = True
+            elif dataset == 'restart':
+                rfname = tempfile.mkdtemp()
+                return_files[dataset] = rfname
+                del_return_files[dataset] = True
+            else:
+                (fd, rfname) = tempfile.mkstemp(suffix=return_format_suffixes.get(return_format, ''))
+                os.close(fd)
+                return_files[dataset] = rfname
+                del_return_files[dataset] = True
+
+            addtl_env['WEST_{}_RETURN'.format(dataset.upper())] = return_files[dataset]
+            if return_format is not None:
+                addtl_env['WEST_{}_RETURN_FORMAT'.format(dataset.upper())] = return_format
+        return return_files, del_return_files, addtl_env
+
+    def remove_return_files(self, return_files, del_return_files):
+        scratch_slots = set()
+        for dataset in self.data_info:
+            if not self.data_info[dataset].get('enabled',False):
+                continue
+            filename = return_files[dataset]
+            if del_return_files[dataset]:
+                if self.scratch is not None and self.scratch.owns(filename):
+                    # emptied in the background
+                    scratch_slots.add(os.path.dirname(filename))
+                elif dataset == 'restart':
+                    try:
+                        shutil.rmtree(filename)
+                    except Exception as e:
+                        log.warning('could not delete {} file {!r}: {!r}'.format(dataset, filename, e))
+                    else:
+                        log.debug('deleted {} directory {!r}'.format(dataset, filename))
+                else:
+                    try:
+                        os.unlink(filename)
+                    except Exception as e:
+                        log.warning('could not delete {} file {!r}: {!r}'.format(dataset, filename, e))
+                    else:
+                        log.debug('deleted {} file {!r}'.format(dataset, filename))
+        for slot in scratch_slots:
+            self.scratch.release_slot(slot)
+
+    def load_segment_data(self, child_info, segment, return_files):
+        '''Load the datasets returned by the propagator for the given segment.'''
+        # We want to load the pcoord last, as we may wish to directly manipulate trajectories.
+        # Actually, I take it back.  We want to load the pcoord first such that we may calculate properties
+        # on the trajectory while it still exists in the filesystem.
+        #for dataset in self.data_info:
+        for dataset in reversed(self.data_info):
+            # pcoord is always enabled (see __init__)
+            if not self.data_info[dataset].get('enabled',False):
+                continue
 
-            return_files = {}
-            del_return_files = {}
+            filename = return_files[dataset]
+            loader = self.data_info[dataset]['loader']
+            try:
+                segment.file_type = self.trajectory_types
+            except:
+                pass
+            try:
+                if dataset == 'pcoord':
+                    # Yes, I'm considering changing the default behavior.  It's faster to just supply the files directly on disk during propagation,
+                    # rather than re-creating temp files just to have it work for a custom pcoord load function.  Really, we just need to make sure
+                    # that the pcoord loaders accept *kwargs; nothing else should be necessary.
+                    #try:
+                    porig = segment.pcoord
+                    if self.data_info['restart']['enabled']:
+                        loader(dataset, filename, segment, single_point=False, trajectory=return_files['trajectory'], restart=return_files['restart'])
+                    else:
+                        loader(dataset, filename, segment, single_point=False, trajectory=return_files['trajectory'], restart=None)
+                    check_pcoord(segment, original_pcoord=porig, single_point=False, executable=child_info['executable'], logfile=child_info['stdout'])
+                    #except:
+                        # Compatibility for older calls.  If this call doesn't work, the normal error handling should sort it.
+                    #    porig = segment.pcoord
+                    #    loader(dataset, filename, segment, single_point=False)
+                    #    check_pcoord(segment, original_pcoord=porig, single_point=False, executable=child_info['executable'], logfile=child_info['stdout'])
+                else:
+                    loader(dataset, filename, segment, single_point=False)
+            except Exception as e:
+                #print(log.exception(e))
+                a = traceback.format_exc()
+                #a = a.split('\n')
+                #a = "\n        ".join(a.splitlines()[:])
+                #print(e, dataset)
+                #if dataset != 'pcoord':
+                #    error.report_segment_error(error.RUNSEG_TMP_ERROR, segment=segment, filename=filename, dataset=dataset, e=e)
+
+                # We catch this if the error hasn't already been handled.
+                if e.__class__ != error.ErrorHandled:
+                    segment.error.append(error.report_segment_error(error.RUNSEG_TMP_ERROR, segment=segment, filename=filename, dataset=dataset, e=e, loader=loader, traceback=a))
+                #else:
+                #    error.report_segment_error(error.EMPTY_PCOORD_ERROR, segment=segment, filename=filename, dataset=dataset, e=e)
+                #log.error('could not read {} from {!r}: {!r}'.format(dataset, filename, e))
+                segment.status = Segment.SEG_STATUS_FAILED
+                #break
+
+    def finish_segment(self, child_info, segment, run_environ, rc, err, return_files, del_return_files):
+        '''Record the outcome of propagating the given segment, which exited with return code ``rc``,
+        loading its data if it succeeded and removing its (temporary) return files.'''
+        segment.err = err
+
+        if self.cleanup == True:
+            self.cleanup_file_system(child_info, segment, run_environ)
+
+        if rc == 0:
+            segment.status = Segment.SEG_STATUS_COMPLETE
+        elif rc < 0:
+            #log.error('child process for segment %d exited on signal %d (%s)' % (segment.seg_id, -rc, SIGNAL_NAMES[-rc]))
+            segment.error.append(error.report_segment_error(error.RUNSEG_SIGNAL_ERROR, segment=segment, err=err, rc=-rc))
+            segment.status = Segment.SEG_STATUS_FAILED
+        else:
+            #log.error('child process for segment %d exited with code %d' % (segment.seg_id, rc))
+            segment.error.append(error.report_segment_error(error.RUNSEG_GENERAL_ERROR, segment=segment, err=err, rc=rc))
+            segment.status = Segment.SEG_STATUS_FAILED
+
+        # Extract data and store on segment for recording in the master thread/process/node
+        if segment.status != Segment.SEG_STATUS_FAILED:
+            self.load_segment_data(child_info, segment, return_files)
+
+        # Why are we deleting the dataset AFTER we load it?  We want to expose the trajectory and restart information to the
+        # pcoord loader, if applicable.
+        self.remove_return_files(return_files, del_return_files)
+
+    def _get_segment_pool(self):
+        with self._segment_pool_lock:
+            if self._segment_pool is None or self._segment_pool_pid != os.getpid():
+                # Threads do not survive a fork, so each process needs its own pool, which is shut
+                # down when that process exits (as for persistent runners)
+                from multiprocessing.pool import ThreadPool
+                self._segment_pool = ThreadPool(self.segment_concurrency)
+                self._segment_pool_pid = os.getpid()
+                multiprocessing.util.Finalize(self, self.shutdown_segment_pool, exitpriority=10)
+            return self._segment_pool
+
+    def shutdown_segment_pool(self):
+        '''Stop any threads used to propagate segments concurrently.'''
+        with self._segment_pool_lock:
+            pool, self._segment_pool = self._segment_pool, None
+            if pool is not None and self._segment_pool_pid == os.getpid():
+                pool.close()
+                pool.join()
+
+    def map_segments(self, fn, items):
+        '''Return ``map(fn, items)``, evaluated by up to ``segment_concurrency`` threads at once.'''
+        items = list(items)
+        if self.segment_concurrency > 1 and len(items) > 1:
+            return self._get_segment_pool().map(fn, items, chunksize=1)
+        else:
+            return map(fn, items)
 
-            #for dataset in sorted(self.data_info, reverse=True):
-            # We want to load the progress coordinate LAST, and it's set into the ordereddict first, so.
-            #for dataset in reversed(self.data_info):
-            for dataset in self.data_info:
-                if not self.data_info[dataset].get('enabled',False):
-                    continue
+    def propagate_segment(self, child_info, segment):
+        '''Propagate one segment, from preparing its directory through loading its data.'''
+        #segment.error = []
+        starttime = time.time()
 
-                return_template = self.data_info[dataset].get('filename')
-                if return_template:
-                    return_files[dataset] = self.makepath(return_template, self.template_args_for_segment(segment))
-                    del_return_files[dataset] = False
-                elif dataset == 'restart':
-                    rfname = tempfile.mkdtemp()
-                    return_files[dataset] = rfname
-                    del_return_files[dataset] = True
-                else:
-                    (fd, rfname) = tempfile.mkstemp()
-                    os.close(fd)
-                    return_files[dataset] = rfname
-                    del_return_files[dataset] = True
+        # exec_for_segment() sets the working directory in child_info, so segments propagated
+        # concurrently each need their own copy
+        child_info = dict(child_info)
+        return_files, del_return_files, addtl_env = self.make_return_files(segment)
 
-                addtl_env['WEST_{}_RETURN'.format(dataset.upper())] = return_files[dataset]
-                # This is where it all goes down.
+        # Spawn propagator and wait for its completion
+        #used_environ, rc, rusage = self.exec_for_segment(child_info, segment, addtl_env)
+        results = self.exec_for_segment(child_info, segment, addtl_env)
+        rc, rusage, err = results[1]
+        run_environ = results[0]
 
-            # We're going to want to output the extra coordinates used for stuff...
+        self.finish_segment(child_info, segment, run_environ, rc, err, return_files, del_return_files)
+        if segment.status == Segment.SEG_STATUS_FAILED:
+            return
 
-            # Spawn propagator and wait for its completion
-            #used_environ, rc, rusage = self.exec_for_segment(child_info, segment, addtl_env)
-            results = self.exec_for_segment(child_info, segment, addtl_env)
-            rc, rusage, err = results[1]
-            segment.err = err
-            run_environ = results[0]
+        # Record timing info
+        segment.walltime = time.time() - starttime
+        segment.cputime = rusage.ru_utime
 
-            if self.cleanup == True:
-                self.cleanup_file_system(child_info, segment, run_environ)
+    def propagate(self, segments):
+        child_info = self.exe_info['propagator']
 
-            if rc == 0:
-                segment.status = Segment.SEG_STATUS_COMPLETE
-            elif rc < 0:
-                #log.error('child process for segment %d exited on signal %d (%s)' % (segment.seg_id, -rc, SIGNAL_NAMES[-rc]))
-                segment.error.append(error.report_segment_error(error.RUNSEG_SIGNAL_ERROR, segment=segment, err=err, rc=-rc))
-                segment.status = Segment.SEG_STATUS_FAILED
-                continue
-            else:
-                #log.error('child process for segment %d exited with code %d' % (segment.seg_id, rc))
-                segment.error.append(error.report_segment_error(error.RUNSEG_GENERAL_ERROR, segment=segment, err=err, rc=rc))
-                segment.status = Segment.SEG_STATUS_FAILED
-                continue
+        if child_info.get('gang'):
+            return self.propagate_gang(child_info, segments)
 
-            # Extract data and store on segment for recording in the master thread/process/node
-            # We want to load the pcoord last, as we may wish to directly manipulate trajectories.
-            # Actually, I take it back.  We want to load the pcoord first such that we may calculate properties
-            # on the trajectory while it still exists in the filesystem.
-            #for dataset in self.data_info:
-            for dataset in reversed(self.data_info):
-                # pcoord is always enabled (see __init__)
-                if not self.data_info[dataset].get('enabled',False):
-                    continue
-
-                filename = return_files[dataset]
-                loader = self.data_info[dataset]['loader']
-                try:
-                    segment.file_type = self.trajectory_types
-                except:
-                    pass
-                try:
-                    if dataset == 'pcoord':
-                        # Yes, I'm considering changing the default behavior.  It's faster to just supply the files directly on disk during propagation,
-                        # rather than re-creating temp files just to have it work for a custom pcoord load function.  Really, we just need to make sure
-                        # that the pcoord loaders accept *kwargs; nothing else should be necessary.
-                        #try:
-                        porig = segment.pcoord
-                        if self.data_info['restart']['enabled']:
-                            loader(dataset, filename, segment, single_point=False, trajectory=return_files['trajectory'], restart=return_files['restart'])
-                        else:
-                            loader(dataset, filename, segment, single_point=False, trajectory=return_files['trajectory'], restart=None)
-                        check_pcoord(segment, original_pcoord=porig, single_point=False, executable=child_info['executable'], logfile=child_info['stdout'])
-                        #except:
-                            # Compatibility for older calls.  If this call doesn't work, the normal error handling should sort it.
-                        #    porig = segment.pcoord
-                        #    loader(dataset, filename, segment, single_point=False)
-                        #    check_pcoord(segment, original_pcoord=porig, single_point=False, executable=child_info['executable'], logfile=child_info['stdout'])
-                    else:
-                        loader(dataset, filename, segment, single_point=False)
-                except Exception as e:
-                    #print(log.exception(e))
-                    a = traceback.format_exc()
-                    #a = a.split('\n')
-                    #a = "\n        ".join(a.splitlines()[:])
-                    #print(e, dataset)
-                    #if dataset != 'pcoord':
-                    #    error.report_segment_error(error.RUNSEG_TMP_ERROR, segment=segment, filename=filename, dataset=dataset, e=e)
-
-                    # We catch this if the error hasn't already been handled.
-                    if e.__class__ != error.ErrorHandled:
-                        segment.error.append(error.report_segment_error(error.RUNSEG_TMP_ERROR, segment=segment, filename=filename, dataset=dataset, e=e, loader=loader, traceback=a))
-                    #else:
-                    #    error.report_segment_error(error.EMPTY_PCOORD_ERROR, segment=segment, filename=filename, dataset=dataset, e=e)
-                    #log.error('could not read {} from {!r}: {!r}'.format(dataset, filename, e))
-                    segment.status = Segment.SEG_STATUS_FAILED
-                    #break
-
-            # Why are we deleting the dataset AFTER we load it?  We want to expose the trajectory and restart information to the
-            # pcoord loader, if applicable.
-            #for dataset in reversed(self.data_info):
-            for dataset in self.data_info:
-                if not self.data_info[dataset].get('enabled',False):
-                    continue
-                filename = return_files[dataset]
-                if del_return_files[dataset]:
-                    if dataset == 'restart':
-                        try:
-                            shutil.rmtree(filename)
-                        except Exception as e:
-                            log.warning('could not delete {} file {!r}: {!r}'.format(dataset, filename, e))
-                        else:
-                            log.debug('deleted {} directory {!r}'.format(dataset, filename))
-                    else:
-                        try:
-                            os.unlink(filename)
-                        except Exception as e:
-                            log.warning('could not delete {} file {!r}: {!r}'.format(dataset, filename, e))
-                        else:
-                            log.debug('deleted {} file {!r}'.format(dataset, filename))
-            if segment.status == Segment.SEG_STATUS_FAILED:
-                continue
+        # With segment_concurrency > 1, that many segments (each with its own child process, and the
+        # preparation and loading of its data) are in flight at once
+        self.map_segments(lambda segment: self.propagate_segment(child_info, segment), segments)
+        return segments
+
+    def propagate_gang(self, child_info, segments):
+        '''Propagate all the given segments with a single invocation of the propagator executable, which
+        finds the segments to run in a JSON manifest named by $WEST_SEGMENT_MANIFEST. Each entry of the
+        manifest's ``segments`` list gives the ``n_iter``, ``seg_id``, ``cwd`` and ``environ`` (the environment
+        variables that would have been set for that segment alone, including the WEST_*_RETURN files) for one
+        segment. The executable may record per-segment return codes (and timings) in the manifest by adding
+        ``rc`` (and ``walltime``/``cputime``) to each entry; otherwise its own return code applies to every
+        segment, and its wall and CPU time are split evenly among them. Entries are matched to segments by
+        ``n_iter`` and ``seg_id``, in any order; a segment with no entry (or more than one) in a manifest
+        read back successfully is failed.'''
+        segments = list(segments)
+        if not segments:
+            return segments
+
+        def prepare(segment):
+            return_files, del_return_files, addtl_env = self.make_return_files(segment)
+            template_args, environ = {}, {}
+            self.update_args_env_iter(template_args, environ, segment.n_iter)
+            self.update_args_env_segment(template_args, environ, segment)
+            environ.update(addtl_env)
+            environ.update(self.random_val_env_vars())
+            for (key, value) in child_info.get('environ', {}).iteritems():
+                environ[key] = self.makepath(value)
+            self.prepare_file_system(child_info, segment, environ)
+            return (segment, environ, return_files, del_return_files)
+
+        starttime = time.time()
+        prepared = self.map_segments(prepare, segments)
+        entries = [{'n_iter': segment.n_iter,
+                    'seg_id': segment.seg_id,
+                    'cwd': environ[self.ENV_CURRENT_SEG_DATA_REF],
+                    'environ': environ} for (segment, environ, _return_files, _del_return_files) in prepared]
+
+        executed = False
+        (fd, manifest) = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'wt') as manifest_file:
+                json.dump({'segments': entries}, manifest_file, indent=1)
 
-            # Record timing info
-            segment.walltime = time.time() - starttime
-            segment.cputime = rusage.ru_utime
-        # Clean up the file system.
+            results = self.exec_for_iteration(child_info, segments[0].n_iter, {self.ENV_SEGMENT_MANIFEST: manifest})
+            rc, rusage, err = results[1]
+            executed = True
+
+            try:
+                with open(manifest, 'rt') as manifest_file:
+                    returned_entries = json.load(manifest_file)['segments']
+                entries_by_key = {}
+                for entry in returned_entries:
+                    entries_by_key.setdefault((entry['n_iter'], entry['seg_id']), []).append(entry)
+            except Exception as e:
+                log.warning('could not read back segment manifest {!r}: {!r}'.format(manifest, e))
+                entries = [(entry, None) for entry in entries]
+            else:
+                entries = []
+                for (segment, _environ, _return_files, _del_return_files) in prepared:
+                    matches = entries_by_key.pop((segment.n_iter, segment.seg_id), [])
+                    if len(matches) == 1:
+                        entries.append((matches[0], None))
+                    elif matches:
+                        entries.append(({}, 'segment appears {:d} times in the returned manifest'.format(len(matches))))
+                    else:
+                        entries.append(({}, 'segment missing from the returned manifest'))
+                if entries_by_key:
+                    log.warning('ignoring unknown segments {!r} in returned manifest'.format(sorted(entries_by_key)))
+        finally:
+            try:
+                os.unlink(manifest)
+            except OSError as e:
+                log.warning('could not delete segment manifest {!r}: {!r}'.format(manifest, e))
+            if not executed:
+                for (_segment, _environ, return_files, del_return_files) in prepared:
+                    self.remove_return_files(return_files, del_return_files)
+
+        walltime = (time.time() - starttime) / len(segments)
+        cputime = rusage.ru_utime / len(segments)
+
+        def finish(item):
+            ((entry, problem), (segment, environ, return_files, del_return_files)) = item
+            if problem:
+                seg_rc, seg_err = (rc or 1), problem
+            else:
+                seg_rc = entry.get('rc', rc)
+                seg_err = err if seg_rc else ''
+            self.finish_segment(child_info, segment, environ, seg_rc, seg_err, return_files, del_return_files)
+            if segment.status != Segment.SEG_STATUS_FAILED:
+                segment.walltime = entry.get('walltime', walltime)
+                segment.cputime = entry.get('cputime', cputime)
+
+        self.map_segments(finish, zip(entries, prepared))
         return segments
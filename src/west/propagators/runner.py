@@ -0,0 +1,111 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Support for persistent runners, long-lived child processes to which the executable propagator
+hands one segment after another (see the ``runner`` option of ``west.executable.propagator``).
+
+The protocol is line-oriented JSON over the runner's standard input and output. For each segment,
+the propagator writes one request, an object with the keys
+
+  ``executable``
+    the (expanded) path of the configured propagator executable, which the runner may ignore
+  ``environ``
+    the environment variables which would have been set for the executable (``WEST_CURRENT_SEG_ID``,
+    ``WEST_PCOORD_RETURN``, etc), in addition to those inherited by the runner at startup
+  ``cwd``, ``stdout``, ``stderr``
+    the working directory and output files configured for the executable (or null)
+
+and waits for one reply, an object with the keys ``rc`` (the return code for the segment; zero
+indicates success), and optionally ``err`` (the last lines of error output) and ``rusage`` (a mapping
+of ``resource.struct_rusage`` field names to values for the segment). Runners exit when their standard
+input is closed. Because standard output carries replies, runners must not write anything else there.
+
+``serve()`` implements the runner side of this protocol around a function which propagates one
+segment; running this module as a script gives a runner which executes the requested executable
+for each segment, which is mostly useful as a template.
+'''
+
+from __future__ import division, print_function; __metaclass__ = type
+
+import sys, os, json, resource, subprocess
+
+rusage_fields = ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_ixrss', 'ru_idrss', 'ru_isrss', 'ru_minflt', 'ru_majflt',
+                 'ru_nswap', 'ru_inblock', 'ru_oublock', 'ru_msgsnd', 'ru_msgrcv', 'ru_nsignals', 'ru_nvcsw', 'ru_nivcsw')
+
+def _total_rusage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {field: getattr(own, field) + getattr(children, field) for field in rusage_fields}
+
+def serve(run_segment, instream=None, outstream=None):
+    '''Read segment requests from ``instream`` (default: standard input) until it is closed, calling
+    ``run_segment(request)`` for each and writing a reply to ``outstream`` (default: standard output).
+    ``run_segment`` returns the return code for the segment, or a tuple (rc, err). Resource usage is
+    measured around each call, and includes any child processes waited on. Exceptions raised by
+    ``run_segment`` are reported as a failure of that segment.'''
+
+    instream = instream or sys.stdin
+    outstream = outstream or sys.stdout
+
+    while True:
+        line = instream.readline()
+        if not line:
+            break
+        elif not line.strip():
+            continue
+
+        request = json.loads(line)
+        before = _total_rusage()
+        try:
+            rv = run_segment(request)
+        except Exception as e:
+            rc, err = 1, '{}: {!s}'.format(e.__class__.__name__, e)
+        else:
+            if isinstance(rv, tuple):
+                rc, err = rv
+            else:
+                rc, err = rv, ''
+        after = _total_rusage()
+
+        rusage = {field: after[field] - before[field] for field in rusage_fields}
+        rusage['ru_maxrss'] = after['ru_maxrss']
+        outstream.write(json.dumps({'rc': int(rc), 'err': err or '', 'rusage': rusage}) + '\n')
+        outstream.flush()
+
+def run_executable(request):
+    '''Run the requested executable, much as the executable propagator would have.'''
+    environ = dict(os.environ)
+    environ.update(request['environ'])
+    stdin = open(os.devnull, 'rb')
+    stdout = open(request['stdout'], 'ab') if request.get('stdout') else open(os.devnull, 'wb')
+    if request.get('stderr') == 'stdout':
+        stderr = stdout
+    else:
+        stderr = open(request['stderr'], 'ab') if request.get('stderr') else subprocess.PIPE
+    try:
+        proc = subprocess.Popen([request['executable']], cwd=request.get('cwd'), env=environ,
+                                stdin=stdin, stdout=stdout, stderr=stderr, close_fds=True)
+        _out, err = proc.communicate()
+    finally:
+        stdin.close()
+        stdout.close()
+        if stderr not in (stdout, subprocess.PIPE):
+            stderr.close()
+    return proc.returncode, '\n'.join((err or '').splitlines()[-10:])
+
+if __name__ == '__main__':
+    serve(run_executable)
@@ -23,7 +23,16 @@ class Segment:
     '''A class wrapping segment data that must be passed through the work manager or data manager.
     Most fields are self-explanatory.  One item worth noting is that a negative parent ID means that
     the segment starts from the initial state with ID -(segment.parent_id+1)
+
+    Segments are held in large numbers by the master, so fields are stored in slots, and the
+    ``data`` dict and ``error`` list are only created when first used. ``restart`` is stored as
+    given (e.g. as an HDF5 reference or bytes object), without copying. Other attributes may
+    still be assigned, and are stored in a per-instance dict created on demand.
     '''
+
+    __slots__ = ('n_iter', 'seg_id', 'status', 'parent_id', 'restart', 'endpoint_type',
+                 'weight', 'wtg_parent_ids', 'pcoord', 'walltime', 'cputime', '_data', '_error',
+                 '__dict__')
     
     SEG_STATUS_UNSET    = 0
     SEG_STATUS_PREPARED = 1
@@ -75,7 +84,7 @@ class Segment:
         self.seg_id = long(seg_id) if seg_id is not None else None
         self.status = int(status)  if status is not None else None
         self.parent_id = long(parent_id) if parent_id is not None else None
-        self.restart = str(restart) if restart is not None else None
+        self.restart = restart
         self.endpoint_type = int(endpoint_type) if endpoint_type else self.SEG_ENDPOINT_UNSET
         
         self.weight = float(weight) if weight is not None else None
@@ -84,8 +93,53 @@ class Segment:
         self.pcoord = numpy.asarray(pcoord) if pcoord is not None else None
         self.walltime = walltime
         self.cputime = cputime
-        self.data = data if data else {}
-        self.error = error if error else []
+        self._data = data if data else None
+        self._error = error if error else None
+
+    @property
+    def data(self):
+        '''Auxiliary data (e.g. trajectory or restart data) to be stored for this segment'''
+        if self._data is None:
+            self._data = {}
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    @property
+    def error(self):
+        '''Errors reported for this segment'''
+        if self._error is None:
+            self._error = []
+        return self._error
+
+    @error.setter
+    def error(self, error):
+        self._error = error
+
+    def __getstate__(self):
+        state = {}
+        for slot in self.__slots__:
+            if slot != '__dict__':
+                try:
+                    state[slot] = getattr(self, slot)
+                except AttributeError:
+                    # slot unset (or deleted)
+                    pass
+        try:
+            state.update(self.__dict__)
+        except AttributeError:
+            pass
+        return state
+
+    def __setstate__(self, state):
+        # Segments pickled before slots were introduced store data and error directly
+        self._data = state.pop('data', None)
+        self._error = state.pop('error', None)
+        for (name, value) in state.iteritems():
+            setattr(self, name, value)
+
 
     def __repr__(self):
         return '<%s(%s) n_iter=%r seg_id=%r weight=%r parent_id=%r wtg_parent_ids=%r pcoord[0]=%r pcoord[-1]=%r> restart=%r' \
@@ -112,6 +166,168 @@ class Segment:
     status_text = property((lambda s: s.status_names[s.status]))
     endpoint_type_text = property((lambda s: s.endpoint_type_names[s.endpoint_type]))
     
+def pack_pcoords(segments):
+    '''Copy the progress coordinates of ``segments`` into one array, replacing the ``pcoord`` of
+    each segment with a view into it, so that the segments of an iteration do not each hold their
+    own array. Returns the new array, indexed as [segment][time][dimension], or None (leaving the
+    segments unchanged) if any segment has no progress coordinates or their shapes differ.'''
+    segments = list(segments)
+    if not segments or any(segment.pcoord is None for segment in segments):
+        return None
+
+    first_pcoord = segments[0].pcoord
+    if any(segment.pcoord.shape != first_pcoord.shape for segment in segments):
+        return None
+
+    pcoords = numpy.empty((len(segments),) + first_pcoord.shape, dtype=first_pcoord.dtype)
+    for (iseg, segment) in enumerate(segments):
+        pcoords[iseg] = segment.pcoord
+        segment.pcoord = pcoords[iseg]
+    return pcoords
+
+class SegmentTable:
+    '''A columnar (struct-of-arrays) representation of the segments of one iteration.
+
+    Per-segment fields are held as parallel numpy arrays (``weights``, ``parent_ids``,
+    ``status``, ``endpoint_types``, ``walltimes``, ``cputimes``) along with an optional
+    ``pcoords`` array indexed as [segment][time][dimension]. The weight transfer graph is
+    stored in compressed sparse row form: the parents of the ith segment in the table are
+    ``wtg_parent_ids[wtg_offsets[i]:wtg_offsets[i+1]]``.
+
+    ``Segment`` objects are only constructed when requested (by indexing or iterating over
+    the table), and are cached, so that repeated access yields the same object. The
+    progress coordinates of these segments are views into ``pcoords``.
+    '''
+
+    def __init__(self, n_iter, weights, parent_ids, seg_ids=None, status=None, endpoint_types=None,
+                 walltimes=None, cputimes=None, pcoords=None, wtg_offsets=None, wtg_parent_ids=None,
+                 restarts=None):
+        self.n_iter = n_iter
+        self.weights = numpy.asarray(weights)
+        self.parent_ids = numpy.asarray(parent_ids)
+
+        n_segs = len(self.weights)
+        if len(self.parent_ids) != n_segs:
+            raise ValueError('weights and parent_ids must have the same length')
+
+        self.seg_ids = numpy.asarray(seg_ids) if seg_ids is not None else numpy.arange(n_segs)
+        self.status = (numpy.asarray(status) if status is not None
+                       else numpy.zeros((n_segs,), dtype=numpy.uint8))
+        self.endpoint_types = (numpy.asarray(endpoint_types) if endpoint_types is not None
+                               else numpy.zeros((n_segs,), dtype=numpy.uint8))
+        self.walltimes = (numpy.asarray(walltimes) if walltimes is not None
+                          else numpy.zeros((n_segs,), dtype=numpy.float64))
+        self.cputimes = (numpy.asarray(cputimes) if cputimes is not None
+                         else numpy.zeros((n_segs,), dtype=numpy.float64))
+        self.pcoords = numpy.asarray(pcoords) if pcoords is not None else None
+
+        if wtg_offsets is None:
+            # Every segment has only its history parent in the weight transfer graph
+            self.wtg_offsets = numpy.arange(n_segs+1)
+            self.wtg_parent_ids = self.parent_ids.copy()
+        else:
+            self.wtg_offsets = numpy.asarray(wtg_offsets)
+            self.wtg_parent_ids = numpy.asarray(wtg_parent_ids)
+            if len(self.wtg_offsets) != n_segs+1:
+                raise ValueError('wtg_offsets must have one more entry than there are segments')
+
+        # Restart references (or data), if any; this is an object array, since
+        # the entries may be HDF5 references
+        self.restarts = restarts
+
+        self._segments = [None]*n_segs
+
+    @classmethod
+    def from_segments(cls, segments, n_iter=None, load_pcoords=True):
+        '''Construct a table from a sequence of ``Segment`` objects. The given objects are
+        used as the (cached) segment views of the new table, and (if ``load_pcoords`` is true)
+        their progress coordinates become views into ``pcoords``.'''
+
+        segments = list(segments)
+        n_segs = len(segments)
+        if n_iter is None and segments:
+            n_iter = segments[0].n_iter
+
+        wtg_n_parents = numpy.fromiter((len(segment.wtg_parent_ids) for segment in segments),
+                                       dtype=numpy.int64, count=n_segs)
+        wtg_offsets = numpy.zeros((n_segs+1,), dtype=numpy.int64)
+        numpy.cumsum(wtg_n_parents, out=wtg_offsets[1:])
+        wtg_parent_ids = numpy.empty((wtg_offsets[-1],), dtype=numpy.int64)
+        for (iseg, segment) in enumerate(segments):
+            wtg_parent_ids[wtg_offsets[iseg]:wtg_offsets[iseg+1]] = sorted(segment.wtg_parent_ids)
+
+        pcoords = pack_pcoords(segments) if load_pcoords else None
+
+        table = cls(n_iter,
+                    weights=numpy.fromiter((segment.weight for segment in segments), dtype=numpy.float64, count=n_segs),
+                    parent_ids=numpy.fromiter((segment.parent_id for segment in segments), dtype=numpy.int64, count=n_segs),
+                    seg_ids=numpy.array([segment.seg_id if segment.seg_id is not None else iseg
+                                         for (iseg, segment) in enumerate(segments)], dtype=numpy.int64),
+                    status=numpy.fromiter((segment.status or 0 for segment in segments), dtype=numpy.uint8, count=n_segs),
+                    endpoint_types=numpy.fromiter((segment.endpoint_type or 0 for segment in segments),
+                                                  dtype=numpy.uint8, count=n_segs),
+                    walltimes=numpy.fromiter((segment.walltime for segment in segments), dtype=numpy.float64, count=n_segs),
+                    cputimes=numpy.fromiter((segment.cputime for segment in segments), dtype=numpy.float64, count=n_segs),
+                    pcoords=pcoords,
+                    wtg_offsets=wtg_offsets,
+                    wtg_parent_ids=wtg_parent_ids)
+        table._segments = segments
+        return table
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __iter__(self):
+        for iseg in xrange(len(self)):
+            yield self.segment(iseg)
+
+    def __getitem__(self, iseg):
+        return self.segment(iseg)
+
+    def __repr__(self):
+        return '<{} at 0x{:x}: n_iter={!r}, {:d} segments>'.format(self.__class__.__name__, id(self),
+                                                                   self.n_iter, len(self))
+
+    @property
+    def initial_pcoords(self):
+        'Initial progress coordinate point of each segment, as a view into ``pcoords``.'
+        return self.pcoords[:,0]
+
+    @property
+    def final_pcoords(self):
+        'Final progress coordinate point of each segment, as a view into ``pcoords``.'
+        return self.pcoords[:,-1]
+
+    @property
+    def wtg_n_parents(self):
+        'Number of parents of each segment in the weight transfer graph.'
+        return numpy.diff(self.wtg_offsets)
+
+    def get_wtg_parent_ids(self, iseg):
+        'Return the weight transfer graph parents of the ``iseg``th segment in this table.'
+        return self.wtg_parent_ids[self.wtg_offsets[iseg]:self.wtg_offsets[iseg+1]]
+
+    def segment(self, iseg):
+        '''Return a ``Segment`` object for the ``iseg``th segment (row) in this table, constructing
+        it if necessary.'''
+        segment = self._segments[iseg]
+        if segment is None:
+            segment = Segment(n_iter = self.n_iter,
+                              seg_id = self.seg_ids[iseg],
+                              weight = self.weights[iseg],
+                              endpoint_type = self.endpoint_types[iseg],
+                              parent_id = self.parent_ids[iseg],
+                              wtg_parent_ids = (long(parent_id) for parent_id in self.get_wtg_parent_ids(iseg)),
+                              pcoord = self.pcoords[iseg] if self.pcoords is not None else None,
+                              status = self.status[iseg],
+                              walltime = float(self.walltimes[iseg]),
+                              cputime = float(self.cputimes[iseg]))
+            if self.restarts is not None:
+                # Assigned directly, since the Segment constructor would stringify a reference
+                segment.restart = self.restarts[iseg]
+            self._segments[iseg] = segment
+        return segment
+
 Segment.statuses.update({_attr: getattr(Segment,_attr) for _attr in dir(Segment) if _attr.startswith('SEG_STATUS_')})
 Segment.initpoint_types.update({_attr: getattr(Segment,_attr) for _attr in dir(Segment) if _attr.startswith('SEG_INITPOINT_')})
 Segment.endpoint_types.update({_attr: getattr(Segment,_attr) for _attr in dir(Segment) if _attr.startswith('SEG_ENDPOINT_')})
@@ -33,6 +33,7 @@ from west import errors
 
 from west import wm_ops
 from west.data_manager import weight_dtype
+from west.we_driver import NewWeightTable
 import sys
 
 from pickle import PickleError
@@ -71,18 +72,29 @@ class PropagationError(RuntimeError):
     pass
 
 class WESimManager:
+    # Orders in which segments may be dispatched for propagation; see schedule_segments()
+    schedules = ('default', 'longest_first')
+
     def process_config(self):
         config = self.rc.config
         for (entry, type_) in [('gen_istates', bool),
                                ('block_size', int),
-                               ('save_transition_matrices', bool)]:
+                               ('save_transition_matrices', bool),
+                               ('lazy_restarts', bool)]:
             config.require_type_if_present(['west', 'propagation', entry], type_)
 
         self.do_gen_istates = config.get(['west', 'propagation', 'gen_istates'], False)
         self.propagator_block_size = config.get(['west', 'propagation', 'block_size'], 1)
         self.save_transition_matrices = config.get(['west', 'propagation', 'save_transition_matrices'], False)
+        self.lazy_restarts = config.get(['west', 'propagation', 'lazy_restarts'], False)
         self.max_run_walltime = config.get(['west', 'propagation', 'max_run_wallclock'], default=None)
         self.max_total_iterations = config.get(['west', 'propagation', 'max_total_iterations'], default=None)
+
+        config.require_type_if_present(['west', 'propagation', 'walltime_ema_alpha'], float)
+        self.schedule = config.get(['west', 'propagation', 'schedule'], self.schedule)
+        if self.schedule not in self.schedules:
+            raise ValueError('invalid propagation schedule {!r}'.format(self.schedule))
+        self.walltime_ema_alpha = config.get(['west', 'propagation', 'walltime_ema_alpha'], self.walltime_ema_alpha)
         # Just a temp fix for reporting storage.
         try:
             import os
@@ -112,10 +124,17 @@ class WESimManager:
         self.do_gen_istates = False
         self.propagator_block_size = 1
         self.save_transition_matrices = False
+        self.lazy_restarts = False
         self.max_run_walltime = None
         self.max_total_iterations = None
+        self.schedule = 'default'
+        self.walltime_ema_alpha = 0.3
         self.process_config()
 
+        # Exponential moving average of segment walltime in each bin (by initial point),
+        # used to predict walltimes when scheduling propagation
+        self.bin_walltime_ema = None
+
         self.errors = errors.WESTErrorReporting(sys.argv[0])
 
         # Per-iteration variables
@@ -403,9 +422,11 @@ class WESimManager:
 
         # Get the segments for this iteration and separate into complete and incomplete
         if self.segments is None:
-            segments = self.segments = {segment.seg_id: segment for segment in self.data_manager.get_segments()}
+            segment_table = self.data_manager.get_segment_table()
+            segments = self.segments = {segment.seg_id: segment for segment in segment_table}
             log.debug('loaded {:d} segments'.format(len(segments)))
         else:
+            segment_table = None
             segments = self.segments
             log.debug('using {:d} pre-existing segments'.format(len(segments)))
 
@@ -433,19 +454,28 @@ class WESimManager:
         log.debug('This iteration uses {:d} initial states'.format(len(self.current_iter_istates)))
 
         # Assign this iteration's segments' initial points to bins and report on bin population
-        initial_pcoords = self.system.new_pcoord_array(len(segments))
         initial_binning = self.system.bin_mapper.construct_bins()
-        for iseg, segment in enumerate(segments.itervalues()):
-            initial_pcoords[iseg] = segment.pcoord[0]
+        if segment_table is not None:
+            binned_segments = segment_table
+            initial_pcoords = self.system.new_pcoord_array(len(segment_table))
+            initial_pcoords[...] = segment_table.initial_pcoords
+        else:
+            binned_segments = segments.values()
+            initial_pcoords = self.system.new_pcoord_array(len(segments))
+            for iseg, segment in enumerate(binned_segments):
+                initial_pcoords[iseg] = segment.pcoord[0]
         initial_assignments = self.system.bin_mapper.assign(initial_pcoords)
-        for (segment, assignment) in izip(segments.itervalues(), initial_assignments):
+        for (segment, assignment) in izip(binned_segments, initial_assignments):
             initial_binning[assignment].add(segment)
         self.report_bin_statistics(initial_binning, save_summary=True)
-        del initial_pcoords, initial_binning
+        del initial_pcoords, initial_binning, binned_segments
 
         # Let the WE driver assign completed segments
         if completed_segments:
-            self.we_driver.assign(completed_segments.values())
+            if segment_table is not None and len(completed_segments) == len(segment_table):
+                self.we_driver.assign(segment_table)
+            else:
+                self.we_driver.assign(completed_segments.values())
 
         # Get the basis states and initial states for the next iteration, necessary for doing on-the-fly recycling
         self.next_iter_bstates = self.data_manager.get_basis_states(self.n_iter+1)
@@ -491,11 +521,15 @@ class WESimManager:
 
         futures = set()
         updated_states = []
-        for _i in xrange(n_istates_needed):
-            # Select a basis state according to its weight
-            ibstate = numpy.digitize([random.random()], self.next_iter_bstate_cprobs)
+        if not n_istates_needed:
+            return futures
+
+        # Select basis states according to their weights, and allocate storage for all new
+        # initial states at once
+        ibstates = numpy.digitize([random.random() for _i in xrange(n_istates_needed)], self.next_iter_bstate_cprobs)
+        new_istates = self.data_manager.create_initial_states(n_istates_needed, n_iter=self.n_iter+1)
+        for (ibstate, initial_state) in izip(ibstates, new_istates):
             basis_state = self.next_iter_bstates[ibstate]
-            initial_state = self.data_manager.create_initial_states(1, n_iter=self.n_iter+1)[0]
             initial_state.iter_created = self.n_iter
             initial_state.basis_state_id = basis_state.state_id
             initial_state.istate_status = InitialState.ISTATE_STATUS_PENDING
@@ -517,15 +551,97 @@ class WESimManager:
         self.data_manager.update_initial_states(updated_states, n_iter=self.n_iter+1)
         return futures
 
-    def propagate(self):
-        from westpa.progress import (ProgressIndicator)
-        segments = self.incomplete_segments.values()
-        self.progress = ProgressIndicator()
-        pi = self.progress
-        log.debug('iteration {:d}: propagating {:d} segments'.format(self.n_iter, len(segments)))
-        # Dereference restart data
+    def predict_walltimes(self, segments):
+        '''Predict the walltime of each of ``segments``, as the walltime of its parent in the previous
+        iteration, if known, or otherwise as the moving average walltime of segments starting in
+        the same bin. Segments for which neither is available are given the mean of the other
+        predictions (or zero).'''
+        n_segs = len(segments)
+        predicted = numpy.zeros((n_segs,), dtype=numpy.float64)
+        known = numpy.zeros((n_segs,), dtype=numpy.bool_)
+
+        if self.n_iter > 1:
+            try:
+                parent_walltimes = self.data_manager.get_seg_index_field(self.n_iter-1, 'walltime')
+            except KeyError:
+                parent_walltimes = None
+            if parent_walltimes is not None:
+                parent_ids = numpy.fromiter((segment.parent_id for segment in segments), dtype=numpy.int64, count=n_segs)
+                has_parent = (parent_ids >= 0) & (parent_ids < len(parent_walltimes))
+                predicted[has_parent] = parent_walltimes[parent_ids[has_parent]]
+                known = has_parent & (predicted > 0)
+
+        ema = self.bin_walltime_ema
+        if ema is not None and not known.all():
+            unknown = numpy.flatnonzero(~known)
+            initial_pcoords = numpy.array([segments[iseg].pcoord[0] for iseg in unknown])
+            bin_predictions = ema[self.we_driver.bin_mapper.assign(initial_pcoords)]
+            has_estimate = ~numpy.isnan(bin_predictions)
+            predicted[unknown[has_estimate]] = bin_predictions[has_estimate]
+            known[unknown[has_estimate]] = True
+
+        if known.any() and not known.all():
+            predicted[~known] = predicted[known].mean()
+        return predicted
+
+    def update_walltime_estimates(self):
+        '''Update the per-bin moving average walltimes with the segments completed in this iteration.'''
+        initial_binning = self.we_driver.initial_binning
+        nbins = len(initial_binning)
+        if self.bin_walltime_ema is None or len(self.bin_walltime_ema) != nbins:
+            # No history, or the bin space has changed
+            self.bin_walltime_ema = numpy.empty((nbins,), dtype=numpy.float64)
+            self.bin_walltime_ema.fill(numpy.nan)
+
+        ema = self.bin_walltime_ema
+        alpha = self.walltime_ema_alpha
+        for (ibin, bin) in enumerate(initial_binning):
+            walltimes = [segment.walltime for segment in bin if segment.status == Segment.SEG_STATUS_COMPLETE]
+            if not walltimes:
+                continue
+            mean_walltime = sum(walltimes) / len(walltimes)
+            if numpy.isnan(ema[ibin]):
+                ema[ibin] = mean_walltime
+            else:
+                ema[ibin] = alpha*mean_walltime + (1-alpha)*ema[ibin]
+
+    def schedule_segments(self, segments):
+        '''Return ``segments`` in the order in which they should be dispatched for propagation.
+        With the ``longest_first`` schedule, segments are ordered by decreasing predicted walltime
+        (see ``predict_walltimes``), so that the slowest segments start first and do not determine
+        the length of the iteration by starting last. Segments with the same parent (which share
+        restart data) remain adjacent. Otherwise, the order is unchanged.'''
+        if self.schedule != 'longest_first' or not segments:
+            return segments
+
+        predicted = self.predict_walltimes(segments)
+        n_segs = len(segments)
+        parent_ids = numpy.fromiter((segment.parent_id for segment in segments), dtype=numpy.int64, count=n_segs)
+        seg_ids = numpy.fromiter((segment.seg_id for segment in segments), dtype=numpy.int64, count=n_segs)
+        order = numpy.lexsort((seg_ids, parent_ids, -predicted))
+        log.debug('longest predicted segment walltime {:g} s, mean {:g} s'.format(predicted.max(), predicted.mean()))
+        return [segments[iseg] for iseg in order]
+
+    def load_restarts(self, segments):
+        '''Replace the restart reference of each of ``segments`` with its restart data (or, with
+        ``lazy_restarts``, where possible, a reference which workers resolve themselves just before
+        propagation, so that restart data never passes through the master). Every child of a split
+        walker (or every trajectory started from the same initial state) shares a parent ID and
+        therefore a restart payload, so each payload is read only once and the one object is shared
+        among the segments which use it. Returns the number of distinct payloads.'''
+        restarts = {}
         for seg in segments:
-            seg.restart = self.data_manager.we_h5file[seg.restart]['restart'][seg.parent_id]
+            try:
+                seg.restart = restarts[seg.parent_id]
+            except KeyError:
+                # A reference can only be issued when workers can safely read the file (in SWMR mode)
+                restart = self.data_manager.get_restart_reference(seg) if self.lazy_restarts else None
+                if restart is None:
+                    # References to a previous iteration's data may point into an iteration shard
+                    restart_group = self.data_manager.dereference(seg.restart,
+                                                                  n_iter=(seg.n_iter-1 if seg.parent_id >= 0 else None))
+                    restart = restart_group['restart'][seg.parent_id]
+                seg.restart = restarts[seg.parent_id] = restart
             '''
             try:
                 seg.restart = self.data_manager.we_h5file[seg.restart]['restart'][seg.parent_id]
@@ -538,6 +654,25 @@ class WESimManager:
                     seg.restart = None
                     pass
                     '''
+        log.debug('{:d} unique restarts for {:d} segments'.format(len(restarts), len(segments)))
+        return len(restarts)
+
+    def propagate(self):
+        from westpa.progress import (ProgressIndicator)
+        segments = self.incomplete_segments.values()
+        self.progress = ProgressIndicator()
+        pi = self.progress
+        log.debug('iteration {:d}: propagating {:d} segments'.format(self.n_iter, len(segments)))
+        # Siblings share one restart object, and are dispatched together below, so that a payload is
+        # serialized once per block rather than once per segment (siblings which fall either side of
+        # a block boundary are serialized once in each block)
+        segments.sort(key=operator.attrgetter('parent_id', 'seg_id'))
+        self.load_restarts(segments)
+
+        segments = self.schedule_segments(segments)
+
+        # Straggler detection (if supported) uses task times from this iteration only
+        self.work_manager.reset_task_statistics()
 
         # all futures dispatched for this iteration
         futures = set()
@@ -548,16 +683,27 @@ class WESimManager:
         #self.data_manager.update_initial_states(updated_states, n_iter=self.n_iter+1)
         futures.update(istate_gen_futures)
 
-        # Dispatch propagation tasks using work manager
+        # Dispatch propagation tasks using work manager; these are only speculatively re-executed
+        # if the propagator can cope with two copies of a segment running at once
+        if self.rc.get_propagator().allow_speculation:
+            propagate = wm_ops.propagate_speculatively
+        else:
+            propagate = wm_ops.propagate
         for segment_block in grouper(self.propagator_block_size, segments):
             segment_block = filter(None, segment_block)
             pbstates, pistates = west.states.pare_basis_initial_states(self.current_iter_bstates,
                                                                        self.current_iter_istates.values(), segment_block)
-            future = self.work_manager.submit(wm_ops.propagate, args=(pbstates, pistates, segment_block))
+            future = self.work_manager.submit(propagate, args=(pbstates, pistates, segment_block))
             futures.add(future)
             segment_futures.add(future)
 
         # Since we're storing trajectories, this is now slow slow sloooooow.
+        # Unless writes are handed off to a write-behind thread (west.data.write_behind).
+        if self.data_manager.write_behind:
+            writer = self.data_manager.write_behind_writer()
+            writer.start()
+        else:
+            writer = None
         result_futures = set()
         new_state_futures = set()
         if self.block_write == None:
@@ -565,7 +711,8 @@ class WESimManager:
             self.istate_block_write = 1
         #pi.new_operation('Running simulation', len(futures))
         #with pi:
-        if True:
+        propagated = False
+        try:
             while futures:
                 # TODO: add capacity for timeout or SIGINT here
                 future_return = self.work_manager.wait_any_return_done(futures)
@@ -624,46 +771,59 @@ class WESimManager:
                     else:
                         log.error('unknown future {!r} received from work manager'.format(future))
                         raise AssertionError('untracked future {!r}'.format(future))
-                if float(len(result_futures)) / float(self.block_write) < 1.1 and self.block_write >= 1:
-                    self.block_write -= self.propagator_block_size
-                if self.block_write <= 0:
-                    self.block_write = 1
-
-                if float(len(new_state_futures)) / float(self.istate_block_write) < 1.1 and self.istate_block_write >= 1:
-                    self.istate_block_write -= self.propagator_block_size
-                if self.istate_block_write <= 0:
-                    self.istate_block_write = 1
-
-                if len(result_futures) >= self.block_write:
-                    new_seg_len = len(result_futures)
-                    with self.data_manager.expiring_flushing_lock():
-                        self.data_manager.update_segments(self.n_iter, result_futures)
+                if writer is not None:
+                    if result_futures:
+                        writer.submit_segments(self.n_iter, result_futures)
                         result_futures = set()
-                    #print(self.propagator_block_size)
-                    #result_futures = self.work_manager.submit(self.data_manager.update_segments, args=(self.n_iter, incoming))
-                    # Let's adjust the timing loop, maybe?
-                    #print(float(new_len) / float(self.block_write))
-                    # The idea here is to just... see how many we're returning, and just up the amount we process in one block to optimize writes.
-                    if float(new_seg_len) / float(self.block_write) > 1.1:
-                        self.block_write += self.propagator_block_size
-                    #pi.progress +=(new_seg_len)
-                new_state_len = 1
-                if len(new_state_futures) >= self.istate_block_write:
-                    new_state_len = len(new_state_futures)
-                    with self.data_manager.expiring_flushing_lock():
-                        self.data_manager.update_initial_states(new_state_futures, n_iter=self.n_iter+1)
+                    if new_state_futures:
+                        writer.submit_initial_states(self.n_iter+1, new_state_futures)
                         new_state_futures = set()
-                    if float(new_state_len) / float(self.istate_block_write) > 1.1:
-                        self.istate_block_write += self.propagator_block_size
-                    #pi.progress +=(new_state_len)
+                else:
+                    if float(len(result_futures)) / float(self.block_write) < 1.1 and self.block_write >= 1:
+                        self.block_write -= self.propagator_block_size
+                    if self.block_write <= 0:
+                        self.block_write = 1
+
+                    if float(len(new_state_futures)) / float(self.istate_block_write) < 1.1 and self.istate_block_write >= 1:
+                        self.istate_block_write -= self.propagator_block_size
+                    if self.istate_block_write <= 0:
+                        self.istate_block_write = 1
+
+                    if len(result_futures) >= self.block_write:
+                        new_seg_len = len(result_futures)
+                        with self.data_manager.expiring_flushing_lock():
+                            self.data_manager.update_segments(self.n_iter, result_futures)
+                            result_futures = set()
+                        #print(self.propagator_block_size)
+                        #result_futures = self.work_manager.submit(self.data_manager.update_segments, args=(self.n_iter, incoming))
+                        # Let's adjust the timing loop, maybe?
+                        #print(float(new_len) / float(self.block_write))
+                        # The idea here is to just... see how many we're returning, and just up the amount we process in one block to optimize writes.
+                        if float(new_seg_len) / float(self.block_write) > 1.1:
+                            self.block_write += self.propagator_block_size
+                        #pi.progress +=(new_seg_len)
+                    new_state_len = 1
+                    if len(new_state_futures) >= self.istate_block_write:
+                        new_state_len = len(new_state_futures)
+                        with self.data_manager.expiring_flushing_lock():
+                            self.data_manager.update_initial_states(new_state_futures, n_iter=self.n_iter+1)
+                            new_state_futures = set()
+                        if float(new_state_len) / float(self.istate_block_write) > 1.1:
+                            self.istate_block_write += self.propagator_block_size
+                        #pi.progress +=(new_state_len)
                 #print(new_seg_len, self.block_write, new_state_len, self.istate_block_write, len(futures))
                 if len(futures) == 0:
                     new_istate_futures = self.get_istate_futures()
                     istate_gen_futures.update(new_istate_futures)
                     futures.update(new_istate_futures)
                     #pi.progress -= len(new_istate_futures)
-
-
+            propagated = True
+        finally:
+            if writer is not None:
+                # Wait for all queued data to be written (and the writer thread to exit) before going
+                # on, or before leaving propagation on an error; in that case, an error in the writer
+                # itself must not mask the original one
+                writer.close(check=propagated)
 
         if len(result_futures) > 0:
             with self.data_manager.expiring_flushing_lock():
@@ -679,20 +839,15 @@ class WESimManager:
         #    self.data_manager.aux_h5file.close()
 
     def save_bin_data(self):
-        '''Calculate and write flux and transition count matrices to HDF5. Population and rate matrices
-        are likely useless at the single-tau level and are no longer written.'''
+        '''Calculate and write flux and transition count matrices to HDF5, in sparse (coordinate)
+        form. Population and rate matrices are likely useless at the single-tau level and are no
+        longer written.'''
         # save_bin_data(self, populations, n_trans, fluxes, rates, n_iter=None)
 
         if self.save_transition_matrices:
-            with self.data_manager.expiring_flushing_lock():
-                iter_group = self.data_manager.get_iter_group(self.n_iter)
-                for key in ['bin_ntrans', 'bin_fluxes']:
-                    try:
-                        del iter_group[key]
-                    except KeyError:
-                        pass
-                iter_group['bin_ntrans'] = self.we_driver.transition_matrix
-                iter_group['bin_fluxes'] = self.we_driver.flux_matrix
+            bin_transitions = self.we_driver.bin_transitions
+            with self.data_manager.expiring_flushing_lock(), self.data_manager.suspended_swmr():
+                self.data_manager.save_bin_flux_matrix(self.n_iter, bin_transitions.triplets(), bin_transitions.nbins)
 
     def check_propagation(self):
         '''Check for failures in propagation or initial state generation, and raise an exception
@@ -757,19 +912,17 @@ class WESimManager:
         self.data_manager.save_iter_binning(self.n_iter+1, hashed, pickled, self.we_driver.bin_target_counts)
 
         # Report on recycling
-        recycling_events = {}
-        for nw in self.we_driver.new_weights:
-            try:
-                recycling_events[nw.target_state_id].add(nw.weight)
-            except KeyError:
-                recycling_events[nw.target_state_id] = set([nw.weight])
-
-        tstates_by_id = {state.state_id: state for state in self.we_driver.target_states.itervalues()}
-        for tstate_id, weights in recycling_events.iteritems():
-            tstate = tstates_by_id[tstate_id]
-            self.rc.pstatus('Recycled {:g} probability ({:d} walkers) from target state {!r}'.format(sum(weights),
-                                                                                                     len(weights),
-                                                                                                     tstate.label))
+        new_weights = self.we_driver.new_weights
+        if new_weights and not isinstance(new_weights, NewWeightTable):
+            new_weights = NewWeightTable.from_entries(new_weights, self.system)
+        if new_weights:
+            tstates_by_id = {state.state_id: state for state in self.we_driver.target_states.itervalues()}
+            for tstate_id in numpy.unique(new_weights.target_state_ids):
+                weights = new_weights.weights[new_weights.target_state_ids == tstate_id]
+                tstate = tstates_by_id[tstate_id]
+                self.rc.pstatus('Recycled {:g} probability ({:d} walkers) from target state {!r}'.format(weights.sum(),
+                                                                                                         len(weights),
+                                                                                                         tstate.label))
 
     def prepare_new_iteration(self):
         '''Commit data for the coming iteration to the HDF5 file.'''
@@ -813,9 +966,16 @@ class WESimManager:
                 self.rc.pflush()
 
                 self.pre_propagation()
-                self.propagate()
+                # Allow analysis tools to read the file while segments are propagated, if enabled
+                self.data_manager.begin_swmr()
+                try:
+                    self.propagate()
+                finally:
+                    self.data_manager.end_swmr()
                 self.rc.pflush()
                 self.check_propagation()
+                if self.schedule == 'longest_first':
+                    self.update_walltime_estimates()
                 self.rc.pflush()
                 self.post_propagation()
 
@@ -869,6 +1029,7 @@ class WESimManager:
 
     def prepare_run(self):
         '''Prepare a new run.'''
+        self.we_driver.prepare_run()
         self.data_manager.prepare_run()
         self.system.prepare_run()
         self.invoke_callbacks(self.prepare_run)
@@ -877,6 +1038,7 @@ class WESimManager:
         '''Perform cleanup at the normal end of a run'''
         self.invoke_callbacks(self.finalize_run)
         self.system.finalize_run()
+        self.we_driver.finalize_run()
         self.data_manager.finalize_run()
 
     def pre_propagation(self):
@@ -0,0 +1,699 @@
+from __future__ import division, print_function
+import os, sys, json, shutil, subprocess, tempfile, threading, time
+import cPickle as pickle
+import numpy
+import h5py
+import westpa
+
+import nose.tools
+from westpa._rc import WESTRC
+from west import Segment
+from west.states import InitialState
+from west.systems import WESTSystem
+from west.data_manager import (IterationCache, WESTDataManager, WriteBehindWriter, binning_index_dtype, seg_index_dtype, vbytes_dtype, vstr_dtype,
+                               pack_restart_data, restart_data_bytes, restart_data_for_dtype, write_aux_data)
+from west import data_manager as data_manager_module
+
+
+class TestIterationCache:
+
+    def setup(self):
+        self.cache = IterationCache(max_iters=2)
+        self.loads = []
+
+    def loader(self, value):
+        def load():
+            self.loads.append(value)
+            return value
+        return load
+
+    def test_hits_and_misses(self):
+        assert self.cache.get(1, 'weight', self.loader('a')) == 'a'
+        assert self.cache.get(1, 'weight', self.loader('b')) == 'a'
+        assert self.loads == ['a']
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+    def test_lru_eviction(self):
+        self.cache.get(1, 'weight', self.loader(1))
+        self.cache.get(2, 'weight', self.loader(2))
+        self.cache.get(1, 'weight', self.loader(1))  # iteration 2 is now least recently used
+        self.cache.get(3, 'weight', self.loader(3))
+        assert len(self.cache) == 2
+        self.cache.get(1, 'weight', self.loader(1))
+        self.cache.get(2, 'weight', self.loader(2))
+        assert self.loads == [1, 2, 3, 2]
+
+    def test_invalidate(self):
+        self.cache.get(1, 'weight', self.loader('a'))
+        self.cache.get(2, 'weight', self.loader('b'))
+        self.cache.invalidate(1)
+        assert self.cache.get(1, 'weight', self.loader('c')) == 'c'
+        assert self.cache.get(2, 'weight', self.loader('d')) == 'b'
+        self.cache.clear()
+        assert len(self.cache) == 0
+
+    def test_failed_load_not_cached(self):
+        def failing_load():
+            raise KeyError('no such iteration')
+        nose.tools.assert_raises(KeyError, self.cache.get, 1, 'iter_group', failing_load)
+        assert self.cache.get(1, 'iter_group', self.loader('a')) == 'a'
+
+    def test_failed_load_leaves_no_entry(self):
+        self.cache.get(1, 'weight', self.loader(1))
+        self.cache.get(2, 'weight', self.loader(2))
+        def failing_load():
+            raise KeyError('no such iteration')
+        nose.tools.assert_raises(KeyError, self.cache.get, 3, 'iter_group', failing_load)
+        assert len(self.cache) == 2
+        # Iteration 1 is still cached, and still the least recently used
+        nose.tools.assert_raises(KeyError, self.cache.get, 2, 'iter_group', failing_load)
+        self.cache.get(3, 'weight', self.loader(3))
+        self.cache.get(2, 'weight', self.loader(2))
+        self.cache.get(1, 'weight', self.loader(1))
+        assert self.loads == [1, 2, 3, 1]
+
+
+class StubDataManager:
+    '''Records the writes made by a WriteBehindWriter; writes block while ``gate`` is clear.'''
+
+    def __init__(self, error=None):
+        self.lock = threading.RLock()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.written = threading.Event()
+        self.error = error
+        self.writes = []
+        self.n_flushes = 0
+
+    def expiring_flushing_lock(self):
+        return self.lock
+
+    def update_segments(self, n_iter, segments):
+        self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        self.writes.append(('segments', n_iter, sorted(segments)))
+        self.written.set()
+
+    def update_initial_states(self, initial_states, n_iter=None):
+        self.gate.wait()
+        self.writes.append(('initial_states', n_iter, sorted(initial_states)))
+        self.written.set()
+
+    def flush_backing(self):
+        self.n_flushes += 1
+
+
+class TestWriteBehindWriter:
+
+    def writer(self, data_manager, **kwargs):
+        writer = WriteBehindWriter(data_manager, **kwargs)
+        writer.start()
+        return writer
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline, 'timed out'
+            time.sleep(0.01)
+
+    def test_batch_size(self):
+        dm = StubDataManager()
+        writer = self.writer(dm, batch_size=4, period=60.0)
+        writer.submit_segments(1, [0, 1])
+        writer.submit_initial_states(2, [5])
+        time.sleep(0.1)
+        assert dm.writes == []
+        writer.submit_segments(1, [3, 2])
+        assert dm.written.wait(5.0)
+        # Pending submissions are coalesced into one write per kind and iteration
+        assert dm.writes == [('initial_states', 2, [5]), ('segments', 1, [0, 1, 2, 3])]
+        assert writer.n_writes == 1
+        writer.close()
+        assert dm.n_flushes == 1
+        assert not writer.thread.is_alive()
+
+    def test_period(self):
+        dm = StubDataManager()
+        writer = self.writer(dm, batch_size=100, period=0.2)
+        started = time.time()
+        writer.submit_segments(1, [0])
+        assert dm.written.wait(5.0)
+        assert time.time() - started >= 0.15
+        assert dm.writes == [('segments', 1, [0])]
+        writer.close()
+
+    def test_close_writes_pending(self):
+        dm = StubDataManager()
+        writer = self.writer(dm, batch_size=100, period=60.0)
+        writer.submit_segments(1, [0])
+        writer.submit_segments(1, [1])
+        writer.close()
+        assert dm.writes == [('segments', 1, [0, 1])]
+        assert dm.n_flushes == 1
+
+    def test_back_pressure(self):
+        dm = StubDataManager()
+        dm.gate.clear()
+        writer = self.writer(dm, queue_size=1, batch_size=1, period=60.0)
+        writer.submit_segments(1, [0])
+        # The writer thread takes the first submission and blocks writing it; the next fills the queue
+        self.wait_for(lambda: writer.queue.empty())
+        writer.submit_segments(1, [1])
+        submitter = threading.Thread(target=writer.submit_segments, args=(1, [2]))
+        submitter.start()
+        time.sleep(0.1)
+        assert submitter.is_alive()
+        dm.gate.set()
+        submitter.join(5.0)
+        assert not submitter.is_alive()
+        writer.close()
+        assert [write[2] for write in dm.writes] == [[0], [1], [2]]
+
+    def test_error_on_submit(self):
+        dm = StubDataManager(error=IOError('disk full'))
+        writer = self.writer(dm, batch_size=1, period=60.0)
+        writer.submit_segments(1, [0])
+        self.wait_for(lambda: writer.error is not None)
+        nose.tools.assert_raises(IOError, writer.submit_segments, 1, [1])
+        nose.tools.assert_raises(IOError, writer.submit_initial_states, 2, [0])
+        nose.tools.assert_raises(IOError, writer.close)
+        assert not writer.thread.is_alive()
+
+    def test_error_on_close(self):
+        dm = StubDataManager(error=IOError('disk full'))
+        writer = self.writer(dm, batch_size=100, period=60.0)
+        writer.submit_segments(1, [0])
+        nose.tools.assert_raises(IOError, writer.close)
+
+    def test_close_unchecked(self):
+        # While another exception is being handled, the writer is stopped without raising its own error
+        dm = StubDataManager(error=IOError('disk full'))
+        dm.gate.clear()
+        writer = self.writer(dm, queue_size=1, batch_size=1, period=60.0)
+        writer.submit_segments(1, [0])
+        writer.submit_segments(1, [1])
+        dm.gate.set()
+        writer.close(check=False)
+        assert isinstance(writer.error, IOError)
+        assert not writer.thread.is_alive()
+        assert dm.n_flushes == 1
+
+
+class TestRestartData:
+    tar_data = ''.join(chr(i) for i in xrange(256)) * 4
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.h5file = h5py.File(os.path.join(self.tempdir, 'restart.h5'), 'w')
+
+    def teardown(self):
+        self.h5file.close()
+        shutil.rmtree(self.tempdir)
+
+    def legacy(self):
+        return pickle.dumps(self.tar_data, protocol=0).encode('base64')
+
+    def test_pack(self):
+        restart = pack_restart_data(self.tar_data)
+        assert restart.dtype == vbytes_dtype
+        assert restart_data_bytes(restart).tostring() == self.tar_data
+
+    def test_legacy_bytes(self):
+        assert restart_data_bytes(self.legacy()) == self.tar_data
+        legacy = numpy.empty((), dtype=numpy.object_)
+        legacy[()] = self.legacy()
+        assert restart_data_bytes(legacy) == self.tar_data
+
+    def test_bytes_dataset(self):
+        ds = self.h5file.create_dataset('restarts', shape=(2,), dtype=vbytes_dtype)
+        ds[0] = restart_data_for_dtype(pack_restart_data(self.tar_data), ds.dtype)
+        ds[1] = restart_data_for_dtype(self.legacy(), ds.dtype)
+        for i in xrange(2):
+            assert restart_data_bytes(ds[i]).tostring() == self.tar_data
+
+    def test_legacy_dataset(self):
+        # Data sets created before restart data was stored as raw bytes are appended to in the old format
+        ds = self.h5file.create_dataset('restarts', shape=(2,), dtype=vstr_dtype)
+        ds[0] = restart_data_for_dtype(pack_restart_data(self.tar_data), ds.dtype)
+        ds[1] = restart_data_for_dtype(self.legacy(), ds.dtype)
+        for i in xrange(2):
+            assert isinstance(ds[i], basestring)
+            assert restart_data_bytes(ds[i]) == self.tar_data
+
+    def test_none(self):
+        assert restart_data_for_dtype(None, vbytes_dtype) is None
+
+
+class TestWriteAuxData:
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.h5file = h5py.File(os.path.join(self.tempdir, 'aux.h5'), 'w')
+
+    def teardown(self):
+        self.h5file.close()
+        shutil.rmtree(self.tempdir)
+
+    def segments(self, seg_ids, make_data):
+        segments = []
+        for seg_id in seg_ids:
+            segment = Segment(n_iter=1, seg_id=seg_id)
+            segment.data['aux'] = make_data(seg_id)
+            segments.append(segment)
+        return segments
+
+    def test_runs(self):
+        dset = self.h5file.create_dataset('aux', shape=(12,2,3), dtype=numpy.float64)
+        # Three runs of contiguous IDs (0-2, 5-6, 9-11), given out of order; segment 4 has no data
+        seg_ids = [6, 0, 11, 2, 9, 5, 1, 10]
+        segments = self.segments(seg_ids, lambda seg_id: numpy.zeros((2,3)) + seg_id)
+        segments.append(Segment(n_iter=1, seg_id=4))
+        write_aux_data(dset, 'aux', segments)
+
+        expected = numpy.zeros((12,2,3))
+        for seg_id in seg_ids:
+            expected[seg_id] = seg_id
+        assert (dset[...] == expected).all()
+
+    def test_odd_shape(self):
+        dset = self.h5file.create_dataset('aux', shape=(4,3), dtype=numpy.int32)
+        segments = self.segments([0,1,3], lambda seg_id: numpy.arange(3) + 10*seg_id)
+        segments.append(self.segments([2], lambda seg_id: numpy.array([7,7]))[0])
+        write_aux_data(dset, 'aux', segments)
+        assert (dset[...] == [[0,1,2], [10,11,12], [7,7,0], [30,31,32]]).all()
+
+    def test_vlen(self):
+        dset = self.h5file.create_dataset('restart', shape=(5,), dtype=vbytes_dtype)
+        seg_ids = [3, 0, 4]
+        segments = self.segments(seg_ids, lambda seg_id: pack_restart_data(b'restart %d' % seg_id))
+        write_aux_data(dset, 'aux', segments)
+        for seg_id in seg_ids:
+            assert restart_data_bytes(dset[seg_id]).tostring() == b'restart %d' % seg_id
+        assert len(dset[1]) == len(dset[2]) == 0
+
+
+class DataManagerTestBase:
+    data_options = {}
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.rc = WESTRC()
+        data_options = {'west_data_file': os.path.join(self.tempdir, 'west.h5')}
+        data_options.update(self.data_options)
+        self.rc.config['west'] = {'data': data_options}
+        self.data_manager = WESTDataManager(rc=self.rc)
+        self.data_manager.prepare_backing()
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+
+
+class TestBinMapperIndex(DataManagerTestBase):
+
+    def test_hash_to_row(self):
+        dm = self.data_manager
+        assert dm.save_bin_mapper('aaaa', b'mapper a') == 0
+        assert dm.save_bin_mapper('bbbb', b'mapper b') == 1
+        assert dm.save_bin_mapper('aaaa', b'mapper a') == 0
+        assert dm._bin_mapper_rows == {'aaaa': 0, 'bbbb': 1}
+        nose.tools.assert_raises(KeyError, dm.find_bin_mapper, 'cccc')
+
+    def test_rows_written_after_open(self):
+        dm = self.data_manager
+        dm.save_bin_mapper('aaaa', b'mapper a')
+        dm.close_backing()
+        dm.open_backing()
+        assert dm._bin_mapper_rows_scanned == 0
+        assert dm.find_bin_mapper('aaaa') == 0
+        assert dm._bin_mapper_rows_scanned == 1
+
+        # Append a row behind the data manager's back, as another writer would
+        index = dm.we_h5file['/bin_topologies/index']
+        index.resize((2,))
+        index[1] = numpy.array([('cccc', 0)], dtype=binning_index_dtype)[0]
+        assert dm.find_bin_mapper('cccc') == 1
+        assert dm._bin_mapper_rows_scanned == 2
+        assert dm.save_bin_mapper('dddd', b'mapper d') == 2
+        assert dm.find_bin_mapper('dddd') == 2
+
+
+class TestBinFluxMatrix(DataManagerTestBase):
+
+    def test_roundtrip(self):
+        dm = self.data_manager
+        dm.require_iter_group(1)
+        triplets = (numpy.array([0, 0, 2, 3]), numpy.array([1, 3, 2, 0]),
+                    numpy.array([0.25, 0.5, 0.125, 0.125]), numpy.array([1, 4, 2, 1], dtype=numpy.uint))
+        dm.save_bin_flux_matrix(1, triplets, 4)
+        assert 'bin_fluxes' not in dm.get_iter_group(1)
+        (rows, cols, fluxes, counts, shape) = dm.get_bin_flux_matrix(1)
+        assert shape == (4,4)
+        for (read, written) in zip((rows, cols, fluxes, counts), triplets):
+            assert (read == written).all()
+
+    def test_replace(self):
+        dm = self.data_manager
+        dm.require_iter_group(1)
+        dm.save_bin_flux_matrix(1, ([0], [1], [1.0], [1]), 2)
+        dm.save_bin_flux_matrix(1, ([1], [0], [0.5], [3]), 2)
+        (rows, cols, fluxes, counts, shape) = dm.get_bin_flux_matrix(1)
+        assert list(rows) == [1] and list(cols) == [0]
+        assert list(fluxes) == [0.5] and list(counts) == [3]
+
+    def test_legacy_dense(self):
+        dm = self.data_manager
+        iter_group = dm.require_iter_group(1)
+        fluxes = numpy.zeros((3,3), dtype=numpy.float64)
+        counts = numpy.zeros((3,3), dtype=numpy.uint)
+        fluxes[0,2] = 0.75
+        counts[0,2] = 3
+        fluxes[1,1] = 0.25
+        counts[1,1] = 1
+        iter_group['bin_fluxes'] = fluxes
+        iter_group['bin_ntrans'] = counts
+        (rows, cols, read_fluxes, read_counts, shape) = dm.get_bin_flux_matrix(1)
+        assert shape == (3,3)
+        assert list(rows) == [0, 1] and list(cols) == [2, 1]
+        assert list(read_fluxes) == [0.75, 0.25]
+        assert list(read_counts) == [3, 1]
+
+
+class TestSharding(DataManagerTestBase):
+    data_options = {'iterations_per_shard': 2}
+
+    def write_iteration(self, n_iter):
+        iter_group = self.data_manager.require_iter_group(n_iter)
+        iter_group.create_dataset('data', data=numpy.arange(n_iter*10))
+        seg_index = numpy.zeros((n_iter,), dtype=seg_index_dtype)
+        seg_index['weight'] = 1.0/n_iter
+        iter_group.create_dataset('seg_index', data=seg_index)
+        iter_group.create_dataset('pcoord', data=numpy.arange(n_iter*2, dtype=numpy.float32).reshape(n_iter,2,1))
+        return iter_group
+
+    def test_shard_filename(self):
+        dm = self.data_manager
+        assert dm.shard_filename(1) == 'west_iters_00000001.h5'
+        assert dm.shard_filename(2) == 'west_iters_00000001.h5'
+        assert dm.shard_filename(3) == 'west_iters_00000003.h5'
+        dm.shard_file = '{basename}_{shard:d}_{first_iter:d}-{last_iter:d}.h5'
+        assert dm.shard_filename(4) == 'west_1_3-4.h5'
+
+    def test_require_iter_group(self):
+        dm = self.data_manager
+        for n_iter in (1, 2, 3):
+            self.write_iteration(n_iter)
+        for n_iter in (1, 2, 3):
+            link = dm.we_h5file.get(dm.iter_group_name(n_iter), getlink=True)
+            assert isinstance(link, h5py.ExternalLink)
+            assert link.filename == dm.shard_filename(n_iter)
+            assert os.path.exists(os.path.join(self.tempdir, link.filename))
+            assert dm.require_iter_group(n_iter).attrs['n_iter'] == n_iter
+            assert (dm.get_iter_group(n_iter)['data'][...] == numpy.arange(n_iter*10)).all()
+
+    def test_del_iter_group(self):
+        dm = self.data_manager
+        self.write_iteration(1)
+        self.write_iteration(2)
+        dm.del_iter_group(2)
+        assert dm.iter_group_name(2) not in dm.we_h5file
+        assert dm.iter_group_name(1) in dm.we_h5file
+        dm.close_backing()
+        with h5py.File(os.path.join(self.tempdir, dm.shard_filename(2)), 'r') as shard_file:
+            assert dm.iter_group_name(1) in shard_file
+            assert dm.iter_group_name(2) not in shard_file
+        dm.open_backing()
+
+    def test_dereference(self):
+        dm = self.data_manager
+        ref = self.write_iteration(3)['data'].ref
+        assert dm.dereference(ref, 3).name == dm.iter_group_name(3) + '/data'
+        ref = dm.we_h5file['summary'].ref
+        assert dm.dereference(ref).name == '/summary'
+
+    def test_flush_shard(self):
+        dm = self.data_manager
+        self.write_iteration(1)
+        dm.flush_backing()
+        # Read the shard from another process, as an analysis tool would
+        environ = dict(os.environ, HDF5_USE_FILE_LOCKING='FALSE')
+        script = 'import h5py; print(h5py.File({!r}, "r")[{!r}].shape[0])'.format(
+            os.path.join(self.tempdir, dm.shard_filename(1)), dm.iter_group_name(1) + '/data')
+        output = subprocess.check_output([sys.executable, '-c', script], env=environ)
+        assert int(output) == 10
+
+    def test_compact(self):
+        dm = self.data_manager
+        for n_iter in (1, 2, 3):
+            self.write_iteration(n_iter)
+        dm.current_iteration = 4
+        dm.close_backing()
+
+        rcfile = os.path.join(self.tempdir, 'west.cfg')
+        with open(rcfile, 'wt') as outfile:
+            outfile.write('west:\n  data:\n    west_data_file: {}\n'.format(dm.we_h5filename))
+        w_compact = os.path.join(os.environ['WEST_ROOT'], 'lib', 'cmds', 'w_compact.py')
+        subprocess.check_call([sys.executable, w_compact, '-r', rcfile, '--remove-shards', '--aggregate'],
+                              stdout=open(os.devnull, 'wb'))
+
+        dm.open_backing()
+        for n_iter in (1, 2, 3):
+            assert dm.we_h5file.get(dm.iter_group_name(n_iter), getlink=True).__class__ is h5py.HardLink
+            assert (dm.get_iter_group(n_iter)['data'][...] == numpy.arange(n_iter*10)).all()
+            assert not os.path.exists(os.path.join(self.tempdir, dm.shard_filename(n_iter)))
+        final_pcoord = dm.we_h5file['/aggregates/final_pcoord'][...]
+        assert final_pcoord.shape == (3,3,1)
+        assert (final_pcoord[2,:,0] == [1,3,5]).all()
+        assert numpy.isnan(final_pcoord[0,1:]).all()
+
+
+swmr_reader_script = '''
+import sys, json
+from westpa._rc import WESTRC
+from west.data_manager import WESTDataManager
+rc = WESTRC()
+rc.config['west'] = {'data': {'west_data_file': sys.argv[1]}}
+data_manager = WESTDataManager(rc=rc)
+data_manager.open_backing(follow=True)
+iter_group = data_manager.get_iter_group(2)
+json.dump({'weight': iter_group['seg_index']['weight'].tolist(),
+           'pcoord': iter_group['pcoord'][:,-1,0].tolist(),
+           'aux': iter_group['auxdata/aux'][...].tolist(),
+           'n_istates': len(data_manager.find_ibstate_group(3)['istate_index'])}, sys.stdout)
+'''
+
+restart_reader_script = '''
+import sys, json
+import cPickle as pickle
+from west.data_manager import restart_data_bytes
+references = pickle.load(sys.stdin)
+json.dump([restart_data_bytes(reference.load()).tostring() for reference in references], sys.stdout)
+'''
+
+class TestInitialStates(DataManagerTestBase):
+
+    def setup(self):
+        DataManagerTestBase.setup(self)
+        system = WESTSystem(rc=self.rc)
+        system.pcoord_ndim = 1
+        system.pcoord_len = 2
+        system.pcoord_dtype = numpy.float32
+        self.rc._system = system
+        self.saved_rc, westpa.rc = westpa.rc, self.rc
+        self.data_manager.create_ibstate_group([], n_iter=1)
+
+    def teardown(self):
+        westpa.rc = self.saved_rc
+        DataManagerTestBase.teardown(self)
+
+    def tables(self):
+        ibstate_group = self.data_manager.find_ibstate_group(1)
+        return ibstate_group['istate_index'][...], ibstate_group['istate_pcoord'][...]
+
+    def prepare(self, istates, offset=0):
+        for istate in istates:
+            istate.basis_state_id = 0
+            istate.istate_type = InitialState.ISTATE_TYPE_BASIS
+            istate.istate_status = InitialState.ISTATE_STATUS_PREPARED
+            istate.pcoord = numpy.array([istate.state_id + offset], dtype=numpy.float32)
+
+    def test_create_batch(self):
+        dm = self.data_manager
+        istates = dm.create_initial_states(5, n_iter=1)
+        assert [istate.state_id for istate in istates] == range(5)
+        more_istates = dm.create_initial_states(3, n_iter=1)
+        assert [istate.state_id for istate in more_istates] == range(5,8)
+
+        index, pcoords = self.tables()
+        assert len(index) == len(pcoords) == 8
+        assert (index['iter_created'] == 1).all()
+        assert (index['istate_status'] == InitialState.ISTATE_STATUS_PENDING).all()
+
+    def test_update_contiguous(self):
+        dm = self.data_manager
+        istates = dm.create_initial_states(5, n_iter=1)
+        self.prepare(istates)
+        dm.update_initial_states(reversed(istates), n_iter=1)
+
+        index, pcoords = self.tables()
+        assert (index['istate_status'] == InitialState.ISTATE_STATUS_PREPARED).all()
+        assert (index['basis_state_id'] == 0).all()
+        assert (pcoords[:,0] == numpy.arange(5)).all()
+
+    def test_update_with_gap(self):
+        dm = self.data_manager
+        istates = dm.create_initial_states(5, n_iter=1)
+        self.prepare(istates)
+        dm.update_initial_states(istates, n_iter=1)
+
+        updated = [istates[3], istates[0], istates[4]]
+        self.prepare(updated, offset=10)
+        dm.update_initial_states(updated, n_iter=1)
+
+        index, pcoords = self.tables()
+        assert (index['istate_status'] == InitialState.ISTATE_STATUS_PREPARED).all()
+        assert list(pcoords[:,0]) == [10, 1, 2, 13, 14]
+
+
+class TestSWMR(DataManagerTestBase):
+    data_options = {'swmr': True}
+
+    def setup(self):
+        DataManagerTestBase.setup(self)
+        system = WESTSystem(rc=self.rc)
+        system.pcoord_ndim = 1
+        system.pcoord_len = 2
+        system.pcoord_dtype = numpy.float32
+        self.rc._system = system
+        self.saved_rc, westpa.rc = westpa.rc, self.rc
+
+        dm = self.data_manager
+        dm.create_ibstate_group([], n_iter=1)
+        dm.save_target_states([], n_iter=1)
+        istates = dm.create_initial_states(2, n_iter=1)
+        for istate in istates:
+            istate.pcoord = numpy.zeros((1,), dtype=numpy.float32)
+        dm.update_initial_states(istates, n_iter=1)
+
+    def teardown(self):
+        westpa.rc = self.saved_rc
+        DataManagerTestBase.teardown(self)
+
+    def segments(self, n_iter, n_segments=2):
+        # The first iteration starts from initial states, which are continued thereafter
+        return [Segment(n_iter=n_iter, seg_id=seg_id, parent_id=(-(seg_id+1) if n_iter == 1 else seg_id),
+                        weight=1.0/n_segments,
+                        status=Segment.SEG_STATUS_PREPARED, pcoord=numpy.zeros((1,1), dtype=numpy.float32))
+                for seg_id in xrange(n_segments)]
+
+    def propagate(self, segments):
+        for segment in segments:
+            segment.status = Segment.SEG_STATUS_COMPLETE
+            segment.pcoord = numpy.array([[0],[segment.seg_id+segment.n_iter]], dtype=numpy.float32)
+            segment.data['aux'] = numpy.arange(3, dtype=numpy.float64) + segment.seg_id
+
+    def run_iteration(self, n_iter):
+        dm = self.data_manager
+        segments = self.segments(n_iter)
+        dm.prepare_iteration(n_iter, segments)
+        dm.current_iteration = n_iter
+        assert dm.begin_swmr()
+        self.propagate(segments)
+        dm.update_segments(n_iter, segments)
+        return segments
+
+    def test_no_reopen(self):
+        dm = self.data_manager
+        self.run_iteration(1)
+        dm.end_swmr()
+
+        # Data sets needed during propagation exist before SWMR mode is entered, so the file is
+        # never reopened while segments are written (including the initial state tables of a new
+        # set of basis states taking effect next iteration)
+        dm.create_ibstate_group([], n_iter=3)
+        dm.prepare_iteration(2, self.segments(2))
+        assert 'auxdata/aux' in dm.get_iter_group(2)
+        assert 'istate_index' in dm.find_ibstate_group(3)
+        assert dm.begin_swmr()
+        h5file = dm.we_h5file
+        segments = self.segments(2)
+        self.propagate(segments)
+        dm.update_segments(2, segments)
+        istates = dm.create_initial_states(2, n_iter=3)
+        for istate in istates:
+            istate.pcoord = numpy.zeros((1,), dtype=numpy.float32)
+        dm.update_initial_states(istates, n_iter=3)
+        dm.flush_backing()
+        assert dm.in_swmr
+        assert dm.we_h5file is h5file
+
+        # Read the file as w_* tools do with --follow, while it is still being written
+        output = subprocess.check_output([sys.executable, '-c', swmr_reader_script, dm.we_h5filename])
+        result = json.loads(output)
+        assert result['weight'] == [0.5, 0.5]
+        assert result['pcoord'] == [2, 3]
+        assert result['aux'] == [[0,1,2], [1,2,3]]
+        assert result['n_istates'] == 2
+
+    def test_deferred_vlen(self):
+        dm = self.data_manager
+        segments = self.run_iteration(1)
+        for segment in segments:
+            segment.data['trajectories/restart'] = pack_restart_data(b'restart %d' % segment.seg_id)
+        dm.update_segments(1, segments)
+        restarts = dm.get_iter_group(1)['auxdata/trajectories/restart']
+        assert all(len(restart) == 0 for restart in restarts[...])
+
+        dm.end_swmr()
+        istates = dm.create_initial_states(2, n_iter=2)
+        assert dm.begin_swmr()
+        for istate in istates:
+            istate.pcoord = numpy.zeros((1,), dtype=numpy.float32)
+            istate.data['trajectories/restart'] = pack_restart_data(b'istate %d' % istate.state_id)
+        dm.update_initial_states(istates, n_iter=2)
+
+        # Variable-length data is written on leaving SWMR mode
+        dm.end_swmr()
+        restarts = dm.get_iter_group(1)['auxdata/trajectories/restart'][...]
+        assert [restart_data_bytes(restart).tostring() for restart in restarts] == [b'restart 0', b'restart 1']
+        istate_index = dm.find_ibstate_group(2)['istate_index'][...]
+        for istate in istates:
+            assert restart_data_bytes(istate_index[istate.state_id]['restart']).tostring() == b'istate %d' % istate.state_id
+
+    def test_restart_references(self):
+        dm = self.data_manager
+        segments = self.run_iteration(1)
+        for segment in segments:
+            segment.data['trajectories/restart'] = pack_restart_data(b'restart %d' % segment.seg_id)
+        dm.update_segments(1, segments)
+        dm.end_swmr()
+        (istate,) = dm.create_initial_states(1, n_iter=2)
+        istate.pcoord = numpy.zeros((1,), dtype=numpy.float32)
+        istate.data['trajectories/restart'] = pack_restart_data(b'istate %d' % istate.state_id)
+        dm.update_initial_states([istate], n_iter=2)
+
+        # One continuing segment, and one started from a new initial state
+        segments = [Segment(n_iter=2, seg_id=0, parent_id=1), Segment(n_iter=2, seg_id=1, parent_id=-(istate.state_id+1))]
+
+        # Outside SWMR mode, other processes cannot safely open the file
+        assert [dm.get_restart_reference(segment) for segment in segments] == [None, None]
+
+        assert dm.begin_swmr()
+        references = [dm.get_restart_reference(segment) for segment in segments]
+        expected = [b'restart 1', b'istate %d' % istate.state_id]
+
+        # Resolve the references in another process (as a worker would) while this one holds the file open
+        reader = subprocess.Popen([sys.executable, '-c', restart_reader_script], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        (output, _) = reader.communicate(pickle.dumps(references, pickle.HIGHEST_PROTOCOL))
+        assert reader.returncode == 0
+        assert json.loads(output) == expected
+
+        # ...and in this one, as with the serial and threads work managers
+        try:
+            assert [restart_data_bytes(reference.load()).tostring() for reference in references] == expected
+            assert len(data_manager_module._restart_h5files) == 1
+        finally:
+            dm.end_swmr()
+            dm.finalize_run()
+        assert data_manager_module._restart_h5files == {}
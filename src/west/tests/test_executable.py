@@ -0,0 +1,428 @@
+from __future__ import division, print_function
+import os, sys, json, shutil, tempfile, threading, time
+import cPickle as pickle
+import numpy
+import argparse
+import westpa
+from westpa._rc import WESTRC
+from west import Segment
+from west.systems import WESTSystem
+
+# Error reporting in west.propagators.executable is set up from the run-time configuration (which
+# must include a system) when the module is imported
+os.environ['WEST_SIM_ROOT'] = os.path.join(os.environ['WEST_ROOT'], 'lib/examples/odld')
+_parser = argparse.ArgumentParser()
+westpa.rc.add_args(_parser)
+westpa.rc.process_args(_parser.parse_args(['-r={}'.format(os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg'))]))
+from west.propagators.executable import (ExecutablePropagator, ScratchDirectory, load_return_data,
+                                         restart_input, restart_output)
+from west.data_manager import vbytes_dtype, restart_data_bytes
+
+import nose
+import nose.tools
+
+class TestReturnData:
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.data = numpy.arange(12, dtype=numpy.float64).reshape(6,2) / 4
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_text(self):
+        filename = os.path.join(self.tempdir, 'pcoord.dat')
+        numpy.savetxt(filename, self.data)
+        assert (load_return_data(filename) == self.data).all()
+
+    def test_npy(self):
+        filename = os.path.join(self.tempdir, 'pcoord.npy')
+        numpy.save(filename, self.data)
+        loaded = load_return_data(filename, dtype=numpy.float32)
+        assert loaded.dtype == numpy.float32
+        assert loaded.shape == (6,2)
+        assert (loaded == self.data.astype(numpy.float32)).all()
+
+
+class TestScratchDirectory:
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.scratch = ScratchDirectory(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def wait_until_free(self, slot, timeout=5.0):
+        deadline = time.time() + timeout
+        while slot not in self.scratch.free_slots:
+            assert time.time() < deadline, 'slot {!r} was never freed'.format(slot)
+            time.sleep(0.01)
+
+    def test_slot_reuse(self):
+        slot = self.scratch.acquire_slot()
+        assert self.scratch.owns(os.path.join(slot, 'pcoord'))
+        assert not self.scratch.owns(os.path.join(self.tempdir, 'pcoord'))
+        other_slot = self.scratch.acquire_slot()
+        assert other_slot != slot
+        with open(os.path.join(slot, 'pcoord'), 'wt') as outfile:
+            outfile.write('1.0\n')
+        os.mkdir(os.path.join(slot, 'restart'))
+        with open(os.path.join(slot, 'restart', 'restart.rst'), 'wt') as outfile:
+            outfile.write('restart\n')
+
+        # Emptied in the background, then reused
+        self.scratch.release_slot(slot)
+        self.wait_until_free(slot)
+        assert os.listdir(slot) == []
+        assert self.scratch.acquire_slot() == slot
+        assert self.scratch.n_slots == 2
+
+    def test_cleanup_survives_errors(self):
+        slot = self.scratch.acquire_slot()
+        shutil.rmtree(slot)
+        # The slot cannot be listed, so it is dropped; the cleanup thread carries on
+        self.scratch.release_slot(slot)
+        other_slot = self.scratch.acquire_slot()
+        self.scratch.release_slot(other_slot)
+        self.wait_until_free(other_slot)
+        assert slot not in self.scratch.free_slots
+        assert self.scratch.cleanup_thread.is_alive()
+
+    def test_fork(self):
+        slot = self.scratch.acquire_slot()
+        root = self.scratch.root
+        # As if the scratch directory had been created before this process was forked
+        self.scratch.pid = -1
+        new_slot = self.scratch.acquire_slot()
+        assert self.scratch.root != root
+        assert self.scratch.pid == os.getpid()
+        assert self.scratch.owns(new_slot)
+        assert not self.scratch.owns(slot)
+        assert self.scratch.n_slots == 1
+
+gang_script = '''#!{python}
+import os, sys, json
+manifest = os.environ['WEST_SEGMENT_MANIFEST']
+with open(manifest) as infile:
+    entries = json.load(infile)['segments']
+with open({record!r}, 'wt') as outfile:
+    json.dump(entries, outfile)
+for entry in entries:
+    seg_id = entry['seg_id']
+    with open(entry['environ']['WEST_PCOORD_RETURN'], 'wt') as outfile:
+        outfile.write('{{0}}\\n{{1}}\\n'.format(seg_id+1, seg_id+2))
+    if {seg_rcs!r} is not None:
+        entry['rc'] = {seg_rcs!r}[seg_id]
+returned = entries[:{n_returned!r}] + [dict(entries[0], seg_id=seg_id) for seg_id in {extra_seg_ids!r}]
+if {reverse!r}:
+    returned.reverse()
+with open(manifest, 'wt') as outfile:
+    json.dump({{'segments': returned}}, outfile)
+sys.exit({rc:d})
+'''
+
+segment_script = '''#!{python}
+import os, sys, json, time
+seg_id = int(os.path.basename(os.environ['WEST_CURRENT_SEG_DATA_REF']))
+started = time.time()
+time.sleep({delay!r})
+with open(os.environ['WEST_PCOORD_RETURN'], 'wt') as outfile:
+    outfile.write('{{0}}\\n{{1}}\\n'.format(seg_id+1, seg_id+2))
+with open(os.path.join({record_dir!r}, str(seg_id)), 'wt') as outfile:
+    json.dump({{'cwd': os.getcwd(), 'seg_data_ref': os.environ['WEST_CURRENT_SEG_DATA_REF'],
+               'started': started, 'finished': time.time()}}, outfile)
+'''
+
+speculation_script = '''#!{python}
+import os, sys, json, time
+started = time.time()
+time.sleep({delay!r})
+with open(os.environ['WEST_PCOORD_RETURN'], 'wt') as outfile:
+    outfile.write('1\\n2\\n')
+with open(os.environ['WEST_TRAJECTORY_RETURN'], 'wt') as outfile:
+    outfile.write('trajectory\\n')
+with open(os.path.join(os.environ['WEST_RESTART_RETURN'], 'seg.rst'), 'wt') as outfile:
+    outfile.write(str(os.getpid()))
+with open(os.path.join({record_dir!r}, str(os.getpid())), 'wt') as outfile:
+    json.dump({{'cwd': os.getcwd(), 'seg_data_ref': os.environ['WEST_CURRENT_SEG_DATA_REF'],
+               'parent_restart': open('parent.rst').read(), 'started': started, 'finished': time.time()}}, outfile)
+'''
+
+class PropagatorTestBase:
+    propagator_options = {}
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.rc = WESTRC()
+        self.system = WESTSystem(rc=self.rc)
+        self.system.pcoord_ndim = 1
+        self.system.pcoord_len = 2
+        self.system.pcoord_dtype = numpy.float32
+        self.rc._system = self.system
+        self.saved_rc, westpa.rc = westpa.rc, self.rc
+
+        propagator_options = {'executable': os.path.join(self.tempdir, 'runseg.py')}
+        propagator_options.update(self.propagator_options)
+        self.rc.config['west'] = {'executable': {'propagator': propagator_options,
+                                                 'environ': {}},
+                                  'data': {'data_refs': {'segment': os.path.join(self.tempdir, '{segment.n_iter:06d}/{segment.seg_id:06d}'),
+                                                         'basis_state': os.path.join(self.tempdir, 'bstates'),
+                                                         'initial_state': os.path.join(self.tempdir, 'istates')}}}
+
+    def tearDown(self):
+        westpa.rc = self.saved_rc
+        shutil.rmtree(self.tempdir)
+
+    def write_script(self, template, **kwargs):
+        script = self.rc.config['west', 'executable', 'propagator', 'executable']
+        with open(script, 'wt') as outfile:
+            outfile.write(template.format(python=sys.executable, **kwargs))
+        os.chmod(script, 0o755)
+
+    def segments(self, n_segments):
+        return [Segment(n_iter=2, seg_id=seg_id, parent_id=seg_id, weight=1.0/n_segments,
+                        status=Segment.SEG_STATUS_PREPARED,
+                        pcoord=self.system.new_pcoord_array())
+                for seg_id in xrange(n_segments)]
+
+class TestConcurrentPropagation(PropagatorTestBase):
+    propagator_options = {'concurrency': 4}
+
+    def test_concurrent_block(self):
+        record_dir = os.path.join(self.tempdir, 'records')
+        os.mkdir(record_dir)
+        self.write_script(segment_script, delay=0.5, record_dir=record_dir)
+        propagator = ExecutablePropagator(rc=self.rc)
+        segments = self.segments(4)
+        try:
+            propagated = propagator.propagate(segments)
+        finally:
+            propagator.shutdown_segment_pool()
+        assert propagator._segment_pool is None
+
+        assert propagated == segments
+        for segment in segments:
+            assert segment.status == Segment.SEG_STATUS_COMPLETE
+            assert (segment.pcoord[:,0] == [segment.seg_id+1, segment.seg_id+2]).all()
+
+        records = [json.load(open(os.path.join(record_dir, str(segment.seg_id)))) for segment in segments]
+        cwds = set(os.path.realpath(record['cwd']) for record in records)
+        assert len(cwds) == 4
+        for (segment, record) in zip(segments, records):
+            assert os.path.realpath(record['cwd']) == os.path.realpath(record['seg_data_ref'])
+            assert record['seg_data_ref'] == os.path.join(self.tempdir, '000002/{:06d}'.format(segment.seg_id))
+        # All four ran at once
+        assert max(record['started'] for record in records) < min(record['finished'] for record in records)
+
+class TestSpeculativePropagation(PropagatorTestBase):
+    def setUp(self):
+        PropagatorTestBase.setUp(self)
+        # Segment directories are removed after propagation
+        self.seg_rundir = os.path.join(self.tempdir, 'traj_segs')
+        self.rc.config['west']['data']['data_refs'] = {'seg_rundir': self.seg_rundir,
+                                                       'trajectories': os.path.join(self.tempdir, 'trajectories'),
+                                                       'basis_state': os.path.join(self.tempdir, 'bstates'),
+                                                       'initial_state': os.path.join(self.tempdir, 'istates')}
+        self.record_dir = os.path.join(self.tempdir, 'records')
+        os.mkdir(self.record_dir)
+
+    def segments(self, n_segments):
+        parent_dir = os.path.join(self.tempdir, 'parent')
+        os.mkdir(parent_dir)
+        with open(os.path.join(parent_dir, 'parent.rst'), 'wt') as outfile:
+            outfile.write('parent\n')
+        segments = PropagatorTestBase.segments(self, n_segments)
+        for segment in segments:
+            restart_input('restart', parent_dir, segment, False)
+            segment.restart = segment.data.pop('trajectories/restart')
+        shutil.rmtree(parent_dir)
+        return segments
+
+    def test_allowed(self):
+        assert ExecutablePropagator(rc=self.rc).allow_speculation
+
+        # Not if another copy could overwrite files which are kept
+        self.rc.config['west']['executable']['datasets'] = [{'name': 'aux', 'filename': os.path.join(self.tempdir, 'aux-{segment.seg_id}')}]
+        assert not ExecutablePropagator(rc=self.rc).allow_speculation
+        del self.rc.config['west']['executable']['datasets']
+        self.rc.config['west']['executable']['propagator']['cleanup'] = False
+        assert not ExecutablePropagator(rc=self.rc).allow_speculation
+
+    def test_segment_directories_kept(self):
+        self.rc.config['west']['data']['data_refs'] = {'segment': os.path.join(self.tempdir, '{segment.n_iter:06d}/{segment.seg_id:06d}'),
+                                                       'basis_state': os.path.join(self.tempdir, 'bstates'),
+                                                       'initial_state': os.path.join(self.tempdir, 'istates')}
+        assert not ExecutablePropagator(rc=self.rc).allow_speculation
+
+    def test_concurrent_copies(self):
+        self.write_script(speculation_script, delay=0.5, record_dir=self.record_dir)
+        propagator = ExecutablePropagator(rc=self.rc)
+
+        # Two copies of the same segment, as if one had been speculatively re-executed
+        copies = [self.segments(1)[0] for _i in xrange(2)]
+        threads = [threading.Thread(target=propagator.propagate, args=([segment],)) for segment in copies]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        records = [json.load(open(os.path.join(self.record_dir, name))) for name in os.listdir(self.record_dir)]
+        assert len(records) == 2
+        assert max(record['started'] for record in records) < min(record['finished'] for record in records)
+        seg_data_ref = os.path.join(self.seg_rundir, '000002', '000000')
+        for record in records:
+            assert os.path.realpath(record['cwd']) == os.path.realpath(record['seg_data_ref'])
+            assert record['seg_data_ref'].startswith(seg_data_ref + '.')
+            assert record['parent_restart'] == 'parent\n'
+        assert records[0]['seg_data_ref'] != records[1]['seg_data_ref']
+
+        # Each copy returns its own outputs, and removes its own directory
+        pids = set()
+        for segment in copies:
+            assert segment.status == Segment.SEG_STATUS_COMPLETE
+            assert (segment.pcoord[:,0] == [1, 2]).all()
+            output_dir = tempfile.mkdtemp(dir=self.tempdir)
+            segment.restart = segment.data['trajectories/restart']
+            restart_output(output_dir, segment)
+            pids.add(open(os.path.join(output_dir, 'seg.rst')).read())
+        assert pids == set(os.listdir(self.record_dir))
+        assert os.listdir(os.path.join(self.seg_rundir, '000002')) == []
+
+    def test_remove_cancelled_directories(self):
+        propagator = ExecutablePropagator(rc=self.rc)
+        segments = self.segments(2)
+        iter_dir = os.path.join(self.seg_rundir, '000002')
+        # The directory of a cancelled copy of segment 0, and of segment 1 itself (kept by the user)
+        os.makedirs(os.path.join(iter_dir, '000000.cancelled'))
+        os.makedirs(os.path.join(iter_dir, '000001'))
+        propagator.finalize_iteration(2, segments[:1])
+        assert os.listdir(iter_dir) == ['000001']
+
+class TestGangPropagation(PropagatorTestBase):
+    propagator_options = {'gang': True}
+
+    def propagate(self, n_segments=3, seg_rcs=None, n_returned=None, extra_seg_ids=(), reverse=False, rc=0):
+        self.record = os.path.join(self.tempdir, 'manifest.json')
+        self.write_script(gang_script, record=self.record, seg_rcs=seg_rcs, n_returned=n_returned,
+                          extra_seg_ids=list(extra_seg_ids), reverse=reverse, rc=rc)
+        propagator = ExecutablePropagator(rc=self.rc)
+        return propagator.propagate(self.segments(n_segments))
+
+    def test_manifest(self):
+        segments = self.propagate()
+        with open(self.record) as infile:
+            entries = json.load(infile)
+        assert [entry['seg_id'] for entry in entries] == [0, 1, 2]
+        for entry in entries:
+            assert entry['n_iter'] == 2
+            assert entry['cwd'] == os.path.join(self.tempdir, '000002/{:06d}'.format(entry['seg_id']))
+            assert entry['environ']['WEST_CURRENT_SEG_DATA_REF'] == entry['cwd']
+            assert os.path.isdir(entry['cwd'])
+            assert not os.path.exists(entry['environ']['WEST_PCOORD_RETURN'])
+        for segment in segments:
+            assert segment.status == Segment.SEG_STATUS_COMPLETE
+            assert (segment.pcoord[:,0] == [segment.seg_id+1, segment.seg_id+2]).all()
+
+    def test_segment_rc(self):
+        segments = self.propagate(seg_rcs=[0, 3, 0], rc=0)
+        assert [segment.status for segment in segments] == [Segment.SEG_STATUS_COMPLETE, Segment.SEG_STATUS_FAILED,
+                                                            Segment.SEG_STATUS_COMPLETE]
+
+    def test_global_rc(self):
+        segments = self.propagate(rc=2)
+        assert all(segment.status == Segment.SEG_STATUS_FAILED for segment in segments)
+
+    def test_reversed_manifest(self):
+        # Entries are matched to segments by ID, not position
+        segments = self.propagate(seg_rcs=[3, 0, 0], reverse=True, rc=0)
+        assert [segment.status for segment in segments] == [Segment.SEG_STATUS_FAILED, Segment.SEG_STATUS_COMPLETE,
+                                                            Segment.SEG_STATUS_COMPLETE]
+
+    def test_short_manifest(self):
+        # A segment missing from the returned manifest fails; every segment is still finished
+        segments = self.propagate(seg_rcs=[0, 0, 0], n_returned=2, rc=0)
+        assert [segment.status for segment in segments] == [Segment.SEG_STATUS_COMPLETE, Segment.SEG_STATUS_COMPLETE,
+                                                            Segment.SEG_STATUS_FAILED]
+        assert 'missing' in segments[2].err
+        with open(self.record) as infile:
+            for entry in json.load(infile):
+                assert not os.path.exists(entry['environ']['WEST_PCOORD_RETURN'])
+
+    def test_duplicate_and_unknown_entries(self):
+        segments = self.propagate(seg_rcs=[0, 0, 0], extra_seg_ids=[1, 99], rc=0)
+        assert [segment.status for segment in segments] == [Segment.SEG_STATUS_COMPLETE, Segment.SEG_STATUS_FAILED,
+                                                            Segment.SEG_STATUS_COMPLETE]
+        assert '2 times' in segments[1].err
+
+    def test_unreadable_manifest(self):
+        # Without a readable manifest, the executable's own return code applies to every segment
+        self.record = os.path.join(self.tempdir, 'manifest.json')
+        self.write_script(gang_script.replace("json.dump({{'segments': returned}}, outfile)", "outfile.write('garbage')"),
+                          record=self.record, seg_rcs=None, n_returned=None, extra_seg_ids=[], reverse=False, rc=0)
+        segments = ExecutablePropagator(rc=self.rc).propagate(self.segments(3))
+        assert all(segment.status == Segment.SEG_STATUS_COMPLETE for segment in segments)
+
+    def test_exec_failure(self):
+        propagator = ExecutablePropagator(rc=self.rc)
+        made = []
+        def make_return_files(segment):
+            result = ExecutablePropagator.make_return_files(propagator, segment)
+            made.append(result[0])
+            return result
+        propagator.make_return_files = make_return_files
+
+        # The propagator executable does not exist
+        nose.tools.assert_raises(OSError, propagator.propagate, self.segments(2))
+        assert len(made) == 2
+        for return_files in made:
+            assert not any(os.path.exists(filename) for filename in return_files.itervalues())
+
+class TestConcurrentGangPropagation(TestGangPropagation):
+    propagator_options = {'gang': True, 'concurrency': 2}
+
+class TestRestartData(PropagatorTestBase):
+    def setUp(self):
+        PropagatorTestBase.setUp(self)
+        self.restart_dir = os.path.join(self.tempdir, 'restart')
+        os.makedirs(os.path.join(self.restart_dir, 'sub'))
+        self.contents = {'seg.rst': 'restart\n' * 100, os.path.join('sub', 'seg.vel'): 'velocities\n'}
+        for (filename, contents) in self.contents.iteritems():
+            with open(os.path.join(self.restart_dir, filename), 'wt') as outfile:
+                outfile.write(contents)
+
+    def check_extracted(self, path):
+        for (filename, contents) in self.contents.iteritems():
+            with open(os.path.join(path, filename)) as infile:
+                assert infile.read() == contents
+
+    def round_trip(self, compression, legacy=False):
+        self.rc.config['west']['executable']['restart_compression'] = compression
+        segment = self.segments(1)[0]
+        restart_input('restart', self.restart_dir, segment, False)
+        restart = segment.data['trajectories/restart']
+        assert restart.dtype == vbytes_dtype
+        tar_data = restart_data_bytes(restart).tostring()
+        if compression == 'gzip':
+            assert tar_data.startswith('\x1f\x8b')
+        elif compression == 'bz2':
+            assert tar_data.startswith('BZh')
+
+        if legacy:
+            # Restart data as stored in vlen strings before it was stored as raw bytes
+            segment.restart = pickle.dumps(tar_data, protocol=0).encode('base64')
+        else:
+            segment.restart = restart
+        output_dir = os.path.join(self.tempdir, 'output-{}{}'.format(compression, '-legacy' if legacy else ''))
+        restart_output(output_dir, segment)
+        self.check_extracted(output_dir)
+
+    def test_round_trip(self):
+        for compression in (None, 'none', 'gzip', 'bz2'):
+            self.round_trip(compression)
+
+    def test_legacy_round_trip(self):
+        for compression in (None, 'none', 'gzip', 'bz2'):
+            self.round_trip(compression, legacy=True)
+
+    def test_invalid_compression(self):
+        self.rc.config['west']['executable']['restart_compression'] = 'lzma'
+        nose.tools.assert_raises(ValueError, restart_input, 'restart', self.restart_dir, self.segments(1)[0], False)
@@ -0,0 +1,78 @@
+from __future__ import division, print_function
+import os, sys, json, shutil, tempfile
+from StringIO import StringIO
+from west.propagators.runner import serve, run_executable
+import argparse
+import westpa
+
+# Error reporting in west.propagators.executable is set up from the run-time configuration (which
+# must include a system) when the module is imported
+os.environ['WEST_SIM_ROOT'] = os.path.join(os.environ['WEST_ROOT'], 'lib/examples/odld')
+_parser = argparse.ArgumentParser()
+westpa.rc.add_args(_parser)
+westpa.rc.process_args(_parser.parse_args(['-r={}'.format(os.path.join(os.environ['WEST_SIM_ROOT'], 'west.cfg'))]))
+from west.propagators.executable import PersistentRunner
+
+import nose
+import nose.tools
+
+runner_script = '''#!{python}
+import os, sys
+sys.path[:0] = {path!r}
+from west.propagators.runner import serve, run_executable
+def run_segment(request):
+    with open(request['environ']['WEST_PCOORD_RETURN'], 'wt') as outfile:
+        outfile.write('{{:d}}\\n'.format(os.getpid()))
+    return int(request['environ']['EXIT_CODE'])
+serve(run_segment)
+'''
+
+class TestRunner:
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_serve(self):
+        requests = [{'environ': {'EXIT_CODE': '0'}}, {'environ': {'EXIT_CODE': '3'}}, {'environ': {}}]
+        instream = StringIO(''.join(json.dumps(request) + '\n' for request in requests))
+        outstream = StringIO()
+
+        def run_segment(request):
+            return int(request['environ']['EXIT_CODE'])
+
+        serve(run_segment, instream, outstream)
+        replies = [json.loads(line) for line in outstream.getvalue().splitlines()]
+        assert [reply['rc'] for reply in replies] == [0, 3, 1]
+        assert 'KeyError' in replies[2]['err']
+        assert 'ru_utime' in replies[0]['rusage']
+
+    def test_persistent_runner(self):
+        script = os.path.join(self.tempdir, 'runner.py')
+        with open(script, 'wt') as outfile:
+            outfile.write(runner_script.format(python=sys.executable, path=sys.path))
+        os.chmod(script, 0o755)
+        pcoord_return = os.path.join(self.tempdir, 'pcoord.txt')
+
+        runner = PersistentRunner(script, environ=dict(os.environ))
+        pids = set()
+        try:
+            for exit_code in (0, 2, 0):
+                rc, rusage, err = runner.run({'environ': {'WEST_PCOORD_RETURN': pcoord_return,
+                                                          'EXIT_CODE': str(exit_code)}})
+                assert rc == exit_code
+                assert rusage.ru_utime >= 0
+                pids.add(open(pcoord_return).read().strip())
+        finally:
+            runner.close()
+        assert len(pids) == 1
+        assert runner.proc is None
+
+    def test_run_executable_closes_files(self):
+        request = {'executable': '/bin/true', 'environ': {}}
+        n_fds = len(os.listdir('/proc/self/fd'))
+        for _i in xrange(5):
+            rc, err = run_executable(request)
+            assert rc == 0
+        assert len(os.listdir('/proc/self/fd')) == n_fds
@@ -0,0 +1,65 @@
+from __future__ import division, print_function
+from west.segment import Segment, SegmentTable, pack_pcoords
+import numpy, cPickle as pickle
+
+import nose
+import nose.tools
+
+class TestSegment:
+    def segment(self, seg_id, pcoord_len=3):
+        return Segment(n_iter=1, seg_id=seg_id, weight=0.5, parent_id=seg_id,
+                       pcoord=numpy.zeros((pcoord_len,2), numpy.float32) + seg_id)
+
+    def test_lazy_data_and_error(self):
+        segment = self.segment(0)
+        assert segment._data is None
+        assert segment._error is None
+        segment.data['trajectories/restart'] = b'restart'
+        assert segment._data == {'trajectories/restart': b'restart'}
+        
+    def test_instance_dict_unused(self):
+        segment = self.segment(0)
+        segment.status = Segment.SEG_STATUS_COMPLETE
+        segment.error.append('error')
+        segment.data['trajectories/restart'] = b'restart'
+        assert segment.__dict__ == {}
+
+    def test_restart_not_copied(self):
+        restart = numpy.arange(10)
+        segment = Segment(n_iter=1, seg_id=0, restart=restart)
+        assert segment.restart is restart
+
+    def test_pickle(self):
+        segment = self.segment(1)
+        segment.status = Segment.SEG_STATUS_COMPLETE
+        segment.error.append('error')
+        segment.err = 'stderr output'
+        for protocol in xrange(pickle.HIGHEST_PROTOCOL+1):
+            unpickled = pickle.loads(pickle.dumps(segment, protocol))
+            assert unpickled.seg_id == 1
+            assert unpickled.status == Segment.SEG_STATUS_COMPLETE
+            assert (unpickled.pcoord == segment.pcoord).all()
+            assert unpickled.error == ['error']
+            assert unpickled.err == 'stderr output'
+            assert unpickled._data is None
+
+    def test_pack_pcoords(self):
+        segments = [self.segment(seg_id) for seg_id in xrange(4)]
+        pcoords = pack_pcoords(segments)
+        assert pcoords.shape == (4,3,2)
+        for (iseg, segment) in enumerate(segments):
+            assert segment.pcoord.base is pcoords
+            assert (segment.pcoord == iseg).all()
+        segments[2].pcoord[0] = 7
+        assert (pcoords[2,0] == 7).all()
+
+    def test_pack_pcoords_mismatch(self):
+        segments = [self.segment(0), self.segment(1, pcoord_len=4)]
+        original = segments[0].pcoord
+        assert pack_pcoords(segments) is None
+        assert segments[0].pcoord is original
+
+    def test_table_from_segments(self):
+        segments = [self.segment(seg_id) for seg_id in xrange(4)]
+        table = SegmentTable.from_segments(segments)
+        assert segments[3].pcoord.base is table.pcoords
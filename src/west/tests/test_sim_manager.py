@@ -18,6 +18,7 @@
 from __future__ import division, print_function
 import os
 import argparse
+import cPickle as pickle
 import numpy
 
 os.environ['WEST_SIM_ROOT'] = os.path.join(os.environ['WEST_ROOT'], 'lib/examples/odld')
@@ -28,6 +29,27 @@ import nose
 import nose.tools
 
 
+class RestartReader:
+    '''Stands in for an HDF5 ``restart`` data set, counting reads of each row.'''
+    def __init__(self):
+        self.reads = {}
+
+    def __getitem__(self, parent_id):
+        self.reads[parent_id] = self.reads.get(parent_id, 0) + 1
+        return numpy.frombuffer(os.urandom(4096), dtype=numpy.uint8)
+
+class StubDataManager:
+    def __init__(self, in_swmr=False):
+        self.restarts = RestartReader()
+        self.in_swmr = in_swmr
+
+    def dereference(self, ref, n_iter=None):
+        return {'restart': self.restarts}
+
+    def get_restart_reference(self, segment):
+        return ('reference', segment.parent_id) if self.in_swmr else None
+
+
 class TestSimManager:
 
     def setup(self):
@@ -80,3 +102,54 @@ class TestSimManager:
 
         system = self.sim_manager.system
         assert numpy.all(system.bin_mapper.boundaries == numpy.array([0.0, 1.0, 2.0, 3.0]))
+
+    def test_longest_first_schedule(self):
+        self.sim_manager.schedule = 'longest_first'
+        self.sim_manager.n_iter = 1
+        self.sim_manager.we_driver.bin_mapper = RectilinearBinMapper([[0.0, 1.0, 2.0, 3.0]])
+        self.sim_manager.bin_walltime_ema = numpy.array([1.0, 5.0, numpy.nan])
+
+        segments = []
+        for (seg_id, init_pcoord) in enumerate([0.5, 1.5, 2.5, 1.5]):
+            segment = west.Segment(n_iter=1, seg_id=seg_id, parent_id=-1, weight=0.25,
+                                   pcoord=numpy.array([[init_pcoord], [init_pcoord]]))
+            segments.append(segment)
+
+        scheduled = self.sim_manager.schedule_segments(segments)
+        assert [segment.seg_id for segment in scheduled] == [1, 3, 2, 0]
+
+    def test_shared_restarts(self):
+        data_manager = self.sim_manager.data_manager = StubDataManager()
+        self.sim_manager.lazy_restarts = False
+
+        # Two split walkers with three and two children, and one continuing walker
+        parent_ids = [4, 4, 4, 7, 7, 9]
+        segments = [west.Segment(n_iter=2, seg_id=seg_id, parent_id=parent_id, weight=1.0/6)
+                    for (seg_id, parent_id) in enumerate(parent_ids)]
+        assert self.sim_manager.load_restarts(segments) == 3
+        assert data_manager.restarts.reads == {4: 1, 7: 1, 9: 1}
+        assert segments[0].restart is segments[1].restart is segments[2].restart
+        assert segments[3].restart is segments[4].restart
+        assert segments[2].restart is not segments[3].restart
+
+        # Siblings in one block are serialized with one copy of their restart data
+        payload_size = len(pickle.dumps(segments[0].restart, pickle.HIGHEST_PROTOCOL))
+        block_size = len(pickle.dumps(segments[0:3], pickle.HIGHEST_PROTOCOL))
+        assert block_size < 1.5*payload_size
+
+    def test_lazy_restarts(self):
+        self.sim_manager.lazy_restarts = True
+        parent_ids = [4, 4, 7]
+
+        # Without SWMR, no references can be issued and restart data is read as usual
+        data_manager = self.sim_manager.data_manager = StubDataManager()
+        segments = [west.Segment(n_iter=2, seg_id=seg_id, parent_id=parent_id) for (seg_id, parent_id) in enumerate(parent_ids)]
+        assert self.sim_manager.load_restarts(segments) == 2
+        assert data_manager.restarts.reads == {4: 1, 7: 1}
+        assert isinstance(segments[0].restart, numpy.ndarray)
+
+        data_manager = self.sim_manager.data_manager = StubDataManager(in_swmr=True)
+        segments = [west.Segment(n_iter=2, seg_id=seg_id, parent_id=parent_id) for (seg_id, parent_id) in enumerate(parent_ids)]
+        assert self.sim_manager.load_restarts(segments) == 2
+        assert data_manager.restarts.reads == {}
+        assert [segment.restart for segment in segments] == [('reference', 4), ('reference', 4), ('reference', 7)]
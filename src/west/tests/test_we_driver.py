@@ -16,25 +16,64 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division, print_function
-from west.we_driver import WEDriver
+from westpa._rc import WESTRC
+from west.we_driver import WEDriver, ArrayWEDriver, BinTransitions, NewWeightEntry
 from west.systems import WESTSystem
 from westpa.binning import RectilinearBinMapper
 from west.states import TargetState, InitialState
-from west import Segment
-import numpy
+from west import Segment, SegmentTable
+import numpy, random
 
 EPS = numpy.finfo(numpy.float64).eps
 
 import nose
 import nose.tools
 
-class TestWEDriver:    
+class TestBinTransitions:
+    nbins = 5
+
+    def test_empty(self):
+        transitions = BinTransitions(self.nbins)
+        (rows, cols, fluxes, counts) = transitions.triplets()
+        assert len(rows) == len(cols) == len(fluxes) == len(counts) == 0
+        assert (transitions.flux_matrix == 0).all()
+
+    def test_accumulate(self):
+        transitions = BinTransitions(self.nbins)
+        flux_matrix = numpy.zeros((self.nbins, self.nbins), dtype=numpy.float64)
+        transition_matrix = numpy.zeros((self.nbins, self.nbins), dtype=numpy.uint)
+        rng = numpy.random.RandomState(17)
+        for ibatch in xrange(6):
+            # Few bins, so (row, col) pairs repeat within and across batches
+            from_bins = rng.randint(self.nbins, size=20)
+            to_bins = rng.randint(self.nbins, size=20)
+            weights = rng.uniform(size=20)
+            transitions.add(from_bins, to_bins, weights)
+            numpy.add.at(flux_matrix, (from_bins, to_bins), weights)
+            numpy.add.at(transition_matrix, (from_bins, to_bins), 1)
+            if ibatch % 2:
+                # Consolidating part way through must not lose or double count anything
+                transitions.triplets()
+
+        (rows, cols, fluxes, counts) = transitions.triplets()
+        keys = rows*self.nbins + cols
+        assert (numpy.diff(keys) > 0).all()
+        assert (counts > 0).all()
+        assert set(zip(rows, cols)) == set(zip(*numpy.nonzero(transition_matrix)))
+        assert numpy.allclose(fluxes, flux_matrix[rows, cols])
+        assert (counts == transition_matrix[rows, cols]).all()
+        assert numpy.allclose(transitions.flux_matrix, flux_matrix)
+        assert (transitions.transition_matrix == transition_matrix).all()
+
+class TestWEDriver:
+    we_driver_class = WEDriver
+
     def setup(self):
         system = WESTSystem()
         system.bin_mapper = RectilinearBinMapper([[0.0, 1.0, 2.0]])
         system.bin_target_counts = numpy.array([4,4])
         system.pcoord_len = 2
-        self.we_driver = WEDriver(system=system)
+        self.we_driver = self.we_driver_class(system=system)
         self.system = system
         self._seg_id = 0
 
@@ -65,6 +104,21 @@ class TestWEDriver:
         assert len(self.we_driver.final_binning[1]) == 1
         assert (self.we_driver.flux_matrix == numpy.array([[0.0, 0.5], [0.5,0.0]])).all()
         
+    def test_assign_table(self):
+        segments = [self.segment(0.0, 1.5, weight=0.5),
+                    self.segment(1.5, 0.5, weight=0.5)]
+        for segment in segments:
+            segment.parent_id = segment.seg_id
+        table = SegmentTable.from_segments(segments)
+        assert table[0] is segments[0]
+        self.we_driver.new_iteration()
+        n_recycled = self.we_driver.assign(table)
+        assert n_recycled == 0
+        assert len(self.we_driver.initial_binning[0]) == 1
+        assert len(self.we_driver.final_binning[1]) == 1
+        assert (self.we_driver.flux_matrix == numpy.array([[0.0, 0.5], [0.5,0.0]])).all()
+        assert (self.we_driver.transition_matrix == numpy.array([[0, 1], [1, 0]])).all()
+        
     def test_passthrough(self):
         segments = ([self.segment(0.0, 1.5, weight=0.125) for _i in xrange(4)]
                    +[self.segment(1.5, 0.5, weight=0.125) for _i in xrange(4)])
@@ -136,7 +190,7 @@ class TestWEDriver:
         system.bin_mapper = RectilinearBinMapper([[0.0, 1.0]])
         system.bin_target_counts = numpy.array([1])
         system.pcoord_len = 2
-        self.we_driver = WEDriver(system=system)
+        self.we_driver = self.we_driver_class(system=system)
         self.system = system
         self._seg_id = 0
         
@@ -213,7 +267,7 @@ class TestWEDriver:
         segments = [self.segment(0.0, 1.5, weight=0.5),
                     self.segment(0.0, 0.5, weight=0.5)]
         tstate = TargetState('recycle', [1.5], 0)
-        istate = InitialState(0, 0, 0, pcoord=[0.0])
+        istate = InitialState(0, 0, 0, pcoord=[0.0], data={'trajectories/restart': 'restart'})
         
         self.we_driver.new_iteration(initial_states=[istate], target_states=[tstate])
         n_needed = self.we_driver.assign(segments)
@@ -230,6 +284,31 @@ class TestWEDriver:
                               [0.25 for _i in xrange(4)])
         assert segments[0].endpoint_type == Segment.SEG_ENDPOINT_RECYCLED
 
+    def test_recycle_new_weights(self):
+        segments = [self.segment(0.0, 1.5, weight=0.5),
+                    self.segment(0.0, 0.5, weight=0.5)]
+        tstate = TargetState('recycle', [1.5], 3)
+        istate = InitialState(7, 0, 0, pcoord=[0.25], data={'trajectories/restart': 'restart'})
+        
+        self.we_driver.new_iteration(initial_states=[istate], target_states=[tstate])
+        self.we_driver.assign(segments)
+        self.we_driver.construct_next()
+        
+        new_weights = self.we_driver.new_weights
+        assert len(new_weights) == 1
+        assert (new_weights.weights == [0.5]).all()
+        assert (new_weights.target_state_ids == [3]).all()
+        (entry,) = list(new_weights)
+        assert isinstance(entry, NewWeightEntry)
+        assert entry.prev_seg_id == segments[0].seg_id
+        assert entry.initial_state_id == 7
+        assert (entry.prev_final_pcoord == [1.5]).all()
+        assert (entry.new_init_pcoord == [0.25]).all()
+        
+        # recycled weight seeds the flux matrix of the next iteration
+        self.we_driver.new_iteration(new_weights=new_weights)
+        assert self.we_driver.flux_matrix[0,0] == 0.5
+
         
     def test_multiple_merge(self):
         
@@ -264,3 +343,91 @@ class TestWEDriver:
 
     # TODO: add test for seeding the flux matrix based on recycling 
     # TODO: add test for split after merge in adjust count
+
+
+class TestArrayWEDriver(TestWEDriver):
+    we_driver_class = ArrayWEDriver
+
+    def resample(self, we_driver, weights, final_pcoords):
+        self._seg_id = 0
+        segments = [self.segment(0.5, final_pcoord, weight=weight) for (weight, final_pcoord) in zip(weights, final_pcoords)]
+        random.seed(1234)
+        we_driver.new_iteration()
+        we_driver.assign(segments)
+        we_driver.construct_next()
+        return ([sorted(seg.weight for seg in bin) for bin in we_driver.next_iter_binning],
+                [sorted(seg.parent_id for seg in bin) for bin in we_driver.next_iter_binning],
+                [segment.endpoint_type for segment in segments])
+
+    def test_matches_default_driver(self):
+        self.system.bin_target_counts = numpy.array([8,8])
+        rng = numpy.random.RandomState(42)
+        weights = rng.uniform(size=(64,))
+        weights /= weights.sum()
+        final_pcoords = rng.choice([0.5, 1.5], size=(64,))
+
+        (array_weights, array_parents, array_endpoints) = self.resample(self.we_driver, weights, final_pcoords)
+        (default_weights, default_parents, default_endpoints) = self.resample(WEDriver(system=self.system), weights,
+                                                                              final_pcoords)
+        for ibin in xrange(2):
+            assert len(array_weights[ibin]) == 8
+            assert numpy.allclose(array_weights[ibin], default_weights[ibin])
+            assert array_parents[ibin] == default_parents[ibin]
+        assert abs(sum(map(sum, array_weights)) - 1.0) < 64*EPS
+        assert array_endpoints.count(Segment.SEG_ENDPOINT_CONTINUES) == default_endpoints.count(Segment.SEG_ENDPOINT_CONTINUES)
+
+    def test_wtg_parents(self):
+        # four walkers merged to one must carry the weight transfer graph of all four
+        self.system.bin_target_counts = numpy.array([1,1])
+        segments = [self.segment(0.0, 0.5, weight=0.25) for _i in xrange(4)]
+        self.we_driver.new_iteration()
+        self.we_driver.assign(segments)
+        self.we_driver.construct_next()
+        (newseg,) = self.we_driver.next_iter_binning[0]
+        assert newseg.wtg_parent_ids == set(segment.seg_id for segment in segments)
+        assert abs(newseg.weight - 1.0) < 4*EPS
+
+    def test_parallel_resampling(self):
+        # Per-bin random number streams make results independent of the number of workers
+        self.system.bin_target_counts = numpy.array([8,8])
+        rng = numpy.random.RandomState(42)
+        weights = rng.uniform(size=(64,))
+        weights /= weights.sum()
+        final_pcoords = rng.choice([0.5, 1.5], size=(64,))
+
+        results = []
+        for (n_workers, pool_type) in ((1, 'thread'), (3, 'thread'), (2, 'process')):
+            we_driver = ArrayWEDriver(system=self.system)
+            we_driver.resample_workers = n_workers
+            we_driver.resample_pool_type = pool_type
+            try:
+                results.append(self.resample(we_driver, weights, final_pcoords))
+            finally:
+                we_driver.shutdown_resample_pool()
+
+        (weights_1, parents_1, endpoints_1) = results[0]
+        for (weights_n, parents_n, endpoints_n) in results[1:]:
+            for ibin in xrange(2):
+                assert len(weights_1[ibin]) == 8
+                assert numpy.allclose(weights_1[ibin], weights_n[ibin])
+                assert parents_1[ibin] == parents_n[ibin]
+            assert endpoints_1 == endpoints_n
+            assert abs(sum(map(sum, weights_n)) - 1.0) < 64*EPS
+
+    def test_resample_pool_lifetime(self):
+        we_driver = ArrayWEDriver(system=self.system)
+        we_driver.resample_workers = 2
+        we_driver.resample_pool_type = 'process'
+        # Worker processes are started before the run (and so before the HDF5 file is opened)
+        we_driver.prepare_run()
+        pool = we_driver._resample_pool
+        assert pool is not None
+        self.resample(we_driver, [0.5, 0.5], [0.5, 1.5])
+        assert we_driver._resample_pool is pool
+        we_driver.finalize_run()
+        assert we_driver._resample_pool is None
+
+    def test_resample_workers_config(self):
+        rc = WESTRC()
+        rc.config['west'] = {'we': {'resample_workers': 0}}
+        nose.tools.assert_raises(ValueError, ArrayWEDriver, rc=rc, system=self.system)
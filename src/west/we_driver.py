@@ -22,10 +22,12 @@ import numpy
 import operator
 from math import ceil
 import random
+import heapq
 from itertools import izip
 
 import westpa
-from west import Segment
+from west import Segment, SegmentTable
+from west.segment import pack_pcoords
 
 class ConsistencyError(RuntimeError):
     pass
@@ -52,6 +54,132 @@ class NewWeightEntry:
         return ('<{} object at 0x{:x}: weight={self.weight:g} target_state_id={self.target_state_id} prev_final_pcoord={self.prev_final_pcoord}>'
                 .format(self.__class__.__name__, id(self), self=self))
 
+class NewWeightTable:
+    '''A columnar representation of a sequence of new weight entries, as stored in HDF5.
+    ``index`` is an array of type ``west.data_manager.nw_index_dtype`` (in which -1 marks a missing
+    segment or state ID), and ``prev_init_pcoords``, ``prev_final_pcoords``, and
+    ``new_init_pcoords`` are arrays of progress coordinate points, indexed by entry. Indexing or
+    iterating over the table yields ``NewWeightEntry`` objects, which are constructed on demand.'''
+
+    def __init__(self, index, prev_init_pcoords, prev_final_pcoords, new_init_pcoords):
+        self.index = index
+        self.prev_init_pcoords = prev_init_pcoords
+        self.prev_final_pcoords = prev_final_pcoords
+        self.new_init_pcoords = new_init_pcoords
+
+    @classmethod
+    def from_entries(cls, entries, system):
+        '''Construct a table from a sequence of ``NewWeightEntry`` objects, using ``system`` to
+        determine the shape and type of progress coordinates.'''
+        # This has to be down here to avoid an import race
+        from west.data_manager import nw_index_dtype
+
+        entries = list(entries)
+        index = numpy.empty((len(entries),), dtype=nw_index_dtype)
+        prev_init_pcoords = system.new_pcoord_array(len(entries))
+        prev_final_pcoords = system.new_pcoord_array(len(entries))
+        new_init_pcoords = system.new_pcoord_array(len(entries))
+
+        for (ientry, entry) in enumerate(entries):
+            row = index[ientry]
+            row['source_type'] = entry.source_type
+            row['weight'] = entry.weight
+            # the following use -1 as a sentinel for a missing value
+            row['prev_seg_id'] = entry.prev_seg_id if entry.prev_seg_id is not None else -1
+            row['target_state_id'] = entry.target_state_id if entry.target_state_id is not None else -1
+            row['initial_state_id'] = entry.initial_state_id if entry.initial_state_id is not None else -1
+            index[ientry] = row
+
+            if entry.prev_init_pcoord is not None:
+                prev_init_pcoords[ientry] = entry.prev_init_pcoord
+            if entry.prev_final_pcoord is not None:
+                prev_final_pcoords[ientry] = entry.prev_final_pcoord
+            if entry.new_init_pcoord is not None:
+                new_init_pcoords[ientry] = entry.new_init_pcoord
+
+        return cls(index, prev_init_pcoords, prev_final_pcoords, new_init_pcoords)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        row = self.index[i]
+        prev_seg_id, target_state_id, initial_state_id = (None if row[field] == -1 else long(row[field])
+                                                          for field in ('prev_seg_id', 'target_state_id', 'initial_state_id'))
+        return NewWeightEntry(source_type=row['source_type'],
+                              weight=row['weight'],
+                              prev_seg_id=prev_seg_id,
+                              prev_init_pcoord=self.prev_init_pcoords[i].copy(),
+                              prev_final_pcoord=self.prev_final_pcoords[i].copy(),
+                              new_init_pcoord=self.new_init_pcoords[i].copy(),
+                              target_state_id=target_state_id,
+                              initial_state_id=initial_state_id)
+
+    def __iter__(self):
+        for i in xrange(len(self.index)):
+            yield self[i]
+
+    @property
+    def weights(self):
+        return self.index['weight']
+
+    @property
+    def target_state_ids(self):
+        return self.index['target_state_id']
+
+class BinTransitions:
+    '''A sparse accumulator of the bin-to-bin fluxes (total weight) and numbers of transitions
+    observed among ``nbins`` bins. Transitions are added in batches with ``add()``; ``triplets()``
+    returns the non-zero entries in coordinate form, sorted by row and then column. Dense matrices
+    are only constructed on request.'''
+
+    def __init__(self, nbins):
+        self.nbins = nbins
+        self._pending = []
+        self._triplets = (numpy.empty((0,), dtype=numpy.intp), numpy.empty((0,), dtype=numpy.intp),
+                          numpy.empty((0,), dtype=numpy.float64), numpy.empty((0,), dtype=numpy.uint))
+
+    def add(self, from_bins, to_bins, weights):
+        '''Record one transition from ``from_bins[i]`` to ``to_bins[i]``, carrying weight ``weights[i]``,
+        for each ``i``.'''
+        self._pending.append((numpy.asarray(from_bins, dtype=numpy.intp), numpy.asarray(to_bins, dtype=numpy.intp),
+                              numpy.asarray(weights, dtype=numpy.float64)))
+
+    def triplets(self):
+        '''Return ``(rows, cols, fluxes, counts)`` for all bin pairs between which a transition was
+        observed.'''
+        if self._pending:
+            (rows, cols, fluxes, counts) = self._triplets
+            keys = numpy.concatenate([rows*self.nbins + cols]
+                                     + [from_bins*self.nbins + to_bins for (from_bins, to_bins, _w) in self._pending])
+            all_fluxes = numpy.concatenate([fluxes] + [weights for (_f, _t, weights) in self._pending])
+            all_counts = numpy.concatenate([counts] + [numpy.ones((len(weights),), dtype=numpy.uint)
+                                                       for (_f, _t, weights) in self._pending])
+            (unique_keys, inverse) = numpy.unique(keys, return_inverse=True)
+            fluxes = numpy.zeros((len(unique_keys),), dtype=numpy.float64)
+            counts = numpy.zeros((len(unique_keys),), dtype=numpy.uint)
+            numpy.add.at(fluxes, inverse, all_fluxes)
+            numpy.add.at(counts, inverse, all_counts)
+            self._triplets = (unique_keys // self.nbins, unique_keys % self.nbins, fluxes, counts)
+            self._pending = []
+        return self._triplets
+
+    @property
+    def flux_matrix(self):
+        '''The dense (nbins x nbins) flux matrix.'''
+        (rows, cols, fluxes, _counts) = self.triplets()
+        matrix = numpy.zeros((self.nbins, self.nbins), dtype=numpy.float64)
+        matrix[rows, cols] = fluxes
+        return matrix
+
+    @property
+    def transition_matrix(self):
+        '''The dense (nbins x nbins) matrix of transition counts.'''
+        (rows, cols, _fluxes, counts) = self.triplets()
+        matrix = numpy.zeros((self.nbins, self.nbins), dtype=numpy.uint)
+        matrix[rows, cols] = counts
+        return matrix
+
 class WEDriver:
     '''A class implemented Huber & Kim's weighted ensemble algorithm over Segment objects.
     This class handles all binning, recycling, and preparation of new Segment objects for the
@@ -67,7 +195,7 @@ class WEDriver:
       3) Call `run_we()`, optionally providing a set of initial states that will be used to
          recycle walkers.
          
-    Note the presence of flux_matrix, transition_matrix,
+    Note the presence of bin_transitions (and the dense flux_matrix and transition_matrix),
     current_iter_segments, next_iter_segments, recycling_segments,
     initial_binning, final_binning, next_iter_binning, and new_weights (to be documented soon).
     '''
@@ -98,9 +226,8 @@ class WEDriver:
         # binning on initial points for next iteration
         self.next_iter_binning = None
                 
-        # Flux and rate matrices for the current iteration
-        self.flux_matrix = None
-        self.transition_matrix = None
+        # Fluxes and transition counts for the current iteration (a BinTransitions object)
+        self.bin_transitions = None
         
         # Information on new weights (e.g. from recycling) for the next iteration
         self.new_weights = None
@@ -126,8 +253,26 @@ class WEDriver:
         
         self.weight_merge_cutoff = config.get(['west', 'we', 'weight_merge_cutoff'], self.weight_merge_cutoff)
         log.info('Merge cutoff: {}'.format(self.weight_merge_cutoff))
+
+    def prepare_run(self):
+        '''Prepare for a simulation run. Called by the sim manager before the WEST HDF5 file is opened.'''
+        pass
+
+    def finalize_run(self):
+        '''Clean up at the end of a simulation run.'''
+        pass
         
         
+    @property
+    def flux_matrix(self):
+        '''Dense flux matrix for the current iteration (see ``bin_transitions`` for the sparse form)'''
+        return self.bin_transitions.flux_matrix if self.bin_transitions is not None else None
+    
+    @property
+    def transition_matrix(self):
+        '''Dense transition count matrix for the current iteration (see ``bin_transitions`` for the sparse form)'''
+        return self.bin_transitions.transition_matrix if self.bin_transitions is not None else None
+        
     @property
     def next_iter_segments(self):
         '''Newly-created segments for the next iteration'''
@@ -190,14 +335,13 @@ class WEDriver:
         '''Explicitly delete all Segment-related state.'''
         
         del self.initial_binning, self.final_binning, self.next_iter_binning
-        del self.flux_matrix, self.transition_matrix
+        del self.bin_transitions
         del self.new_weights, self.used_initial_states, self.avail_initial_states
         
         self.initial_binning = None
         self.final_binning = None
         self.next_iter_binning = None
-        self.flux_matrix = None
-        self.transition_matrix = None
+        self.bin_transitions = None
         self.avail_initial_states = None
         self.used_initial_states = None
         self.new_weights = None
@@ -239,8 +383,8 @@ class WEDriver:
         self.final_binning      = self.bin_mapper.construct_bins()
         self.next_iter_binning  = None
         
-        flux_matrix = self.flux_matrix = numpy.zeros((nbins,nbins), dtype=numpy.float64)
-        transition_matrix = self.transition_matrix = numpy.zeros((nbins,nbins), numpy.uint)
+        # Fluxes are accumulated sparsely, as most bin pairs see no transitions
+        bin_transitions = self.bin_transitions = BinTransitions(nbins)
         
         # map target state specifications to bins
         target_states = target_states or []
@@ -251,23 +395,17 @@ class WEDriver:
             log.debug('target state {!r} mapped to bin {}'.format(tstate, tstate_assignment))
             self.bin_target_counts[tstate_assignment] = 0
             
-        # loop over recycled segments, adding entries to the flux matrix appropriately
+        # add entries for recycled segments to the flux matrix
         if new_weights:
-            init_pcoords = numpy.empty((len(new_weights), self.system.pcoord_ndim), dtype=self.system.pcoord_dtype)
-            prev_init_pcoords = numpy.empty((len(new_weights), self.system.pcoord_ndim), dtype=self.system.pcoord_dtype)
-            
-            for (ientry,entry) in enumerate(new_weights):
-                init_pcoords[ientry] = entry.new_init_pcoord
-                prev_init_pcoords[ientry] = entry.prev_init_pcoord
+            if not isinstance(new_weights, NewWeightTable):
+                new_weights = NewWeightTable.from_entries(new_weights, self.system)
             
-            init_assignments = self.bin_mapper.assign(init_pcoords)
-            prev_init_assignments = self.bin_mapper.assign(prev_init_pcoords)
+            init_assignments = self.bin_mapper.assign(new_weights.new_init_pcoords)
+            prev_init_assignments = self.bin_mapper.assign(new_weights.prev_init_pcoords)
             
-            for (entry, i, j) in izip(new_weights, prev_init_assignments, init_assignments):
-                flux_matrix[i,j] += entry.weight
-                transition_matrix[i,j] += 1
+            bin_transitions.add(prev_init_assignments, init_assignments, new_weights.weights)
                 
-            del init_pcoords, prev_init_pcoords, init_assignments, prev_init_assignments
+            del init_assignments, prev_init_assignments
         
         self.avail_initial_states = {state.state_id: state for state in initial_states}
         self.used_initial_states = {}
@@ -294,9 +432,18 @@ class WEDriver:
         # collect initial and final coordinates into one place        
         all_pcoords = numpy.empty((2,len(segments), self.system.pcoord_ndim), dtype=self.system.pcoord_dtype)
         
-        for iseg, segment in enumerate(segments):
-            all_pcoords[0,iseg] = segment.pcoord[0,:]
-            all_pcoords[1,iseg] = segment.pcoord[-1,:]
+        if isinstance(segments, SegmentTable) and segments.pcoords is not None:
+            # columnar fast path; no per-segment copies required
+            all_pcoords[0] = segments.initial_pcoords
+            all_pcoords[1] = segments.final_pcoords
+            weights = segments.weights
+        else:
+            segments = list(segments)
+            weights = numpy.empty((len(segments),), dtype=numpy.float64)
+            for iseg, segment in enumerate(segments):
+                all_pcoords[0,iseg] = segment.pcoord[0,:]
+                all_pcoords[1,iseg] = segment.pcoord[-1,:]
+                weights[iseg] = segment.weight
         
         # assign based on initial and final progress coordinates
         initial_assignments = self.bin_mapper.assign(all_pcoords[0,:,:])
@@ -307,13 +454,12 @@ class WEDriver:
             
         initial_binning = self.initial_binning
         final_binning = self.final_binning
-        flux_matrix = self.flux_matrix
-        transition_matrix = self.transition_matrix
         for (segment,iidx,fidx) in izip(segments, initial_assignments, final_assignments):
             initial_binning[iidx].add(segment)
             final_binning[fidx].add(segment)
-            flux_matrix[iidx,fidx] += segment.weight
-            transition_matrix[iidx,fidx] += 1
+        
+        # accumulate fluxes and transition counts
+        self.bin_transitions.add(initial_assignments, final_assignments, weights)
             
         n_recycled_total = self.n_recycled_segs
         n_new_states = n_recycled_total - len(self.avail_initial_states)
@@ -341,53 +487,62 @@ class WEDriver:
             raise ConsistencyError('need {} initial states for recycling, but only {} present'
                                    .format(n_recycled_walkers,len(self.avail_initial_states)))
 
-        used_istate_ids = set()
-        istateiter = iter(self.avail_initial_states.itervalues())
-        for (ibin,target_state) in self.target_states.iteritems():
-            target_bin = self.next_iter_binning[ibin]
-            for segment in set(target_bin):
-                initial_state = istateiter.next()                
-                istate_assignment = self.bin_mapper.assign([initial_state.pcoord])[0]
-                parent = self._parent_map[segment.parent_id]
-                parent.endpoint_type = Segment.SEG_ENDPOINT_RECYCLED
-
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug('recycling {!r} from target state {!r} to initial state {!r}'.format(segment, target_state,
-                                                                                                   initial_state))
-                    log.debug('parent is {!r}'.format(parent))                
-                
-                
-                segment.parent_id = -(initial_state.state_id+1)
-                segment.restart = initial_state.data['trajectories/restart'],
-                # We might have to do this, too...
-                #segment.data['trajectories/restart'] = initial_state.data['trajectories/restart']
-                segment.pcoord[0] = initial_state.pcoord
-
-                self.new_weights.append(NewWeightEntry(source_type=NewWeightEntry.NW_SOURCE_RECYCLED,
-                                                       weight=parent.weight, prev_seg_id=parent.seg_id,
-                                                       # the .copy() is crucial, otherwise the slice of pcoords will
-                                                       # keep the parent segments' pcoord data alive unnecessarily long
-                                                       prev_init_pcoord=parent.pcoord[0].copy(),
-                                                       prev_final_pcoord=parent.pcoord[-1].copy(),
-                                                       new_init_pcoord=initial_state.pcoord.copy(),
-                                                       target_state_id=target_state.state_id,
-                                                       initial_state_id=initial_state.state_id) )
-                
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug('new weight entry is {!r}'.format(self.new_weights[-1]))
+        # This has to be down here to avoid an import race
+        from west.data_manager import nw_index_dtype
+        
+        # Pair each recycled walker with an initial state, and assign all initial states to bins at once
+        recycled = [(target_state, segment) for (ibin, target_state) in self.target_states.iteritems()
+                                            for segment in self.next_iter_binning[ibin]]
+        istateiter = iter(self.avail_initial_states.values())
+        initial_states = [istateiter.next() for _i in xrange(n_recycled_walkers)]
+        istate_pcoords = numpy.empty((n_recycled_walkers, self.system.pcoord_ndim), dtype=self.system.pcoord_dtype)
+        for (istate_pcoord, initial_state) in izip(istate_pcoords, initial_states):
+            istate_pcoord[...] = initial_state.pcoord
+        istate_assignments = self.bin_mapper.assign(istate_pcoords)
+        
+        # The new weight records are built as arrays and stored as such
+        nw_index = numpy.empty((n_recycled_walkers,), dtype=nw_index_dtype)
+        nw_index['source_type'] = NewWeightEntry.NW_SOURCE_RECYCLED
+        prev_init_pcoords = numpy.empty_like(istate_pcoords)
+        prev_final_pcoords = numpy.empty_like(istate_pcoords)
+        
+        for (irecycled, ((target_state, segment), initial_state, istate_assignment)) \
+                in enumerate(izip(recycled, initial_states, istate_assignments)):
+            parent = self._parent_map[segment.parent_id]
+            parent.endpoint_type = Segment.SEG_ENDPOINT_RECYCLED
 
-                self.next_iter_binning[istate_assignment].add(segment)
-                
-                initial_state.iter_used = segment.n_iter
-                log.debug('marking initial state {!r} as used'.format(initial_state))
-                used_istate_ids.add(initial_state.state_id)
-                target_bin.remove(segment)
-                 
-            assert len(target_bin) == 0
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('recycling {!r} from target state {!r} to initial state {!r}'.format(segment, target_state,
+                                                                                               initial_state))
+                log.debug('parent is {!r}'.format(parent))                
+            
+            nw_index['weight'][irecycled] = parent.weight
+            nw_index['prev_seg_id'][irecycled] = parent.seg_id
+            nw_index['target_state_id'][irecycled] = target_state.state_id
+            nw_index['initial_state_id'][irecycled] = initial_state.state_id
+            prev_init_pcoords[irecycled] = parent.pcoord[0]
+            prev_final_pcoords[irecycled] = parent.pcoord[-1]
+            
+            segment.parent_id = -(initial_state.state_id+1)
+            segment.restart = initial_state.data['trajectories/restart'],
+            # We might have to do this, too...
+            #segment.data['trajectories/restart'] = initial_state.data['trajectories/restart']
+            segment.pcoord[0] = initial_state.pcoord
+
+            self.next_iter_binning[istate_assignment].add(segment)
+            
+            initial_state.iter_used = segment.n_iter
+            log.debug('marking initial state {!r} as used'.format(initial_state))
+        
+        for ibin in self.target_states:
+            self.next_iter_binning[ibin].difference_update(segment for (_tstate, segment) in recycled)
+            assert len(self.next_iter_binning[ibin]) == 0
+            
+        self.new_weights = NewWeightTable(nw_index, prev_init_pcoords, prev_final_pcoords, istate_pcoords)
             
         # Transfer newly-assigned states from "available" to "used"
-        for state_id in used_istate_ids:
-            self.used_initial_states[state_id] = self.avail_initial_states.pop(state_id)
+        for initial_state in initial_states:
+            self.used_initial_states[initial_state.state_id] = self.avail_initial_states.pop(initial_state.state_id)
             
                             
     def _split_walker(self, segment, m, bin):
@@ -678,6 +833,9 @@ class WEDriver:
                 self.next_iter_binning[ibin].add(new_segment)
                 
         self._run_we()
+
+        # Hold the progress coordinates of all new segments in one array
+        pack_pcoords(self.next_iter_segments)
                                     
     def construct_next(self):
         '''Construct walkers for the next iteration, by running weighted ensemble recycling
@@ -724,6 +882,9 @@ class WEDriver:
                 self._parent_map[segment.seg_id] = segment
                 
         self._run_we()
+
+        # Hold the progress coordinates of all new segments in one array
+        pack_pcoords(self.next_iter_segments)
         
         log.debug('used initial states: {!r}'.format(self.used_initial_states))
         log.debug('available initial states: {!r}'.format(self.avail_initial_states))
@@ -748,3 +909,375 @@ class WEDriver:
             log.log(level, log_msg)
                     
             
+
+
+class _WalkerArrays:
+    '''The walkers in one bin, as parallel arrays, for use by ``ArrayWEDriver``. Walker ``i``
+    has weight ``weights[i]`` and continues the history (parent, initial point, and restart data) of
+    the ``sources[i]``-th of the segments originally in the bin; ``modified[i]`` is true if the walker
+    was created by splitting or merging. The weight transfer graph is held in coordinate form:
+    walker ``wtg_walkers[k]`` receives weight from original segment ``wtg_sources[k]``.'''
+
+    def __init__(self, weights):
+        n_walkers = len(weights)
+        self.weights = numpy.array(weights, dtype=numpy.float64)
+        self.sources = numpy.arange(n_walkers)
+        self.modified = numpy.zeros((n_walkers,), dtype=numpy.bool_)
+        self.wtg_walkers = numpy.arange(n_walkers)
+        self.wtg_sources = numpy.arange(n_walkers)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def sort(self):
+        '''Order walkers by increasing weight.'''
+        order = numpy.argsort(self.weights, kind='mergesort')
+        new_index = numpy.empty_like(order)
+        new_index[order] = numpy.arange(len(order))
+        self.weights = self.weights[order]
+        self.sources = self.sources[order]
+        self.modified = self.modified[order]
+        self.wtg_walkers = new_index[self.wtg_walkers]
+
+    def expand(self, replicas, weights):
+        '''Replace the walkers with walkers ``replicas[j]`` (which may repeat), with new weights
+        ``weights[j]``. Each replica inherits the history and weight transfer graph of its original.'''
+        n_walkers = len(self.weights)
+        n_replicas = numpy.bincount(replicas, minlength=n_walkers)
+        replica_order = numpy.argsort(replicas, kind='mergesort')
+        first_replica = numpy.cumsum(n_replicas) - n_replicas
+
+        # Copy each entry of the weight transfer graph once for each replica of its walker
+        entry_counts = n_replicas[self.wtg_walkers]
+        entry_replicas = numpy.repeat(numpy.arange(len(self.wtg_walkers)), entry_counts)
+        replica_offsets = (numpy.arange(len(entry_replicas))
+                           - numpy.repeat(numpy.cumsum(entry_counts) - entry_counts, entry_counts))
+        self.wtg_walkers = replica_order[first_replica[self.wtg_walkers][entry_replicas] + replica_offsets]
+        self.wtg_sources = self.wtg_sources[entry_replicas]
+
+        self.weights = numpy.asarray(weights, dtype=numpy.float64)
+        self.sources = self.sources[replicas]
+        self.modified = (self.modified | (n_replicas > 1))[replicas]
+
+    def coalesce(self, groups, weights, sources):
+        '''Merge walkers, so that walker ``i`` becomes part of new walker ``groups[i]``, which has
+        weight ``weights[groups[i]]`` and continues the history of original segment
+        ``sources[groups[i]]``. The weight transfer graph of each new walker is the union of the
+        graphs of the walkers merged into it.'''
+        n_members = numpy.bincount(groups, minlength=len(weights))
+        modified = numpy.zeros((len(weights),), dtype=numpy.bool_)
+        modified[groups[self.modified]] = True
+        self.modified = modified | (n_members > 1)
+        self.weights = numpy.asarray(weights, dtype=numpy.float64)
+        self.sources = numpy.asarray(sources)
+        self.wtg_walkers = groups[self.wtg_walkers]
+
+
+def _split_walkers(walkers, target_count, split_threshold):
+    '''Split overweight walkers in ``walkers`` (sorted by weight), keeping them sorted.'''
+    weights = walkers.weights
+    if len(weights) > 0:
+        assert target_count > 0
+    ideal_weight = weights.sum() / target_count
+    to_split = weights > split_threshold*ideal_weight
+    if not to_split.any():
+        return
+
+    n_replicas = numpy.ones((len(weights),), dtype=numpy.intp)
+    n_replicas[to_split] = numpy.ceil(weights[to_split] / ideal_weight).astype(numpy.intp)
+    replicas = numpy.repeat(numpy.arange(len(weights)), n_replicas)
+    log.debug('splitting {:d} walkers into {:d}'.format(to_split.sum(), n_replicas[to_split].sum()))
+    walkers.expand(replicas, (weights / n_replicas)[replicas])
+    walkers.sort()
+
+def _merge_walkers(walkers, target_count, merge_cutoff, rng=random):
+    '''Merge underweight walkers in ``walkers`` (sorted by weight), keeping them sorted. Returns
+    True if any walkers were merged.'''
+    ideal_weight = walkers.weights.sum() / target_count
+    merged = False
+    while True:
+        cumul_weight = numpy.add.accumulate(walkers.weights)
+        n_merge = numpy.searchsorted(cumul_weight, ideal_weight*merge_cutoff, side='right')
+        if n_merge < 2:
+            return merged
+
+        glom_weight = cumul_weight[n_merge-1]
+        iparent = min(numpy.digitize((rng.uniform(0,glom_weight),), cumul_weight[:n_merge])[0], n_merge-1)
+        log.debug('merging {:d} walkers'.format(n_merge))
+
+        # The lightest n_merge walkers become one, placed so that walkers remain sorted by weight
+        n_walkers = len(walkers)
+        iglom = numpy.searchsorted(walkers.weights[n_merge:], glom_weight, side='right')
+        groups = numpy.arange(n_walkers) - n_merge
+        groups[n_merge:][iglom:] += 1
+        groups[:n_merge] = iglom
+        new_weights = numpy.insert(walkers.weights[n_merge:], iglom, glom_weight)
+        new_sources = numpy.insert(walkers.sources[n_merge:], iglom, walkers.sources[iparent])
+        walkers.coalesce(groups, new_weights, new_sources)
+        merged = True
+
+def _adjust_walker_count(walkers, target_count, rng=random):
+    '''Split or merge walkers in ``walkers`` (sorted by weight) until there are exactly
+    ``target_count`` of them, keeping them sorted. Returns True if any walkers were merged.'''
+    n_walkers = len(walkers)
+
+    # split: always split the highest probability walker into two
+    if n_walkers < target_count:
+        log.debug('adjusting counts by splitting')
+        heap = [(-weight, iwalker) for (iwalker, weight) in enumerate(walkers.weights)]
+        heapq.heapify(heap)
+        for _isplit in xrange(target_count - n_walkers):
+            (neg_weight, iwalker) = heapq.heappop(heap)
+            heapq.heappush(heap, (neg_weight/2, iwalker))
+            heapq.heappush(heap, (neg_weight/2, iwalker))
+        replicas = numpy.fromiter((iwalker for (_w, iwalker) in heap), dtype=numpy.intp, count=len(heap))
+        weights = numpy.fromiter((-neg_weight for (neg_weight, _i) in heap), dtype=numpy.float64, count=len(heap))
+        walkers.expand(replicas, weights)
+        walkers.sort()
+        return False
+
+    # merge: always merge the two lowest-probability walkers
+    elif n_walkers > target_count:
+        log.debug('adjusting counts by merging')
+        n_merges = n_walkers - target_count
+        # Each merge creates a new walker (ID n_walkers, n_walkers+1, ...); record which walker
+        # each walker was merged into, and whose history the new walker continues
+        merged_into = numpy.arange(n_walkers + n_merges)
+        sources = numpy.concatenate([walkers.sources, numpy.empty((n_merges,), dtype=walkers.sources.dtype)])
+        weights = numpy.concatenate([walkers.weights, numpy.empty((n_merges,), dtype=numpy.float64)])
+        heap = [(weight, iwalker) for (iwalker, weight) in enumerate(walkers.weights)]
+        heapq.heapify(heap)
+        for imerge in xrange(n_merges):
+            (weight_a, iwalker_a) = heapq.heappop(heap)
+            (weight_b, iwalker_b) = heapq.heappop(heap)
+            iglom = n_walkers + imerge
+            glom_weight = weight_a + weight_b
+            iparent = numpy.digitize((rng.uniform(0,glom_weight),), (weight_a, glom_weight))[0]
+            sources[iglom] = sources[iwalker_b if iparent > 0 else iwalker_a]
+            weights[iglom] = glom_weight
+            merged_into[iwalker_a] = merged_into[iwalker_b] = iglom
+            heapq.heappush(heap, (glom_weight, iglom))
+
+        # Follow each walker to the walker it ultimately became part of
+        final = merged_into
+        while True:
+            next_final = merged_into[final]
+            if (next_final == final).all():
+                break
+            final = next_final
+
+        survivors = numpy.array(sorted(iwalker for (_w, iwalker) in heap), dtype=numpy.intp)
+        survivors = survivors[numpy.argsort(weights[survivors], kind='mergesort')]
+        new_index = numpy.empty((n_walkers + n_merges,), dtype=numpy.intp)
+        new_index[survivors] = numpy.arange(len(survivors))
+        walkers.coalesce(new_index[final[:n_walkers]], weights[survivors], sources[survivors])
+        return True
+
+    return False
+
+def _resample_walkers(walkers, target_count, stages, split_threshold, merge_cutoff, rng=random):
+    '''Run the given resampling ``stages`` ('split', 'merge', and/or 'adjust', always in
+    that order) on ``walkers``. Returns True if any walkers were merged.'''
+    walkers.sort()
+    merged = False
+    if 'split' in stages:
+        _split_walkers(walkers, target_count, split_threshold)
+    if 'merge' in stages:
+        merged |= _merge_walkers(walkers, target_count, merge_cutoff, rng)
+    if 'adjust' in stages:
+        merged |= _adjust_walker_count(walkers, target_count, rng)
+    return merged
+
+def _resample_walkers_task(args):
+    '''Resample the walkers of one bin in a worker thread or process, using a random number
+    stream seeded by ``seed``. Returns ``(walkers, merged)``.'''
+    (weights, target_count, stages, split_threshold, merge_cutoff, seed) = args
+    walkers = _WalkerArrays(weights)
+    merged = _resample_walkers(walkers, target_count, stages, split_threshold, merge_cutoff, random.Random(seed))
+    return (walkers, merged)
+
+class ArrayWEDriver(WEDriver):
+    '''A weighted ensemble driver which performs splitting and merging on arrays of walker weights
+    rather than on sets of ``Segment`` objects, so that the cost of resampling a bin grows as
+    O(n log n) in the number of walkers in the bin, rather than quadratically. Each bin is sorted by
+    weight, merges keep it sorted, and repeated count adjustments are carried out with a heap. ``Segment`` objects are only created for walkers produced by splitting or merging,
+    once resampling of the bin is complete.
+    
+    Results are statistically equivalent to those of ``WEDriver`` (and consume random numbers from
+    the ``random`` module in the same way), although walkers of exactly equal weight may be
+    selected in a different order. The endpoint type of a parent segment is determined by whether
+    any of its children survive resampling: ``SEG_ENDPOINT_CONTINUES`` if so, or
+    ``SEG_ENDPOINT_MERGED`` if not. Likewise, initial states are returned to the pool of available
+    states if no surviving walker starts from them.
+    
+    Since bins are resampled independently, resampling may be spread across a pool of
+    ``resample_workers`` threads or processes (``resample_pool``). In that case each bin draws
+    random numbers from its own stream, seeded from a single draw from the ``random`` module per
+    iteration, so that results do not depend on the number of workers.
+
+    Select this driver with ``we_driver: array`` in the ``west.drivers`` section of the
+    configuration file.'''
+
+    resample_pool_types = ('thread', 'process')
+
+    def __init__(self, rc=None, system=None):
+        self.resample_workers = None
+        self.resample_pool_type = 'thread'
+        self._resample_pool = None
+        super(ArrayWEDriver, self).__init__(rc, system)
+
+    def process_config(self):
+        super(ArrayWEDriver, self).process_config()
+        config = self.rc.config
+
+        config.require_type_if_present(['west', 'we', 'resample_workers'], int)
+        self.resample_workers = config.get(['west', 'we', 'resample_workers'], self.resample_workers)
+        if self.resample_workers is not None and self.resample_workers < 1:
+            raise ValueError('invalid number of resampling workers {!r}'.format(self.resample_workers))
+
+        self.resample_pool_type = config.get(['west', 'we', 'resample_pool'], self.resample_pool_type)
+        if self.resample_pool_type not in self.resample_pool_types:
+            raise ValueError('invalid resampling pool type {!r}'.format(self.resample_pool_type))
+        if self.resample_workers is not None:
+            log.info('Resampling with {:d} {} worker(s)'.format(self.resample_workers, self.resample_pool_type))
+
+    def prepare_run(self):
+        super(ArrayWEDriver, self).prepare_run()
+        # Worker processes are forked now, so that they do not inherit the open HDF5 file
+        if self.resample_workers is not None and self.resample_pool_type == 'process':
+            self._get_resample_pool()
+
+    def finalize_run(self):
+        self.shutdown_resample_pool()
+        super(ArrayWEDriver, self).finalize_run()
+
+    def _get_resample_pool(self):
+        if self._resample_pool is None:
+            if self.resample_pool_type == 'process':
+                from multiprocessing import Pool
+                self._resample_pool = Pool(self.resample_workers)
+            else:
+                from multiprocessing.pool import ThreadPool
+                self._resample_pool = ThreadPool(self.resample_workers)
+        return self._resample_pool
+
+    def shutdown_resample_pool(self):
+        '''Stop any worker threads or processes used for resampling.'''
+        if self._resample_pool is not None:
+            self._resample_pool.close()
+            self._resample_pool.join()
+            self._resample_pool = None
+
+    def _run_we(self):
+        '''Run recycle/split/merge. Do not call this function directly; instead, use
+        populate_initial(), rebin_current(), or construct_next().'''
+        self._recycle_walkers()
+
+        # sanity check
+        self._check_pre()
+
+        stages = ('split', 'merge', 'adjust') if self.do_adjust_counts else ('split', 'merge')
+        if self.resample_workers is None:
+            for (ibin, bin) in enumerate(self.next_iter_binning):
+                if len(bin) == 0:
+                    continue
+                self._resample_bin(ibin, stages)
+        else:
+            self._resample_bins_parallel(stages)
+
+        self._check_post()
+
+        self.new_weights = self.new_weights or []
+
+        log.debug('used initial states: {!r}'.format(self.used_initial_states))
+        log.debug('available initial states: {!r}'.format(self.avail_initial_states))
+
+    def _split_by_weight(self, ibin):
+        '''Split overweight particles'''
+        self._resample_bin(ibin, ('split',))
+
+    def _merge_by_weight(self, ibin):
+        '''Merge underweight particles'''
+        self._resample_bin(ibin, ('merge',))
+
+    def _adjust_count(self, ibin):
+        self._resample_bin(ibin, ('adjust',))
+
+    def _resample_bin(self, ibin, stages):
+        '''Run the given resampling ``stages`` ('split', 'merge', and/or 'adjust', always in
+        that order) on bin ``ibin``.'''
+        bin = self.next_iter_binning[ibin]
+        segments = list(bin)
+        walkers = _WalkerArrays([segment.weight for segment in segments])
+        merged = _resample_walkers(walkers, self.bin_target_counts[ibin], stages,
+                                   self.weight_split_threshold, self.weight_merge_cutoff)
+        self._update_bin(bin, segments, walkers, merged)
+
+    def _resample_bins_parallel(self, stages):
+        '''Resample all occupied bins in the worker pool, then update the bins (in order) with
+        the results. Bin ``ibin`` uses the random number stream seeded by
+        ``base_seed*nbins + ibin``.'''
+        nbins = len(self.next_iter_binning)
+        base_seed = random.getrandbits(64)
+        occupied = [(ibin, bin, list(bin)) for (ibin, bin) in enumerate(self.next_iter_binning) if len(bin) > 0]
+        tasks = [([segment.weight for segment in segments], self.bin_target_counts[ibin], stages,
+                  self.weight_split_threshold, self.weight_merge_cutoff, base_seed*nbins + ibin)
+                 for (ibin, _bin, segments) in occupied]
+
+        if not tasks:
+            return
+        chunksize = max(1, len(tasks) // (4*self.resample_workers))
+        results = self._get_resample_pool().imap(_resample_walkers_task, tasks, chunksize)
+        for ((_ibin, bin, segments), (walkers, merged)) in izip(occupied, results):
+            self._update_bin(bin, segments, walkers, merged)
+
+    def _update_bin(self, bin, segments, walkers, merged):
+        '''Replace the contents of ``bin`` (originally ``segments``) with the resampled ``walkers``, and
+        update parent endpoint types and initial state usage to match.'''
+
+        # Gather the weight transfer graph for each walker
+        wtg_order = numpy.argsort(walkers.wtg_walkers, kind='mergesort')
+        wtg_sources = walkers.wtg_sources[wtg_order]
+        wtg_bounds = numpy.searchsorted(walkers.wtg_walkers[wtg_order], numpy.arange(len(walkers)+1))
+
+        new_segments = []
+        for (iwalker, (weight, isource, modified)) in enumerate(izip(walkers.weights, walkers.sources, walkers.modified)):
+            source = segments[isource]
+            if not modified:
+                new_segments.append(source)
+                continue
+
+            wtg_parent_ids = set()
+            for iwtg in numpy.unique(wtg_sources[wtg_bounds[iwalker]:wtg_bounds[iwalker+1]]):
+                wtg_parent_ids |= segments[iwtg].wtg_parent_ids
+            new_segment = Segment(n_iter=source.n_iter,
+                                  weight=weight,
+                                  parent_id=source.parent_id,
+                                  wtg_parent_ids=wtg_parent_ids,
+                                  pcoord=source.pcoord.copy(),
+                                  status=Segment.SEG_STATUS_PREPARED)
+            new_segment.restart = source.restart
+            new_segments.append(new_segment)
+
+        bin.clear()
+        bin.update(new_segments)
+
+        if not merged:
+            return
+
+        # Parents with surviving children continue; those without were merged. Initial states
+        # from which no surviving walker starts are made available again.
+        surviving_parent_ids = {segment.parent_id for segment in new_segments}
+        freed_istate_ids = set()
+        for segment in segments:
+            if segment.parent_id >= 0:
+                if segment.parent_id in surviving_parent_ids:
+                    self._parent_map[segment.parent_id].endpoint_type = Segment.SEG_ENDPOINT_CONTINUES
+                else:
+                    self._parent_map[segment.parent_id].endpoint_type = Segment.SEG_ENDPOINT_MERGED
+            elif segment.parent_id not in surviving_parent_ids and segment.initial_state_id not in freed_istate_ids:
+                initial_state = self.used_initial_states.pop(segment.initial_state_id)
+                log.debug('freeing initial state {!r} for future use (merged)'.format(initial_state))
+                self.avail_initial_states[initial_state.state_id] = initial_state
+                initial_state.iter_used = None
+                freed_istate_ids.add(segment.initial_state_id)
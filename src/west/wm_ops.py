@@ -16,6 +16,7 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 import westpa
+from work_managers import allow_speculation
 
 import logging
 log = logging.getLogger(__name__)
@@ -52,3 +53,9 @@ def propagate(basis_states, initial_states, segments):
     if log.isEnabledFor(logging.DEBUG):
         log.debug('propagated {:d} segments'.format(len(incoming_segments)))
     return [incoming_segments[seg_id] for seg_id in outgoing_ids]
+
+@allow_speculation
+def propagate_speculatively(basis_states, initial_states, segments):
+    '''As ``propagate()``, but work managers may run more than one copy of this task at once if it
+    straggles. Used only for propagators whose ``allow_speculation`` is true.'''
+    return propagate(basis_states, initial_states, segments)